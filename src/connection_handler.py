@@ -2,10 +2,13 @@
 """
 Handles requests to remote and integrated instances of Ollama
 """
-import json, os, requests, subprocess, threading, shutil
+import json, os, requests, subprocess, threading, shutil, socket
+from gi.repository import GLib
+from requests.adapters import HTTPAdapter
 from .internal import data_dir, cache_dir
+from .stream_decoder import iter_batches
 from logging import getLogger
-from time import sleep
+from time import sleep, monotonic
 
 logger = getLogger(__name__)
 
@@ -35,9 +38,241 @@ def log_output(pipe):
             except Exception as e:
                 pass
 
+class transport():
+    """
+    Persistent HTTP session for one endpoint, keeps a pool of keep-alive connections
+    """
+
+    def __init__(self, base_url:str, pool_size:int=10, connect_timeout:float=5, read_timeout:float=0):
+        self.base_url = base_url
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.requests = 0
+        self.failures = 0
+
+    def request(self, method:str, url:str, **kwargs) -> requests.models.Response:
+        self.requests += 1
+        try:
+            return self.session.request(method, url, timeout=(self.connect_timeout or None, self.read_timeout or None), **kwargs)
+        except Exception as e:
+            self.failures += 1
+            raise e
+
+    def get_stats(self) -> dict:
+        connections = 0
+        pool_requests = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            try:
+                pool = pools[key]
+            except KeyError:
+                continue
+            connections += pool.num_connections
+            pool_requests += pool.num_requests
+        return {
+            "requests": self.requests,
+            "connections": connections,
+            "reused": max(pool_requests - connections, 0),
+            "failures": self.failures
+        }
+
+    def close(self):
+        self.session.close()
+
+class request_handle():
+    """
+    Returned by instance.request, it can be cancelled from another thread to abort the request server side
+    """
+
+    def __init__(self):
+        self.response = None
+        self.endpoint = None
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    @property
+    def status_code(self) -> int:
+        if self.response is not None:
+            return self.response.status_code
+
+    @property
+    def text(self) -> str:
+        if self.response is not None:
+            return self.response.text
+
+    def set_response(self, response:requests.models.Response):
+        with self.lock:
+            self.response = response
+            if self.cancelled:
+                self.close_socket()
+
+    def close_socket(self):
+        # Closing the socket makes Ollama drop the generation and free the slot
+        raw = getattr(self.response, 'raw', None)
+        connection = getattr(raw, 'connection', None) or getattr(raw, '_connection', None)
+        sock = getattr(connection, 'sock', None)
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def cancel(self):
+        with self.lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            if self.response is not None:
+                self.close_socket()
+
+# Scheduler priority classes, lower goes first
+PRIORITY_CHAT = 0
+PRIORITY_REGENERATE = 1
+PRIORITY_BACKGROUND = 2
+
+class scheduled_job():
+
+    def __init__(self, target:str, priority:int, group:str, description:str):
+        self.target = target
+        self.priority = priority
+        self.group = group
+        self.description = description
+        self.sequence = 0
+        self.running = False
+        self.first_token = False
+        self.queued_at = monotonic()
+        self.started_at = None
+
+class scheduler():
+    """
+    Orders requests by priority and limits how many of them run at the same time on each instance
+    """
+
+    def __init__(self, get_limit:callable):
+        self.get_limit = get_limit
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.running = []
+        self.turns = {}
+        self.sequence = 0
+
+    def get_order(self, job:scheduled_job) -> tuple:
+        # Chats that got fewer turns go first inside the same priority class
+        return (job.priority, self.turns.get(job.group, 0), job.sequence)
+
+    def can_start(self, job:scheduled_job) -> bool:
+        running = [j for j in self.running if j.target == job.target]
+        if len(running) >= self.get_limit(job.target):
+            return False
+        # Background work waits while an interactive request is still waiting for its first token
+        if job.priority == PRIORITY_BACKGROUND and any(j.priority < PRIORITY_BACKGROUND and not j.first_token for j in running):
+            return False
+        return min((j for j in self.waiting if j.target == job.target), key=self.get_order) is job
+
+    def acquire(self, job:scheduled_job, handle) -> bool:
+        with self.condition:
+            self.sequence += 1
+            job.sequence = self.sequence
+            self.waiting.append(job)
+            while not self.can_start(job):
+                if handle.cancelled:
+                    self.waiting.remove(job)
+                    self.condition.notify_all()
+                    return False
+                self.condition.wait(0.25)
+            self.waiting.remove(job)
+            self.running.append(job)
+            job.running = True
+            job.started_at = monotonic()
+            self.turns[job.group] = self.turns.get(job.group, 0) + 1
+            return True
+
+    def mark_first_token(self, job:scheduled_job):
+        if not job.first_token:
+            with self.condition:
+                job.first_token = True
+                self.condition.notify_all()
+
+    def release(self, job:scheduled_job):
+        with self.condition:
+            if job in self.running:
+                self.running.remove(job)
+            if not any(j.group == job.group for j in self.running + self.waiting):
+                self.turns.pop(job.group, None)
+            self.condition.notify_all()
+
+    def get_queue(self) -> list:
+        with self.condition:
+            return [{
+                "description": job.description,
+                "target": job.target,
+                "priority": job.priority,
+                "running": job.running,
+                "elapsed": monotonic() - (job.started_at if job.running else job.queued_at)
+            } for job in self.running + sorted(self.waiting, key=self.get_order)]
+
+class endpoint():
+    """
+    An Ollama server requests can be routed to, it keeps track of its load and models
+    """
+
+    offline_retry_delay = 30
+
+    def __init__(self, url:str, bearer_token:str=None, local:bool=False):
+        self.url = url
+        self.bearer_token = bearer_token
+        self.local = local
+        self.models = set()
+        self.outstanding = 0
+        self.tokens_per_second = 0
+        self.offline_since = None
+        self.lock = threading.Lock()
+
+    def get_headers(self, include_json:bool) -> dict:
+        headers = {}
+        if include_json:
+            headers["Content-Type"] = "application/json"
+        if self.bearer_token and not self.local:
+            headers["Authorization"] = "Bearer " + self.bearer_token
+        return headers if len(headers.keys()) > 0 else None
+
+    def is_available(self) -> bool:
+        return self.offline_since is None or monotonic() - self.offline_since > self.offline_retry_delay
+
+    def set_online(self, online:bool):
+        if online:
+            self.offline_since = None
+        elif self.offline_since is None:
+            logger.warning('Instance {} is offline'.format(self.url))
+            self.offline_since = monotonic()
+
+    def add_outstanding(self, amount:int):
+        with self.lock:
+            self.outstanding += amount
+
+    def record_speed(self, data:dict):
+        if data.get('eval_count') and data.get('eval_duration'):
+            speed = data['eval_count'] / (data['eval_duration'] / 1e9)
+            with self.lock:
+                self.tokens_per_second = speed if not self.tokens_per_second else self.tokens_per_second * 0.7 + speed * 0.3
+
+    def get_load(self) -> tuple:
+        return (self.outstanding, -self.tokens_per_second)
+
+# Integrated instance states
+STATE_STOPPED = 'stopped'
+STATE_STARTING = 'starting'
+STATE_READY = 'ready'
+STATE_FAILED = 'failed'
+
 class instance():
+    ready_timeout = 30
 
-    def __init__(self, local_port:int, remote_url:str, remote:bool, tweaks:dict, overrides:dict, bearer_token:str, idle_timer_delay:int, model_directory:str):
+    def __init__(self, local_port:int, remote_url:str, remote:bool, tweaks:dict, overrides:dict, bearer_token:str, idle_timer_delay:int, model_directory:str, connection_settings:dict=None):
         self.local_port=local_port
         self.remote_url=remote_url
         self.remote=remote
@@ -50,43 +285,237 @@ class instance():
         self.idle_timer=None
         self.instance=None
         self.busy=0
+        self.connection_settings = {"pool_size": 10, "connect_timeout": 5, "read_timeout": 0}
+        if connection_settings:
+            self.connection_settings.update(connection_settings)
+        self.transports = {}
+        self.transports_lock = threading.Lock()
+        self.endpoints = {}
+        self.extra_endpoints = []
+        self.scheduler = scheduler(self.get_parallel_limit)
+        self.preload_enabled = False
+        self.preload_lock = threading.Lock()
+        self.preload_handle = None
+        self.preloading = None
+        self.state = STATE_STOPPED
+        self.ready_event = threading.Event()
+        self.startup_latency = None
 
-    def get_headers(self, include_json:bool) -> dict:
-        headers = {}
-        if include_json:
-            headers["Content-Type"] = "application/json"
-        if self.bearer_token and self.remote:
-            headers["Authorization"] = "Bearer " + self.bearer_token
-        return headers if len(headers.keys()) > 0 else None
+    def get_parallel_limit(self, base_url:str) -> int:
+        # Matches the slots Ollama has available, the integrated instance can be configured with OLLAMA_NUM_PARALLEL
+        if base_url == 'http://127.0.0.1:{}'.format(self.local_port):
+            try:
+                return max(int(self.overrides.get('OLLAMA_NUM_PARALLEL')), 1)
+            except (TypeError, ValueError):
+                pass
+        return 4
 
-    def request(self, connection_type:str, connection_url:str, data:dict=None, callback:callable=None) -> requests.models.Response:
-        self.busy += 1
-        if self.idle_timer and not self.remote:
-            self.idle_timer_stop_event.set()
-            self.idle_timer=None
-        if not self.instance and not self.remote:
-            self.start()
-        connection_url = '{}/{}'.format(self.remote_url if self.remote else 'http://127.0.0.1:{}'.format(self.local_port), connection_url)
-        if self.remote:
+    def get_base_url(self) -> str:
+        return self.remote_url if self.remote else 'http://127.0.0.1:{}'.format(self.local_port)
+
+    def get_primary_endpoint(self) -> endpoint:
+        base_url = self.get_base_url()
+        if base_url not in self.endpoints:
+            self.endpoints[base_url] = endpoint(base_url, None, not self.remote)
+        self.endpoints[base_url].bearer_token = self.bearer_token if self.remote else None
+        return self.endpoints[base_url]
+
+    def get_endpoints(self) -> list:
+        primary = self.get_primary_endpoint()
+        return [primary] + [target for target in self.extra_endpoints if target.url != primary.url]
+
+    def add_endpoint(self, url:str, bearer_token:str=None) -> endpoint:
+        self.remove_endpoint(url)
+        target = endpoint(url, bearer_token)
+        self.extra_endpoints.append(target)
+        return target
+
+    def remove_endpoint(self, url:str):
+        self.extra_endpoints = [target for target in self.extra_endpoints if target.url != url]
+        if url != self.get_base_url():
+            self.close_transport(url)
+
+    def get_candidates(self, model:str=None) -> list:
+        # Requests that aren't tied to a model (pulls, deletes, tags) only go to the main instance
+        if not model:
+            return [self.get_primary_endpoint()]
+        candidates = [target for target in self.get_endpoints() if target.is_available()]
+        with_model = [target for target in candidates if model in target.models]
+        if with_model:
+            candidates = with_model
+        candidates.sort(key=lambda target: target.get_load())
+        return candidates if len(candidates) > 0 else [self.get_primary_endpoint()]
+
+    def get_max_loaded_models(self, base_url:str) -> int:
+        if base_url == 'http://127.0.0.1:{}'.format(self.local_port):
+            try:
+                return max(int(self.overrides.get('OLLAMA_MAX_LOADED_MODELS')), 1)
+            except (TypeError, ValueError):
+                pass
+        # Without knowing the memory of the server assume only one model fits
+        return 1
+
+    def preload_model(self, model:str):
+        if not self.preload_enabled or not model:
+            return
+        with self.preload_lock:
+            if self.preloading == model:
+                return
+            if self.preload_handle:
+                self.preload_handle.cancel()
+            self.preloading = model
+            self.preload_handle = request_handle()
+            threading.Thread(target=self.run_preload, args=(model, self.preload_handle), daemon=True).start()
+
+    def run_preload(self, model:str, handle:request_handle):
+        try:
+            sleep(0.5)
+            if handle.cancelled:
+                return
+            target = self.get_candidates(model)[0]
+            response = self.request("GET", "api/ps", handle=handle, target=target)
+            if handle.cancelled or response.status_code != 200:
+                return
+            loaded = [m['name'] for m in json.loads(response.text)['models']]
+            if model in loaded:
+                return
+            if len(loaded) >= self.get_max_loaded_models(target.url):
+                logger.info("Skipping preload of '{}', it would unload {}".format(model, ', '.join(loaded)))
+                return
+            handle.response = None
+            logger.info("Preloading '{}'".format(model))
+            # Streamed so the response is available while the model loads and cancelling closes its socket
+            data = {"model": model, "keep_alive": "{}m".format(self.tweaks['keep_alive']), "stream": True}
+            self.request("POST", "api/generate", json.dumps(data), lambda data: None, handle=handle, target=target, priority=PRIORITY_BACKGROUND, group='preload')
+        except Exception as e:
+            logger.error("Could not preload '{}': {}".format(model, e))
+        finally:
+            with self.preload_lock:
+                if self.preload_handle is handle:
+                    self.preload_handle = None
+                    self.preloading = None
+
+    def refresh_endpoints(self) -> list:
+        models = []
+        reachable = False
+        for target in self.get_endpoints():
+            try:
+                response = self.request("GET", "api/tags", target=target)
+                if response.status_code != 200:
+                    raise Exception('Status code {}'.format(response.status_code))
+                target_models = [model['name'] for model in json.loads(response.text)['models']]
+                target.models = set(target_models)
+                models += [model for model in target_models if model not in models]
+                reachable = True
+            except Exception as e:
+                logger.error('Could not list models of {}: {}'.format(target.url, e))
+                target.set_online(False)
+        if not reachable:
+            raise Exception('No instance is reachable')
+        return models
+
+    def get_transport(self, base_url:str) -> transport:
+        with self.transports_lock:
+            if base_url not in self.transports:
+                self.transports[base_url] = transport(base_url, self.connection_settings['pool_size'], self.connection_settings['connect_timeout'], self.connection_settings['read_timeout'])
+            return self.transports[base_url]
+
+    def close_transport(self, base_url:str):
+        with self.transports_lock:
+            connection = self.transports.pop(base_url, None)
+        if connection:
+            logger.info('Closing connection pool for {} {}'.format(base_url, connection.get_stats()))
+            connection.close()
+
+    def request(self, connection_type:str, connection_url:str, data:dict=None, callback:callable=None, handle:request_handle=None, model:str=None, target:endpoint=None, priority:int=None, group:str=None, batched:bool=False) -> request_handle:
+        if not handle:
+            handle = request_handle()
+        candidates = [target] if target else self.get_candidates(model)
+        for i, candidate in enumerate(candidates):
+            if handle.cancelled:
+                break
+            job = None
+            try:
+                if priority is not None:
+                    job = scheduled_job(candidate.url, priority, group or connection_url, '{} {}'.format(connection_url, model or '').strip())
+                    candidate.add_outstanding(1)
+                    try:
+                        if not self.scheduler.acquire(job, handle):
+                            break
+                    finally:
+                        candidate.add_outstanding(-1)
+                self.send(candidate, connection_type, connection_url, data, self.wrap_first_token(callback, job) if callback and job else callback, handle, batched)
+                candidate.set_online(True)
+                break
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                candidate.set_online(False)
+                # Can't reroute once the response started arriving
+                if handle.response is not None or i == len(candidates) - 1:
+                    raise e
+                logger.warning('Rerouting request from {} to {}: {}'.format(candidate.url, candidates[i + 1].url, e))
+            finally:
+                if job:
+                    self.scheduler.release(job)
+        return handle
+
+    def wrap_first_token(self, callback:callable, job:scheduled_job) -> callable:
+        def wrapper(data:dict):
+            self.scheduler.mark_first_token(job)
+            callback(data)
+        return wrapper
+
+    def send(self, target:endpoint, connection_type:str, connection_url:str, data:dict, callback:callable, handle:request_handle, batched:bool=False):
+        if target.local:
+            self.busy += 1
+            if self.idle_timer:
+                self.idle_timer_stop_event.set()
+                self.idle_timer=None
+            if not self.instance or self.instance.poll() is not None:
+                # Also restarts the instance if it exited or failed to start before
+                self.start()
+            if not self.wait_until_ready():
+                self.busy -= 1
+                raise requests.exceptions.ConnectionError("Alpaca's Ollama instance is not ready ({})".format(self.state))
+        target.add_outstanding(1)
+        handle.endpoint = target.url
+        connection = self.get_transport(target.url)
+        connection_url = '{}/{}'.format(target.url, connection_url)
+        if not target.local:
             logger.info('{} : {}'.format(connection_type, connection_url))
-        response = None
-        if connection_type == "GET":
-            response = requests.get(connection_url, headers=self.get_headers(False))
-        elif connection_type == "POST":
-            if callback:
-                response = requests.post(connection_url, headers=self.get_headers(True), data=data, stream=True)
-                if response.status_code == 200:
-                    for line in response.iter_lines():
-                        if line:
-                            callback(json.loads(line.decode("utf-8")))
-            else:
-                response = requests.post(connection_url, headers=self.get_headers(True), data=data, stream=False)
-        elif connection_type == "DELETE":
-            response = requests.delete(connection_url, headers=self.get_headers(False), data=data)
-        self.busy -= 1
-        if not self.idle_timer and not self.remote:
+        try:
+            if connection_type == "GET":
+                handle.set_response(connection.request("GET", connection_url, headers=target.get_headers(False)))
+            elif connection_type == "POST":
+                if callback:
+                    handle.set_response(connection.request("POST", connection_url, headers=target.get_headers(True), data=data, stream=True))
+                    try:
+                        if handle.status_code == 200:
+                            for chunks in iter_batches(handle.response, lambda: handle.cancelled):
+                                if chunks[-1].get('done'):
+                                    target.record_speed(chunks[-1])
+                                if batched:
+                                    callback(chunks)
+                                else:
+                                    for chunk in chunks:
+                                        callback(chunk)
+                    except Exception as e:
+                        if not handle.cancelled:
+                            raise e
+                    finally:
+                        handle.response.close()
+                    if handle.cancelled:
+                        logger.info('Request cancelled: {}'.format(connection_url))
+                else:
+                    handle.set_response(connection.request("POST", connection_url, headers=target.get_headers(True), data=data, stream=False))
+            elif connection_type == "DELETE":
+                handle.set_response(connection.request("DELETE", connection_url, headers=target.get_headers(False), data=data))
+        finally:
+            target.add_outstanding(-1)
+            if target.local:
+                self.busy -= 1
+            logger.debug('Connection pool for {} {}'.format(target.url, connection.get_stats()))
+        if target.local and not self.idle_timer:
             self.start_timer()
-        return response
 
     def run_timer(self):
         if not self.idle_timer_stop_event.wait(self.idle_timer_delay*60):
@@ -113,42 +542,92 @@ class instance():
             params["OLLAMA_HOST"] = f"127.0.0.1:{self.local_port}" # You can't change this directly sorry :3
             params["OLLAMA_MODELS"] = self.model_directory
             params["TMPDIR"] = os.path.join(cache_dir, 'tmp/ollama')
+            self.state = STATE_STARTING
+            self.ready_event.clear()
+            spawn_time = monotonic()
             instance = subprocess.Popen(["ollama", "serve"], env={**os.environ, **params}, stderr=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
             threading.Thread(target=log_output, args=(instance.stdout,)).start()
             threading.Thread(target=log_output, args=(instance.stderr,)).start()
             logger.info("Starting Alpaca's Ollama instance...")
             logger.debug(params)
-            logger.info("Started Alpaca's Ollama instance")
-            try:
-                v_str = subprocess.check_output("ollama -v", shell=True).decode('utf-8')
-                logger.info(v_str.split('\n')[1].strip('Warning: ').strip())
-            except Exception as e:
-                logger.error(e)
             self.instance = instance
+            threading.Thread(target=self.probe_readiness, args=(instance, spawn_time), daemon=True).start()
             if not self.idle_timer:
                 self.start_timer()
-            window.ollama_information_label.set_label(_("Integrated Ollama instance is running"))
-            window.ollama_information_label.set_css_classes(['dim-label', 'success'])
+            self.show_status(_("Integrated Ollama instance is starting"), ['dim-label'])
         else:
             self.remote = True
             window.remote_connection_switch.set_sensitive(True)
             window.remote_connection_switch.set_active(True)
 
+    def probe_readiness(self, instance:subprocess.Popen, spawn_time:float):
+        url = 'http://127.0.0.1:{}/api/version'.format(self.local_port)
+        delay = 0.05
+        version = None
+        while monotonic() - spawn_time < self.ready_timeout:
+            if self.instance is not instance or instance.poll() is not None:
+                break
+            try:
+                response = requests.get(url, timeout=1)
+                if response.status_code == 200:
+                    version = response.json().get('version')
+                    break
+            except (requests.exceptions.RequestException, ValueError):
+                pass
+            sleep(delay)
+            delay = min(delay * 2, 1)
+        if self.instance is not instance:
+            # Stopped or replaced while starting
+            return
+        if version is None:
+            self.state = STATE_FAILED
+            self.ready_event.set()
+            logger.error("Alpaca's Ollama instance did not become ready after {:.2f}s".format(monotonic() - spawn_time))
+            self.show_status(_("Integrated Ollama instance failed to start"), ['dim-label', 'error'])
+            # The process is dropped so the next request starts a new one instead of failing until a manual reset
+            if instance.poll() is None:
+                instance.terminate()
+                instance.wait()
+            if self.instance is instance:
+                self.instance = None
+            return
+        self.startup_latency = monotonic() - spawn_time
+        self.state = STATE_READY
+        self.ready_event.set()
+        logger.info("Started Alpaca's Ollama instance (version {}) in {:.2f}s".format(version, self.startup_latency))
+        self.show_status(_("Integrated Ollama instance is running"), ['dim-label', 'success'], _("Ready in {:.2f} seconds").format(self.startup_latency))
+
+    def show_status(self, label:str, css_classes:list, tooltip:str=None):
+        # Called from the request and probe threads
+        def update():
+            window.ollama_information_label.set_label(label)
+            window.ollama_information_label.set_css_classes(css_classes)
+            window.ollama_information_label.set_tooltip_text(tooltip)
+        GLib.idle_add(update)
+
+    def wait_until_ready(self) -> bool:
+        if self.state == STATE_STARTING:
+            self.ready_event.wait(self.ready_timeout)
+        return self.state == STATE_READY
+
     def stop(self):
         if self.idle_timer:
             self.idle_timer_stop_event.set()
             self.idle_timer=None
+        self.close_transport('http://127.0.0.1:{}'.format(self.local_port))
         if self.instance:
             logger.info("Stopping Alpaca's Ollama instance")
-            self.instance.terminate()
-            self.instance.wait()
+            instance = self.instance
             self.instance = None
-            window.ollama_information_label.set_label(_("Integrated Ollama instance is not running"))
-            window.ollama_information_label.set_css_classes(['dim-label'])
+            instance.terminate()
+            instance.wait()
+            self.show_status(_("Integrated Ollama instance is not running"), ['dim-label'])
             logger.info("Stopped Alpaca's Ollama instance")
+        self.state = STATE_STOPPED
+        self.ready_event.set()
 
     def reset(self):
         logger.info("Resetting Alpaca's Ollama instance")
+        # stop() waits for the process to exit so the port is already free
         self.stop()
-        sleep(1)
         self.start()
@@ -7,14 +7,19 @@ import gi
 gi.require_version('Gtk', '4.0')
 gi.require_version('GtkSource', '5')
 from gi.repository import Gtk, Gio, Adw, Gdk, GLib
-import logging, os, datetime, shutil, random, json, sqlite3, threading
+import logging, os, shutil, random, json, threading
+from collections import OrderedDict
 from ..internal import data_dir, cache_dir
-from .message_widget import message
+from .. import markdown_parser, storage
+from .message_widget import message, messages_by_model
 
 logger = logging.getLogger(__name__)
 
 window = None
 
+# Number of messages loaded at once when a chat is opened or scrolled back
+PAGE_SIZE = 50
+
 possible_prompts = [
     "What can you do?",
     "Give me a pancake recipe",
@@ -43,7 +48,7 @@ possible_prompts = [
 class chat(Gtk.ScrolledWindow):
     __gtype_name__ = 'AlpacaChat'
 
-    def __init__(self, name:str, chat_id=str, quick_chat:bool=False):
+    def __init__(self, name:str, chat_id=str, quick_chat:bool=False, last_activity=None):
         self.container = Gtk.Box(
             orientation=1,
             hexpand=True,
@@ -73,13 +78,90 @@ class chat(Gtk.ScrolledWindow):
         self.welcome_screen = None
         self.regenerate_button = None
         self.busy = False
+        self.request_handle = None
         self.chat_id = chat_id
         self.quick_chat = quick_chat
+        self.last_activity = last_activity
+        self.hydrated = False
+        self.has_older = False
+        self.oldest_message = None # Id of the oldest loaded message
+        self.loading = False # A page is being read in a thread
+        self.pending_loads = [] # Run once the page being read was added
+        self.visibility_source = None
+        self.get_vadjustment().connect('value-changed', lambda *_: self.queue_visibility_update())
+        self.get_vadjustment().connect('notify::page-size', lambda *_: self.queue_visibility_update())
+        self.connect('map', lambda *_: self.queue_visibility_update())
         #self.get_vadjustment().connect('notify::page-size', lambda va, *_: va.set_value(va.get_upper() - va.get_page_size()) if va.get_value() == 0 else None)
         ##TODO Figure out how to do this with the search thing
 
+    def queue_visibility_update(self):
+        if not self.visibility_source:
+            self.visibility_source = GLib.timeout_add(100, self.update_visible_messages)
+
+    def update_visible_messages(self) -> bool:
+        # Only messages around the viewport keep their content widgets
+        self.visibility_source = None
+        if not self.get_mapped():
+            return GLib.SOURCE_REMOVE
+        vadjustment = self.get_vadjustment()
+        value = vadjustment.get_value()
+        page = vadjustment.get_page_size()
+        anchor = None
+        shifted = False
+        for message_element in list(self.messages.values()):
+            if not message_element.get_visible():
+                continue
+            found, x, y = message_element.translate_coordinates(self.container, 0, 0)
+            if not found:
+                continue
+            height = message_element.get_height()
+            if not anchor and y + height > value:
+                anchor = (message_element, y - value)
+            if y + height >= value - page and y <= value + page * 2:
+                if not message_element.loaded:
+                    message_element.load()
+                    shifted = shifted or not anchor
+                    # The new blocks only have a position after the next layout
+                    self.queue_visibility_update()
+                elif message_element.update_code_blocks(self.container, value, page):
+                    shifted = shifted or not anchor
+            elif y + height < value - page * 3 or y > value + page * 4:
+                if message_element.loaded:
+                    message_element.unload()
+                    shifted = shifted or not anchor
+        if self.has_older and value < page:
+            self.load_older_messages()
+        if shifted and anchor:
+            # Keeps the first visible message in place if messages above it changed their height
+            GLib.idle_add(self.restore_anchor, *anchor, priority=GLib.PRIORITY_LOW)
+        return GLib.SOURCE_REMOVE
+
+    def restore_anchor(self, message_element, offset:float):
+        found, x, y = message_element.translate_coordinates(self.container, 0, 0)
+        if found:
+            self.get_vadjustment().set_value(y - offset)
+
+    def hydrate(self):
+        # Chats start as stubs, their messages are only loaded once they are needed
+        if not self.hydrated:
+            self.hydrated = True
+            self.load_chat_messages()
+
+    def dehydrate(self):
+        for widget in list(self.container):
+            self.container.remove(widget)
+        self.messages = {}
+        self.welcome_screen = None
+        self.regenerate_button = None
+        self.hydrated = False
+        self.has_older = False
+        self.oldest_message = None
+
     def stop_message(self):
         self.busy = False
+        if self.request_handle:
+            self.request_handle.cancel()
+            self.request_handle = None
         window.switch_send_stop_button(True)
 
     def clear_chat(self):
@@ -142,24 +224,123 @@ class chat(Gtk.ScrolledWindow):
         self.container.append(self.welcome_screen)
 
     def load_chat_messages(self):
-        sqlite_con = sqlite3.connect(window.sqlite_path)
-        cursor = sqlite_con.cursor()
-        cursor.execute("SELECT id, role, model, date_time, content FROM message WHERE chat_id=?", (self.chat_id,))
-        messages = cursor.fetchall()
+        # Only the newest page is loaded, older pages are fetched when scrolling up
+        self.loading = True
+        threading.Thread(target=self.read_first_page).start()
+
+    def read_first_page(self):
+        messages, attachments = storage.get_message_page(self.chat_id, PAGE_SIZE + 1)
+        GLib.idle_add(self.add_first_page, messages, attachments, self.read_blocks(messages[:PAGE_SIZE]))
+
+    def add_first_page(self, messages:list, attachments:dict, blocks:dict):
+        # The chat could have been dehydrated or already filled while the page was being read
+        if self.hydrated and len(self.messages) == 0:
+            self.show_first_page(messages, attachments, blocks)
+        self.finish_loading()
+
+    def show_first_page(self, messages:list, attachments:dict, blocks:dict):
+        self.has_older = len(messages) > PAGE_SIZE
+        messages = messages[:PAGE_SIZE]
         if len(messages) > 0:
             if self.welcome_screen:
                 self.container.remove(self.welcome_screen)
                 self.welcome_screen = None
-            for message in messages:
-                self.add_message(message[0], message[2] if message[1] == 'assistant' else None, message[1] == 'system')
-                message_element = self.messages[message[0]]
-                for attachment in cursor.execute("SELECT id, type, name, content FROM attachment WHERE message_id=?", (message[0],)):
-                    message_element.add_attachment(attachment[2], attachment[1], attachment[3])
-                message_element.set_text(message[4])
-                message_element.add_footer(datetime.datetime.strptime(message[3] + (":00" if message[3].count(":") == 1 else ""), '%Y/%m/%d %H:%M:%S'))
+            self.add_message_rows(messages[::-1], attachments, blocks)
         else:
             self.show_welcome_screen(len(window.model_manager.get_model_list()) > 0)
-        sqlite_con.close()
+        self.queue_visibility_update()
+        if len(messages) > 0 and window.chat_stack.get_visible_child() == self:
+            window.model_manager.change_model(messages[0][2])
+
+    def when_loaded(self, callback:callable):
+        # Runs callback once the page being read was added, right away if nothing is being read
+        if self.loading:
+            self.pending_loads.append(callback)
+        else:
+            callback()
+
+    def finish_loading(self):
+        self.loading = False
+        pending_loads = self.pending_loads
+        self.pending_loads = []
+        for callback in pending_loads:
+            callback()
+
+    def load_older_messages(self, limit:int=PAGE_SIZE, callback:callable=None):
+        # A negative limit loads every remaining message, callback runs once they were added
+        if self.loading:
+            if callback:
+                self.pending_loads.append(lambda: self.load_older_messages(limit, callback))
+            return
+        if not self.has_older or not self.oldest_message:
+            if callback:
+                callback()
+            return
+        self.loading = True
+        threading.Thread(target=self.read_older_page, args=(limit, self.oldest_message, callback)).start()
+
+    def read_older_page(self, limit:int, before:str, callback:callable):
+        messages, attachments = storage.get_message_page(self.chat_id, limit + 1 if limit >= 0 else -1, before)
+        has_older = limit >= 0 and len(messages) > limit
+        if limit >= 0:
+            messages = messages[:limit]
+        GLib.idle_add(self.add_older_page, before, messages, attachments, self.read_blocks(messages), has_older, callback)
+
+    def add_older_page(self, before:str, messages:list, attachments:dict, blocks:dict, has_older:bool, callback:callable):
+        # Skipped if the chat was dehydrated while the page was being read
+        if self.hydrated and before == self.oldest_message:
+            self.has_older = has_older
+            self.show_older_page(messages, attachments, blocks)
+        if callback:
+            callback()
+        self.finish_loading()
+
+    def show_older_page(self, messages:list, attachments:dict, blocks:dict):
+        if len(messages) > 0:
+            anchor = next(iter(self.messages.values()), None)
+            offset = 0
+            if anchor:
+                found, x, y = anchor.translate_coordinates(self.container, 0, 0)
+                offset = y - self.get_vadjustment().get_value() if found else 0
+            self.add_message_rows(messages[::-1], attachments, blocks, True)
+            if anchor:
+                # Keeps the view on the message that was at the top before the older ones were added
+                GLib.idle_add(self.restore_anchor, anchor, offset, priority=GLib.PRIORITY_LOW)
+
+    def read_blocks(self, messages:list) -> dict:
+        # Runs with the page read, blocks missing from the cache are parsed here instead of while the rows are built
+        hashes = {row[0]: markdown_parser.get_hash(row[4]) for row in messages if row[4]}
+        cached_blocks = {message_hash: markdown_parser.load_blocks(blocks) for message_hash, blocks in storage.get_message_asts(list(set(hashes.values())), markdown_parser.PARSER_VERSION).items()}
+        new_blocks = {}
+        for row in messages:
+            if row[0] in hashes and hashes[row[0]] not in cached_blocks:
+                cached_blocks[hashes[row[0]]] = new_blocks[hashes[row[0]]] = markdown_parser.tokenize(row[4])
+        if new_blocks:
+            storage.add_message_asts([(message_hash, markdown_parser.PARSER_VERSION, markdown_parser.dump_blocks(blocks)) for message_hash, blocks in new_blocks.items()])
+        return {message_id: cached_blocks[message_hash] for message_id, message_hash in hashes.items()}
+
+    def add_message_rows(self, messages:list, attachments:dict, blocks:dict, prepend:bool=False):
+        # Messages must be sorted from oldest to newest, attachments come from storage.get_message_page and blocks from read_blocks
+        page = {}
+        for row in (messages[::-1] if prepend else messages):
+            message_element = message(row[0], row[2] if row[1] == 'assistant' else None, row[1] == 'system')
+            page[row[0]] = message_element
+            if prepend:
+                self.container.prepend(message_element)
+            else:
+                self.container.append(message_element)
+            for attachment_type, name, content in attachments.get(row[0], []):
+                message_element.add_attachment(name, attachment_type, content)
+            if row[0] in blocks:
+                message_element.defer_text(row[4], blocks[row[0]])
+            else:
+                message_element.set_text(row[4])
+            message_element.add_footer(row[3])
+        if prepend:
+            self.messages = {**dict(reversed(page.items())), **self.messages}
+        else:
+            self.messages.update(page)
+        self.oldest_message = messages[0][0]
 
     def on_export_successful(self, file, result):
         file.replace_contents_finish(result)
@@ -180,6 +361,11 @@ class chat(Gtk.ScrolledWindow):
 
     def export_md(self, obsidian:bool):
         logger.info("Exporting chat (MD)")
+        window.chat_list_box.hydrate_chat(self)
+        # Every message has to be loaded first
+        self.load_older_messages(-1, lambda: self.write_export_md(obsidian))
+
+    def write_export_md(self, obsidian:bool):
         markdown = []
         for message_id, message_element in self.messages.items():
             if message_element.text and message_element.dt:
@@ -219,27 +405,65 @@ class chat(Gtk.ScrolledWindow):
 
     def export_db(self):
         logger.info("Exporting chat (DB)")
+        # The export waits for pending writes, it's done off the main thread
+        threading.Thread(target=self.write_export_db).start()
+
+    def write_export_db(self):
         if os.path.isfile(os.path.join(cache_dir, 'export.db')):
             os.remove(os.path.join(cache_dir, 'export.db'))
-        sqlite_con = sqlite3.connect(window.sqlite_path)
-        cursor = sqlite_con.cursor()
-        cursor.execute("ATTACH DATABASE ? AS export", (os.path.join(cache_dir, 'export.db'),))
-        cursor.execute("CREATE TABLE export.chat AS SELECT * FROM chat WHERE id=?", (self.chat_id,))
-        cursor.execute("CREATE TABLE export.message AS SELECT * FROM message WHERE chat_id=?", (self.chat_id,))
-        cursor.execute("CREATE TABLE export.attachment AS SELECT a.* FROM attachment as a JOIN message m ON a.message_id = m.id WHERE m.chat_id=?", (self.chat_id,))
-        sqlite_con.commit()
-        sqlite_con.close()
+        storage.export_chat(self.chat_id, os.path.join(cache_dir, 'export.db'))
+        GLib.idle_add(self.save_export_db)
+
+    def save_export_db(self):
         file_dialog = Gtk.FileDialog(initial_name=f"{self.get_name()}.db")
         file_dialog.save(parent=window, cancellable=None, callback=lambda file_dialog, result, temp_path=os.path.join(cache_dir, 'export.db'): self.on_export_chat(file_dialog, result, temp_path))
 
     def export_json(self, include_metadata:bool):
         logger.info("Exporting chat (JSON)")
+        window.chat_list_box.hydrate_chat(self)
+        self.when_loaded(lambda: threading.Thread(target=self.write_export_json, args=(self.convert_to_ollama(include_metadata), self.get_unloaded_key(), include_metadata)).start())
+
+    def write_export_json(self, messages:list, older_than:str, include_metadata:bool):
+        if older_than:
+            messages = self.get_older_ollama_messages(older_than, include_metadata) + messages
         with open(os.path.join(cache_dir, 'export.json'), 'w') as f:
-            f.write(json.dumps({self.get_name() if include_metadata else 'messages': self.convert_to_ollama(include_metadata)}, indent=4))
+            f.write(json.dumps({self.get_name() if include_metadata else 'messages': messages}, indent=4))
+        GLib.idle_add(self.save_export_json)
+
+    def save_export_json(self):
         file_dialog = Gtk.FileDialog(initial_name=f"{self.get_name()}.json")
         file_dialog.save(parent=window, cancellable=None, callback=lambda file_dialog, result, temp_path=os.path.join(cache_dir, 'export.json'): self.on_export_chat(file_dialog, result, temp_path))
 
-    def convert_to_ollama(self, include_metadata:bool=False) -> dict:
+    def get_unloaded_key(self) -> str:
+        # Messages older than this id only exist in the database
+        return self.oldest_message if self.has_older else None
+
+    def get_older_ollama_messages(self, older_than:str, include_metadata:bool=False) -> list:
+        # Runs off the main thread, messages that aren't loaded are read from the database instead of building their widgets
+        rows, attachments = storage.get_message_page(self.chat_id, before=older_than)
+        rows = rows[::-1]
+        messages = []
+        for row in rows:
+            if not row[4]:
+                continue
+            message_data = {
+                'role': row[1],
+                'content': ''
+            }
+            for attachment_type, name, content in attachments.get(row[0], []):
+                if attachment_type == 'image':
+                    message_data.setdefault('images', []).append(content)
+                else:
+                    message_data['content'] += '```{} ({})\n{}\n```\n\n'.format(name, attachment_type, content)
+            message_data['content'] += row[4]
+            if include_metadata:
+                message_data['date'] = row[3].strftime("%Y/%m/%d %H:%M:%S")
+                message_data['model'] = row[2] if row[1] == 'assistant' else None
+            messages.append(message_data)
+        return messages
+
+    def convert_to_ollama(self, include_metadata:bool=False) -> list:
+        # Only loaded messages, the ones older than get_unloaded_key are added by get_older_ollama_messages
         messages = []
         for message in self.messages.values():
             if message.text and message.dt:
@@ -348,11 +572,32 @@ class chat_list(Gtk.ListBox):
         )
         self.connect("row-selected", lambda listbox, row: self.chat_changed(row))
         self.tab_list = []
-
-    def update_profile_pictures(self):
-        for tab in self.tab_list:
-            for message in tab.chat_window.messages.values():
-                message.update_profile_picture()
+        self.live_chats = OrderedDict() # Hydrated chats, least recently viewed first
+        self.max_live_chats = 5
+
+    def hydrate_chat(self, chat_window:chat):
+        chat_window.hydrate()
+        self.live_chats.pop(chat_window, None)
+        self.live_chats[chat_window] = None
+        self.trim_live_chats()
+
+    def trim_live_chats(self):
+        current_chat = self.get_current_chat()
+        for chat_window in list(self.live_chats):
+            if len(self.live_chats) <= self.max_live_chats:
+                break
+            if chat_window != current_chat and not chat_window.busy:
+                logger.debug("Dehydrating chat {}".format(chat_window.get_name()))
+                chat_window.dehydrate()
+                del self.live_chats[chat_window]
+
+    def update_profile_pictures(self, model_name:str=None):
+        # Only messages of the given model are touched, every model with messages is checked otherwise
+        for name in ([model_name] if model_name else list(messages_by_model)):
+            model_row = window.model_manager.model_selector.get_model_by_name(name)
+            if model_row:
+                for message_element in list(messages_by_model.get(name, [])):
+                    message_element.set_profile_picture_data(model_row.profile_picture_data)
 
     def update_welcome_screens(self, show_prompts:bool):
         for tab in self.tab_list:
@@ -382,11 +627,11 @@ class chat_list(Gtk.ListBox):
         self.prepend(tab)
         self.select_row(tab)
 
-    def append_chat(self, chat_name:str, chat_id:str) -> chat:
+    def append_chat(self, chat_name:str, chat_id:str, last_activity=None) -> chat:
         chat_name = chat_name.strip()
         if chat_name:
             chat_name = window.generate_numbered_name(chat_name, [tab.chat_window.get_name() for tab in self.tab_list])
-            chat_window = chat(chat_name, chat_id)
+            chat_window = chat(chat_name, chat_id, last_activity=last_activity)
             tab = chat_tab(chat_window)
             self.append(tab)
             self.tab_list.append(tab)
@@ -410,11 +655,7 @@ class chat_list(Gtk.ListBox):
         chat_title = chat_title.strip()
         if chat_title:
             chat_window = self.prepend_chat(chat_title, window.generate_uuid())
-            sqlite_con = sqlite3.connect(window.sqlite_path)
-            cursor = sqlite_con.cursor()
-            cursor.execute("INSERT INTO chat (id, name) VALUES (?, ?);", (chat_window.chat_id, chat_window.get_name()))
-            sqlite_con.commit()
-            sqlite_con.close()
+            storage.add_chat(chat_window.chat_id, chat_window.get_name())
             return chat_window
 
     def delete_chat(self, chat_name:str):
@@ -425,6 +666,7 @@ class chat_list(Gtk.ListBox):
         if chat_tab:
             chat_tab.chat_window.stop_message()
             chat_id = chat_tab.chat_window.chat_id
+            self.live_chats.pop(chat_tab.chat_window, None)
             window.chat_stack.remove(chat_tab.chat_window)
             self.tab_list.remove(chat_tab)
             self.remove(chat_tab)
@@ -432,15 +674,7 @@ class chat_list(Gtk.ListBox):
                 self.new_chat()
             if not self.get_current_chat() or self.get_current_chat() == chat_tab.chat_window:
                 self.select_row(self.get_row_at_index(0))
-            sqlite_con = sqlite3.connect(window.sqlite_path)
-            cursor = sqlite_con.cursor()
-            cursor.execute("DELETE FROM chat WHERE id=?;", (chat_id,))
-            messages = cursor.execute("SELECT id FROM message WHERE chat_id=?", (chat_id,)).fetchall()
-            for message in messages:
-                cursor.execute("DELETE FROM attachment WHERE message_id=?", (message[0],))
-            cursor.execute("DELETE FROM message WHERE chat_id=?", (chat_id,))
-            sqlite_con.commit()
-            sqlite_con.close()
+            storage.delete_chat(chat_id, markdown_parser.get_hash)
 
     def rename_chat(self, old_chat_name:str, new_chat_name:str):
         new_chat_name = new_chat_name.strip()
@@ -452,33 +686,14 @@ class chat_list(Gtk.ListBox):
             tab.label.set_label(new_chat_name)
             tab.label.set_tooltip_text(new_chat_name)
             tab.chat_window.set_name(new_chat_name)
-            sqlite_con = sqlite3.connect(window.sqlite_path)
-            cursor = sqlite_con.cursor()
-            cursor.execute("UPDATE Chat SET name=? WHERE id=?", (new_chat_name, tab.chat_window.chat_id))
-            sqlite_con.commit()
-            sqlite_con.close()
+            storage.rename_chat(tab.chat_window.chat_id, new_chat_name)
 
     def duplicate_chat(self, chat_name:str):
         new_chat_name = window.generate_numbered_name(_("Copy of {}").format(chat_name), [tab.chat_window.get_name() for tab in self.tab_list])
         new_chat_id = window.generate_uuid()
 
-        sqlite_con = sqlite3.connect(window.sqlite_path)
-        cursor = sqlite_con.cursor()
-        cursor.execute("INSERT INTO chat (id, name) VALUES (?, ?);", (new_chat_id, new_chat_name))
-
-        messages = cursor.execute("SELECT id, role, model, date_time, content FROM message WHERE chat_id=?", (self.get_chat_by_name(chat_name).chat_id,)).fetchall()
-        for message in messages:
-            new_message_id = window.generate_uuid()
-            cursor.execute("INSERT INTO message (id, chat_id, role, model, date_time, content) VALUES (?, ?, ?, ?, ?, ?)",
-                (new_message_id, new_chat_id, message[1], message[2], message[3], message[4]))
-            attachments = cursor.execute("SELECT type, name, content FROM attachment WHERE message_id=?", (message[0],)).fetchall()
-            for attachment in attachments:
-                cursor.execute("INSERT INTO attachment (id, message_id, type, name, content) VALUES (?, ?, ?, ?, ?)",
-                    (window.generate_uuid(), new_message_id, attachment[0], attachment[1], attachment[2]))
-        sqlite_con.commit()
-        sqlite_con.close()
-        new_chat = self.prepend_chat(new_chat_name, new_chat_id)
-        threading.Thread(target=new_chat.load_chat_messages).start()
+        storage.duplicate_chat(self.get_chat_by_name(chat_name).chat_id, new_chat_id, new_chat_name, window.generate_uuid)
+        self.prepend_chat(new_chat_name, new_chat_id)
 
     def on_chat_imported(self, file_dialog, result):
         file = file_dialog.open_finish(result)
@@ -486,36 +701,21 @@ class chat_list(Gtk.ListBox):
             if os.path.isfile(os.path.join(cache_dir, 'import.db')):
                 os.remove(os.path.join(cache_dir, 'import.db'))
             file.copy(Gio.File.new_for_path(os.path.join(cache_dir, 'import.db')), Gio.FileCopyFlags.OVERWRITE, None, None, None, None)
-            sqlite_con = sqlite3.connect(window.sqlite_path)
-            cursor = sqlite_con.cursor()
-            cursor.execute("ATTACH DATABASE ? AS import", (os.path.join(cache_dir, 'import.db'),))
-            # Check repeated chat.name
-            for repeated_chat in cursor.execute("SELECT import.chat.id, import.chat.name FROM import.chat JOIN chat dbchat ON import.chat.name = dbchat.name").fetchall():
-                new_name = window.generate_numbered_name(repeated_chat[1], [tab.chat_window.get_name() for tab in self.tab_list])
-                cursor.execute("UPDATE import.chat SET name=? WHERE id=?", (new_name, repeated_chat[0]))
-            # Check repeated chat.id
-            for repeated_chat in cursor.execute("SELECT import.chat.id FROM import.chat JOIN chat dbchat ON import.chat.id = dbchat.id").fetchall():
-                new_id = window.generate_uuid()
-                cursor.execute("UPDATE import.chat SET id=? WHERE id=?", (new_id, repeated_chat[0]))
-                cursor.execute("UPDATE import.message SET chat_id=? WHERE chat_id=?", (new_id, repeated_chat[0]))
-            # Check repeated message.id
-            for repeated_message in cursor.execute("SELECT import.message.id FROM import.message JOIN message dbmessage ON import.message.id = dbmessage.id").fetchall():
-                new_id = window.generate_uuid()
-                cursor.execute("UPDATE import.attachment SET message_id=? WHERE message_id=?", (new_id, repeated_message[0]))
-                cursor.execute("UPDATE import.message SET id=? WHERE id=?", (new_id, repeated_message[0]))
-            # Check repeated attachment.id
-            for repeated_attachment in cursor.execute("SELECT import.attachment.id FROM import.attachment JOIN attachment dbattachment ON import.attachment.id = dbattachment.id").fetchall():
-                new_id = window.generate_uuid()
-                cursor.execute("UPDATE import.attachment SET id=? WHERE id=?", (new_id, repeated_attachment[0]))
-            # Import
-            cursor.execute("INSERT INTO chat SELECT * FROM import.chat")
-            cursor.execute("INSERT INTO message SELECT * FROM import.message")
-            cursor.execute("INSERT INTO attachment SELECT * FROM import.attachment")
-            sqlite_con.commit()
-            for chat in cursor.execute("SELECT * FROM import.chat"):
-                new_chat = self.prepend_chat(chat[1], chat[0])
-                threading.Thread(target=new_chat.load_chat_messages).start()
-            sqlite_con.close()
+            # The import writes every chat at once, it's done off the main thread
+            chat_names = [tab.chat_window.get_name() for tab in self.tab_list]
+            threading.Thread(target=self.read_imported_chats, args=(chat_names,)).start()
+
+    def read_imported_chats(self, chat_names:list):
+        imported_chats = storage.import_chats(
+            os.path.join(cache_dir, 'import.db'),
+            lambda chat_name: window.generate_numbered_name(chat_name, chat_names),
+            window.generate_uuid
+        )
+        GLib.idle_add(self.add_imported_chats, imported_chats)
+
+    def add_imported_chats(self, imported_chats:list):
+        for chat in imported_chats:
+            self.prepend_chat(chat[1], chat[0])
         window.show_toast(_("Chat imported successfully"), window.main_overlay)
 
     def import_chat(self):
@@ -525,6 +725,7 @@ class chat_list(Gtk.ListBox):
 
     def chat_changed(self, row):
         if row:
+            self.hydrate_chat(row.chat_window)
             current_tab_i = next((i for i, t in enumerate(self.tab_list) if t.chat_window == window.chat_stack.get_visible_child()), -1)
             if self.tab_list.index(row) != current_tab_i:
                 if window.searchentry_messages.get_text() != '':
@@ -539,5 +740,6 @@ class chat_list(Gtk.ListBox):
                     window.model_manager.change_model(last_model_used)
                 else:
                     window.model_manager.change_model(window.convert_model_name(window.default_model_list.get_string(window.default_model_combo.get_selected()), 1))
+                window.preload_selected_model()
                 if row.indicator.get_visible():
                     row.indicator.set_visible(False)
@@ -7,13 +7,11 @@ import gi
 gi.require_version('Gtk', '4.0')
 gi.require_version('GtkSource', '5')
 from gi.repository import Gtk, GObject, Gio, Adw, GtkSource, GLib, Gdk, GdkPixbuf
-import logging, os, datetime, re, shutil, threading, sys, base64, sqlite3, tempfile
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.mathtext as mathtext
-from PIL import Image
+import logging, os, datetime, shutil, threading, base64, collections, time, weakref
 from ..internal import config_dir, data_dir, cache_dir, source_dir
+from .. import markdown_parser, storage
+from ..latex_renderer import shared_renderer
+from ..texture_cache import shared_cache
 from .table_widget import TableWidget
 from . import dialog_widget, terminal_widget
 
@@ -21,6 +19,15 @@ logger = logging.getLogger(__name__)
 
 window = None
 
+# Bot messages of every chat that is loaded, by the model that generated them
+messages_by_model = collections.defaultdict(weakref.WeakSet)
+
+# Used to size the placeholders of code blocks that don't have a source view yet
+CODE_LINE_HEIGHT = 20
+PLACEHOLDER_LINES = 50
+# Seconds between saves of a response that is still being generated
+CHECKPOINT_INTERVAL = 3
+
 class edit_text_block(Gtk.Box):
     __gtype_name__ = 'AlpacaEditTextBlock'
 
@@ -81,11 +88,7 @@ class edit_text_block(Gtk.Box):
         message_element = self.get_parent().get_parent()
         message_element.set_text(self.text_view.get_buffer().get_text(self.text_view.get_buffer().get_start_iter(), self.text_view.get_buffer().get_end_iter(), False))
 
-        sqlite_con = sqlite3.connect(window.sqlite_path)
-        cursor = sqlite_con.cursor()
-        cursor.execute("UPDATE message SET content=? WHERE id=?", (message_element.text, message_element.message_id))
-        sqlite_con.commit()
-        sqlite_con.close()
+        storage.update_message(message_element.message_id, content=message_element.text, get_hash=markdown_parser.get_hash)
 
         self.get_parent().remove(self)
         message_element.set_hexpand(message_element.bot)
@@ -127,15 +130,42 @@ class text_block(Gtk.Label):
         self.set_selectable(False)
         self.set_selectable(True)
 
+class stream_text_block(Gtk.TextView):
+    __gtype_name__ = 'AlpacaStreamTextBlock'
+
+    def __init__(self, system:bool):
+        super().__init__(
+            hexpand=True,
+            halign=0,
+            wrap_mode=2,
+            editable=False,
+            cursor_visible=False,
+            top_margin=7,
+            bottom_margin=7,
+            left_margin=7,
+            right_margin=7,
+            css_classes=['stream_text_block', 'dim-label'] if system else ['stream_text_block'],
+            justification=2 if system else 0
+        )
+        # Holds the open paragraph of a response while it streams, new text goes to the end of the buffer without setting the rest again
+        self.raw_text = ''
+        self.update_property([4, 7], [_("Response message"), False])
+
     def insert_at_end(self, text:str):
         self.raw_text += text
-        self.set_text(self.raw_text)
-        self.update_property([1], [self.get_text()])
+        self.get_buffer().insert(self.get_buffer().get_end_iter(), text, len(text.encode('utf-8')))
+
+    def set_text(self, text:str):
+        self.raw_text = text
+        self.get_buffer().set_text(text, len(text.encode('utf-8')))
+
+    def update_accessible_text(self):
+        self.update_property([1], [self.raw_text])
 
 class code_block(Gtk.Box):
     __gtype_name__ = 'AlpacaCodeBlock'
 
-    def __init__(self, text:str, language_name:str=None):
+    def __init__(self, text:str, language_name:str=None, deferred:bool=False):
         super().__init__(
             css_classes=["card", "code_block"],
             orientation=1,
@@ -144,19 +174,13 @@ class code_block(Gtk.Box):
             margin_end=5
         )
 
+        self.text = text
+        self.buffer = None
+        self.source_view = None
+        self.placeholder = None
         self.language = None
         if language_name:
             self.language = GtkSource.LanguageManager.get_default().get_language(language_name)
-        if self.language:
-            self.buffer = GtkSource.Buffer.new_with_language(self.language)
-        else:
-            self.buffer = GtkSource.Buffer()
-        self.buffer.set_style_scheme(GtkSource.StyleSchemeManager.get_default().get_scheme('Adwaita-dark'))
-        self.source_view = GtkSource.View(
-            auto_indent=True, indent_width=4, buffer=self.buffer, show_line_numbers=True, editable=None,
-            top_margin=6, bottom_margin=6, left_margin=12, right_margin=12, css_classes=["code_block"]
-        )
-        self.source_view.update_property([4], [_("{}Code Block").format('{} '.format(self.language.get_name()) if self.language else "")])
 
         title_box = Gtk.Box(margin_start=12, margin_top=3, margin_bottom=3, margin_end=3)
         title_box.append(Gtk.Label(label=self.language.get_name() if self.language else (language_name.title() if language_name else _("Code Block")), hexpand=True, xalign=0))
@@ -169,26 +193,93 @@ class code_block(Gtk.Box):
             title_box.append(run_button)
         self.append(title_box)
         self.append(Gtk.Separator())
+        if deferred:
+            self.show_placeholder()
+        else:
+            self.materialize()
+
+    def show_placeholder(self):
+        # Plain label with roughly the height of the source view, it gets replaced once it's close to the viewport
+        lines = self.text.split('\n')
+        self.placeholder = Gtk.Label(
+            label='\n'.join(lines[:PLACEHOLDER_LINES]),
+            xalign=0,
+            yalign=0,
+            ellipsize=3,
+            margin_top=6,
+            margin_bottom=6,
+            margin_start=12,
+            margin_end=12,
+            height_request=len(lines) * CODE_LINE_HEIGHT,
+            css_classes=["code_block"]
+        )
+        self.placeholder.connect('map', lambda *_: self.queue_visibility_update())
+        self.append(self.placeholder)
+
+    def queue_visibility_update(self):
+        scrolled_window = self.get_ancestor(Gtk.ScrolledWindow)
+        if hasattr(scrolled_window, 'queue_visibility_update'):
+            scrolled_window.queue_visibility_update()
+
+    def materialize(self):
+        if self.source_view:
+            return
+        if self.language:
+            self.buffer = GtkSource.Buffer.new_with_language(self.language)
+        else:
+            self.buffer = GtkSource.Buffer()
+        self.buffer.set_style_scheme(GtkSource.StyleSchemeManager.get_default().get_scheme('Adwaita-dark'))
+        self.source_view = GtkSource.View(
+            auto_indent=True, indent_width=4, buffer=self.buffer, show_line_numbers=True, editable=None,
+            top_margin=6, bottom_margin=6, left_margin=12, right_margin=12, css_classes=["code_block"]
+        )
+        self.source_view.update_property([4], [_("{}Code Block").format('{} '.format(self.language.get_name()) if self.language else "")])
+        if self.placeholder:
+            self.remove(self.placeholder)
+            self.placeholder = None
         self.append(self.source_view)
-        self.buffer.set_text(text)
+        self.buffer.set_text(self.text)
+
+    def release(self):
+        if not self.source_view:
+            return
+        self.text = self.get_text()
+        self.remove(self.source_view)
+        self.source_view = None
+        self.buffer = None
+        self.show_placeholder()
+
+    def get_text(self) -> str:
+        if self.buffer:
+            return self.buffer.get_text(self.buffer.get_start_iter(), self.buffer.get_end_iter(), False)
+        return self.text
+
+    def set_text(self, text:str):
+        self.text = text
+        if self.buffer:
+            self.buffer.set_text(text)
+        elif self.placeholder:
+            self.remove(self.placeholder)
+            self.show_placeholder()
+
+    def insert_at_end(self, text:str):
+        if self.buffer:
+            self.buffer.insert(self.buffer.get_end_iter(), text, len(text.encode('utf-8')))
+        else:
+            self.set_text(self.text + text)
 
     def on_copy(self):
         logger.debug("Copying code")
         clipboard = Gdk.Display().get_default().get_clipboard()
-        start = self.buffer.get_start_iter()
-        end = self.buffer.get_end_iter()
-        text = self.buffer.get_text(start, end, False)
-        clipboard.set(text)
+        clipboard.set(self.get_text())
         window.show_toast(_("Code copied to the clipboard"), window.main_overlay)
 
     def run_script(self, language_name):
         logger.debug("Running script")
-        start = self.buffer.get_start_iter()
-        end = self.buffer.get_end_iter()
         dialog_widget.simple(
             _('Run Script'),
             _('Make sure you understand what this script does before running it, Alpaca is not responsible for any damages to your device or data'),
-            lambda script=self.buffer.get_text(start, end, False), language_name=language_name: terminal_widget.run_terminal(script, language_name),
+            lambda script=self.get_text(), language_name=language_name: terminal_widget.run_terminal(script, language_name),
             _('Execute'),
             'destructive'
         )
@@ -250,46 +341,40 @@ class image(Gtk.Button):
 
     def __init__(self, image_name:str, content:str):
         self.content = content
-        try:
-            image_data = base64.b64decode(self.content)
-            loader = GdkPixbuf.PixbufLoader.new()
-            loader.write(image_data)
-            loader.close()
-            pixbuf = loader.get_pixbuf()
-            texture = Gdk.Texture.new_for_pixbuf(pixbuf)
-            image = Gtk.Image.new_from_paintable(texture)
-            image.set_size_request(240, 240)
-            super().__init__(
-                child=image,
-                css_classes=["flat", "chat_image_button"],
-                name=image_name,
-                tooltip_text=_("Image")
-            )
-            image.update_property([4], [_("Image")])
-            self.connect("clicked", lambda button, content=self.content: window.preview_file(self.get_name(), content, 'image', False))
-        except Exception as e:
-            logger.error(e)
-            image_texture = Gtk.Image.new_from_icon_name("image-missing-symbolic")
-            image_texture.set_icon_size(2)
-            image_texture.set_vexpand(True)
-            image_texture.set_pixel_size(120)
-            image_label = Gtk.Label(
-                label=_("Missing Image"),
-            )
-            image_box = Gtk.Box(
-                spacing=10,
-                orientation=1,
-            )
-            image_box.append(image_texture)
-            image_box.append(image_label)
-            image_box.set_size_request(240, 240)
-            super().__init__(
-                child=image_box,
-                css_classes=["flat", "chat_image_button"],
-                tooltip_text=_("Missing Image")
-            )
-            image_texture.update_property([4], [_("Missing image")])
+        self.image = Gtk.Image()
+        self.image.set_size_request(240, 240)
+        super().__init__(
+            child=self.image,
+            css_classes=["flat", "chat_image_button"],
+            name=image_name,
+            tooltip_text=_("Image")
+        )
+        self.image.update_property([4], [_("Image")])
+        self.connect("clicked", lambda button, content=self.content: window.preview_file(self.get_name(), content, 'image', False) if self.image.get_paintable() else None)
         self.set_overflow(1)
+        shared_cache.load_texture(self.content, 240, self.on_texture_loaded)
+
+    def on_texture_loaded(self, texture):
+        if texture:
+            self.image.set_from_paintable(texture)
+            return
+        image_texture = Gtk.Image.new_from_icon_name("image-missing-symbolic")
+        image_texture.set_icon_size(2)
+        image_texture.set_vexpand(True)
+        image_texture.set_pixel_size(120)
+        image_label = Gtk.Label(
+            label=_("Missing Image"),
+        )
+        image_box = Gtk.Box(
+            spacing=10,
+            orientation=1,
+        )
+        image_box.append(image_texture)
+        image_box.append(image_label)
+        image_box.set_size_request(240, 240)
+        self.set_child(image_box)
+        self.set_tooltip_text(_("Missing Image"))
+        image_texture.update_property([4], [_("Missing image")])
 
 class image_container(Gtk.ScrolledWindow):
     __gtype_name__ = 'AlpacaImageContainer'
@@ -329,7 +414,7 @@ class latex_image(Gtk.MenuButton):
             tooltip_text=_('Regenerate Equation'),
             css_classes=['flat']
         )
-        regenerate_button.connect('clicked', lambda button: self.generate_image(True))
+        regenerate_button.connect('clicked', lambda button: self.generate_image(False))
         popover_container = Gtk.Box(spacing=10)
         popover_container.append(copy_button)
         popover_container.append(regenerate_button)
@@ -340,7 +425,7 @@ class latex_image(Gtk.MenuButton):
             height_request=75,
             css_classes=['flat']
         )
-        threading.Thread(target=self.generate_image, args=(True,)).start()
+        self.generate_image(True)
 
     def copy_equation(self):
         self.popover.popdown()
@@ -348,54 +433,36 @@ class latex_image(Gtk.MenuButton):
         clipboard.set(self.equation)
         window.show_toast(_("Equation copied to the clipboard"), window.main_overlay)
 
-    def generate_image(self, use_TeX:bool):
+    def generate_image(self, use_cache:bool):
         self.popover.popdown()
         self.set_tooltip_text(_('LaTeX Equation'))
-        if use_TeX:
-            eq = self.equation
-        else:
-            eq = '${}$'.format(self.equation.replace('\\[', '').replace('\\]', '').replace('$', '').replace('\n', ''))
+        future = shared_renderer.render(self.equation, use_cache=use_cache)
+        future.add_done_callback(lambda future: GLib.idle_add(self.on_image_generated, future))
+
+    def on_image_generated(self, future):
         try:
+            texture = Gdk.Texture.new_from_bytes(GLib.Bytes.new(future.result()))
             picture = Gtk.Picture(
                 css_classes=['latex_equation'],
                 content_fit=1,
-                vexpand=True
+                vexpand=True,
+                paintable=texture
             )
-            with tempfile.TemporaryDirectory() as temp_path:
-                png_path = os.path.join(temp_path, 'equation.png')
-                fig, ax = plt.subplots()
-                ax.text(0.5, 0.5, eq, fontsize=24, ha='center', va='center', usetex=use_TeX)
-                ax.axis('off')
-                fig.patch.set_alpha(0.0)
-                plt.savefig(png_path, format='png', bbox_inches="tight", pad_inches=0, transparent=True)
-                plt.close(fig)
-
-                img = Image.open(png_path).convert("RGBA")
-                bbox = img.getbbox()
-                if bbox:
-                    cropped_image = img.crop(bbox)
-                    width, height = cropped_image.size
-                    cropped_image.save(png_path)
-
-                picture.set_filename(png_path)
-                picture.set_alternative_text(self.equation)
-                self.set_child(picture)
+            picture.set_alternative_text(self.equation)
+            self.set_child(picture)
         except Exception as e:
-            if use_TeX:
-                self.generate_image(False)
-            else:
-                logger.error(e)
-                label = Gtk.Label(
-                    label=eq,
-                    wrap_mode=2,
-                    wrap=True,
-                    ellipsize=3,
-                    css_classes=['error']
-                )
-                error = str(e)
-                if 'ParseSyntaxException' in error:
-                    self.set_tooltip_text(error.split('ParseSyntaxException: ')[-1])
-                self.set_child(label)
+            logger.error(e)
+            label = Gtk.Label(
+                label=self.equation,
+                wrap_mode=2,
+                wrap=True,
+                ellipsize=3,
+                css_classes=['error']
+            )
+            error = str(e)
+            if 'ParseSyntaxException' in error:
+                self.set_tooltip_text(error.split('ParseSyntaxException: ')[-1])
+            self.set_child(label)
 
 
 class option_popup(Gtk.Popover):
@@ -452,6 +519,15 @@ class option_popup(Gtk.Popover):
             )
             self.regenerate_button.connect('clicked', lambda *_: self.regenerate_message())
             container.append(self.regenerate_button)
+            self.statistics_button = Gtk.Button(
+                halign=1,
+                hexpand=True,
+                icon_name="info-outline-symbolic",
+                css_classes=["flat"],
+                tooltip_text=_("Show Statistics")
+            )
+            self.statistics_button.connect('clicked', lambda *_: self.show_statistics())
+            container.append(self.statistics_button)
 
     def delete_message(self):
         logger.debug("Deleting message")
@@ -459,12 +535,7 @@ class option_popup(Gtk.Popover):
         message_id = self.message_element.message_id
         self.message_element.get_parent().remove(self.message_element)
         del chat.messages[message_id]
-        sqlite_con = sqlite3.connect(window.sqlite_path)
-        cursor = sqlite_con.cursor()
-        cursor.execute("DELETE FROM message WHERE id=?;", (message_id,))
-        cursor.execute("DELETE FROM attachment WHERE message_id=?;", (message_id,))
-        sqlite_con.commit()
-        sqlite_con.close()
+        storage.delete_message(message_id, markdown_parser.get_hash)
         if len(chat.messages) == 0:
             chat.show_welcome_screen(len(window.model_manager.get_model_list()) > 0)
 
@@ -487,6 +558,34 @@ class option_popup(Gtk.Popover):
         GLib.idle_add(edit_text_b.text_view.get_buffer().insert, edit_text_b.text_view.get_buffer().get_start_iter(), self.message_element.text, len(self.message_element.text.encode('utf-8')))
         window.set_focus(edit_text_b)
 
+    def show_statistics(self):
+        self.popdown()
+        # Read in a thread so the metrics still waiting in the write queue are included
+        threading.Thread(target=lambda: GLib.idle_add(self.show_metrics, storage.get_message_metrics(self.message_element.message_id))).start()
+
+    def show_metrics(self, metrics:tuple):
+        if not metrics:
+            window.show_toast(_("There are no statistics for this message"), window.main_overlay)
+            return
+        model, endpoint, time_to_first_token, total_duration, load_duration, prompt_eval_count, prompt_eval_duration, eval_count, eval_duration = metrics
+        seconds = lambda nanoseconds: '{:.2f} s'.format(nanoseconds / 1e9) if nanoseconds is not None else '-'
+        speed = lambda count, nanoseconds: '{:.2f}'.format(count / (nanoseconds / 1e9)) if count and nanoseconds else '-'
+        lines = [
+            '{}: {}'.format(_('Model'), window.convert_model_name(model, 0) if model else '-'),
+            '{}: {}'.format(_('Instance'), endpoint or '-'),
+            '{}: {}'.format(_('Time to first token'), '{:.2f} s'.format(time_to_first_token) if time_to_first_token is not None else '-'),
+            '{}: {}'.format(_('Total duration'), seconds(total_duration)),
+            '{}: {}'.format(_('Load duration'), seconds(load_duration)),
+            '{}: {} ({} {})'.format(_('Prompt tokens'), prompt_eval_count or 0, speed(prompt_eval_count, prompt_eval_duration), _('tokens/s')),
+            '{}: {} ({} {})'.format(_('Response tokens'), eval_count or 0, speed(eval_count, eval_duration), _('tokens/s'))
+        ]
+        dialog_widget.Options(
+            _('Message Statistics'),
+            '\n'.join(lines),
+            'close',
+            {_('Close'): {}}
+        )
+
     def regenerate_message(self):
         chat = self.message_element.get_parent().get_parent().get_parent().get_parent()
         if self.message_element.spinner:
@@ -496,7 +595,7 @@ class option_popup(Gtk.Popover):
             self.message_element.set_text()
             if self.message_element.footer:
                 self.message_element.container.remove(self.message_element.footer)
-            self.message_element.model = window.model_manager.get_selected_model()
+            self.message_element.set_model(window.model_manager.get_selected_model())
             data = {
                 "model": self.message_element.model,
                 "messages": chat.convert_to_ollama(),
@@ -505,7 +604,7 @@ class option_popup(Gtk.Popover):
             }
             if window.ollama_instance.tweaks["seed"] != 0:
                 data['options']['seed'] = window.ollama_instance.tweaks["seed"]
-            thread = threading.Thread(target=window.run_message, args=(data, self.message_element, chat))
+            thread = threading.Thread(target=window.run_message, args=(data, self.message_element, chat, True, chat.get_unloaded_key()))
             thread.start()
         else:
             window.show_toast(_("Message cannot be regenerated while receiving a response"), window.main_overlay)
@@ -562,14 +661,9 @@ class footer(Gtk.Box):
         message_element.profile_picture = None
 
         if message_element.profile_picture_data:
-            image_data = base64.b64decode(message_element.profile_picture_data)
-            loader = GdkPixbuf.PixbufLoader.new()
-            loader.write(image_data)
-            loader.close()
-            pixbuf = loader.get_pixbuf()
-            texture = Gdk.Texture.new_for_pixbuf(pixbuf)
-            message_element.profile_picture = Gtk.Image.new_from_paintable(texture)
+            message_element.profile_picture = Gtk.Image()
             message_element.profile_picture.set_size_request(40, 40)
+            shared_cache.load_texture(message_element.profile_picture_data, 40, lambda texture, profile_picture=message_element.profile_picture: profile_picture.set_from_paintable(texture))
             self.options_button = Gtk.MenuButton(
                 width_request=40,
                 height_request=40,
@@ -607,10 +701,30 @@ class message(Gtk.Box):
         self.image_c = None
         self.attachment_c = None
         self.spinner = None
+        self.streaming = False
+        self.stream_buffer = collections.deque() # Filled by the network thread, drained once per frame
+        self.stream_text = ''
+        self.stream_parser = None
+        self.stream_blocks = []
+        self.stream_widget = None # Widget of the block that is still open
+        self.stream_widget_text = ''
+        self.stream_tick_id = None
+        self.stream_map_id = None
+        self.stream_scheduled = False
+        self.accessibility_time = 0
+        self.blocks = None
+        self.loaded = True # Offscreen messages drop their content widgets and keep only their height
+        self.request_time = None
+        self.first_token_time = None
+        self.checkpoint_id = None
+        self.checkpoint_length = 0
+        self.metrics = None
         self.text = None
         self.profile_picture_data = None
         self.profile_picture = None
+        self.profile_picture_dirty = False
         if self.bot and self.model:
+            messages_by_model[self.model].add(self)
             model_row = window.model_manager.model_selector.get_model_by_name(self.model)
             if model_row:
                 self.profile_picture_data = model_row.profile_picture_data
@@ -630,15 +744,29 @@ class message(Gtk.Box):
         )
 
         self.append(self.container)
+        self.connect('map', lambda *_: self.refresh_profile_picture())
 
-    def update_profile_picture(self):
+    def set_model(self, model:str):
+        if self.model in messages_by_model:
+            messages_by_model[self.model].discard(self)
+        self.model = model
         if self.bot and self.model:
+            messages_by_model[self.model].add(self)
             model_row = window.model_manager.model_selector.get_model_by_name(self.model)
-            if model_row:
-                new_profile_picture_data = model_row.profile_picture_data
-                if new_profile_picture_data != self.profile_picture_data:
-                    self.profile_picture_data = new_profile_picture_data
-                    self.add_footer(self.dt)
+            self.set_profile_picture_data(model_row.profile_picture_data if model_row else None)
+
+    def set_profile_picture_data(self, profile_picture_data:str):
+        # Footers of offscreen messages are rebuilt once they are shown again
+        if profile_picture_data != self.profile_picture_data:
+            self.profile_picture_data = profile_picture_data
+            self.profile_picture_dirty = True
+            if self.get_mapped():
+                self.refresh_profile_picture()
+
+    def refresh_profile_picture(self):
+        if self.profile_picture_dirty and self.footer:
+            self.add_footer(self.dt)
+        self.profile_picture_dirty = False
 
     def add_attachment(self, name:str, attachment_type:str, content:str):
         if attachment_type == 'image':
@@ -665,137 +793,318 @@ class message(Gtk.Box):
     def update_message(self, data:dict):
         chat = self.get_parent().get_parent().get_parent().get_parent()
         if chat.busy:
-            vadjustment = chat.get_vadjustment()
-            if self.spinner:
-                self.container.remove(self.spinner)
-                self.spinner = None
-                self.content_children[-1].set_visible(True)
-                GLib.idle_add(vadjustment.set_value, vadjustment.get_upper())
-            elif vadjustment.get_value() + 50 >= vadjustment.get_upper() - vadjustment.get_page_size():
-                GLib.idle_add(vadjustment.set_value, vadjustment.get_upper() - vadjustment.get_page_size())
-            GLib.idle_add(self.content_children[-1].insert_at_end, data['message']['content'])
-        if not chat.busy or ('done' in data and data['done']):
-            if not chat.quick_chat:
-                window.chat_list_box.get_tab_by_name(chat.get_name()).spinner.set_visible(False)
-                if window.chat_list_box.get_current_chat().get_name() != chat.get_name():
-                    window.chat_list_box.get_tab_by_name(chat.get_name()).indicator.set_visible(True)
-                if chat.welcome_screen:
-                    chat.container.remove(chat.welcome_screen)
-                    chat.welcome_screen = None
-            chat.stop_message()
-            self.text = self.content_children[-1].get_label()
-            GLib.idle_add(self.set_text, self.content_children[-1].get_label())
-            self.dt = datetime.datetime.now()
-            GLib.idle_add(self.add_footer, self.dt)
-            window.show_notification(chat.get_name(), self.text[:200] + (self.text[200:] and '...'), Gio.ThemedIcon.new("chat-message-new-symbolic"))
-            if chat.quick_chat:
-                GLib.idle_add(window.quick_ask_save_button.set_sensitive, True)
+            if self.first_token_time is None:
+                self.first_token_time = time.monotonic()
+            if data.get('done'):
+                self.metrics = {key: data.get(key) for key in ('total_duration', 'load_duration', 'prompt_eval_count', 'prompt_eval_duration', 'eval_count', 'eval_duration')}
+            self.stream_buffer.append(data['message']['content'])
+            if not self.stream_scheduled:
+                self.stream_scheduled = True
+                GLib.idle_add(self.start_stream)
+            if 'done' in data and data['done']:
+                GLib.idle_add(self.end_stream)
+
+    def start_stream(self):
+        if self.stream_map_id:
+            self.disconnect(self.stream_map_id)
+            self.stream_map_id = None
+        if not self.stream_scheduled or self.stream_tick_id:
+            return
+        if self.get_mapped():
+            self.stream_tick_id = self.add_tick_callback(self.flush_stream)
+        else:
+            self.buffer_in_background()
+
+    def buffer_in_background(self):
+        # The chat is not visible, tokens stay in the buffer until it gets mapped or the stream ends
+        self.stream_map_id = self.connect('map', lambda *_: self.start_stream())
+        chat = self.get_parent().get_parent().get_parent().get_parent()
+        if not chat.quick_chat:
+            tab = window.chat_list_box.get_tab_by_name(chat.get_name())
+            if tab:
+                tab.indicator.set_visible(True)
+
+    def flush_stream(self, widget, frame_clock) -> bool:
+        if not self.get_mapped():
+            self.stream_tick_id = None
+            self.buffer_in_background()
+            return GLib.SOURCE_REMOVE
+        text = self.drain_stream_buffer()
+        if text:
+            self.append_stream_text(text)
+            return GLib.SOURCE_CONTINUE
+        # Idle streams don't keep the frame clock busy, update_message adds the callback again with the next token
+        self.stream_scheduled = False
+        if len(self.stream_buffer) > 0:
+            # A token arrived while the flag was still set, it would not be scheduled again
+            self.stream_scheduled = True
+            return GLib.SOURCE_CONTINUE
+        self.stream_tick_id = None
+        return GLib.SOURCE_REMOVE
+
+    def drain_stream_buffer(self) -> str:
+        parts = []
+        while True:
+            try:
+                parts.append(self.stream_buffer.popleft())
+            except IndexError:
+                return ''.join(parts)
+
+    def append_stream_text(self, text:str):
+        chat = self.get_parent().get_parent().get_parent().get_parent()
+        vadjustment = chat.get_vadjustment()
+        follow = self.spinner or vadjustment.get_value() + 50 >= vadjustment.get_upper() - vadjustment.get_page_size()
+        if self.spinner:
+            self.container.remove(self.spinner)
+            self.spinner = None
+            self.content_children[-1].set_visible(True)
+        self.stream_text += text
+        self.add_stream_blocks(self.stream_parser.feed(text))
+        self.update_open_block()
+        if isinstance(self.stream_widget, stream_text_block) and time.monotonic() - self.accessibility_time > 0.5:
+            self.accessibility_time = time.monotonic()
+            self.stream_widget.update_accessible_text()
+        if follow:
+            # Waits for the new text to be measured before scrolling
+            GLib.idle_add(lambda: vadjustment.set_value(vadjustment.get_upper() - vadjustment.get_page_size()), priority=GLib.PRIORITY_LOW)
+
+    def remove_stream_widget(self):
+        if self.stream_widget:
+            self.container.remove(self.stream_widget)
+            self.content_children.remove(self.stream_widget)
+        self.stream_widget = None
+        self.stream_widget_text = ''
+
+    def add_stream_blocks(self, blocks:list):
+        # Blocks closed by the parser get their final widget, the open code block is kept since it already has the text
+        if not blocks:
+            return
+        self.stream_blocks.extend(blocks)
+        if isinstance(self.stream_widget, code_block) and blocks[0]['type'] == 'code' and not self.stream_parser.reparsed:
+            if self.stream_widget_text != blocks[0]['text']:
+                self.stream_widget.set_text(blocks[0]['text'])
+            self.stream_widget = None
+            self.stream_widget_text = ''
+            blocks = blocks[1:]
+        else:
+            self.remove_stream_widget()
+        for block in blocks:
+            self.add_block(block)
+
+    def update_open_block(self):
+        block = self.stream_parser.get_open_block()
+        if not block['text']:
+            return
+        if block['type'] == 'code':
+            if not isinstance(self.stream_widget, code_block):
+                self.remove_stream_widget()
+                self.stream_widget = code_block('', block['language'])
+                self.content_children.append(self.stream_widget)
+                self.container.append(self.stream_widget)
+        elif not isinstance(self.stream_widget, stream_text_block):
+            self.remove_stream_widget()
+            self.stream_widget = stream_text_block(self.system)
+            self.content_children.append(self.stream_widget)
+            self.container.append(self.stream_widget)
+        # Text of an open block only grows, only the new part is appended
+        if block['text'].startswith(self.stream_widget_text):
+            self.stream_widget.insert_at_end(block['text'][len(self.stream_widget_text):])
+        else:
+            self.stream_widget.set_text(block['text'])
+        self.stream_widget_text = block['text']
+
+    def start_request(self):
+        self.request_time = time.monotonic()
+        self.first_token_time = None
+        self.metrics = None
+        if self.checkpoint_id:
+            GLib.source_remove(self.checkpoint_id)
+        # Partial responses are saved while they are generated so a crash doesn't lose them
+        self.checkpoint_length = 0
+        self.checkpoint_id = GLib.timeout_add_seconds(CHECKPOINT_INTERVAL, self.save_checkpoint)
+
+    def save_checkpoint(self) -> bool:
+        chat = self.get_parent().get_parent().get_parent().get_parent() if self.get_parent() else None
+        if not self.streaming or not chat or chat.quick_chat:
+            self.checkpoint_id = None
+            return GLib.SOURCE_REMOVE
+        # Only the main thread takes text out of the buffer so nothing is missed here
+        text = self.get_streamed_text()
+        if len(text) != self.checkpoint_length:
+            self.checkpoint_length = len(text)
+            storage.update_message(self.message_id, content=text)
+        return GLib.SOURCE_CONTINUE
+
+    def save_metrics(self, endpoint:str):
+        if not self.metrics:
+            return
+        time_to_first_token = None
+        if self.request_time is not None and self.first_token_time is not None:
+            time_to_first_token = self.first_token_time - self.request_time
+        storage.set_message_metrics(self.message_id, self.model, endpoint, datetime.datetime.now(), time_to_first_token, self.metrics)
+
+    def get_streamed_text(self) -> str:
+        return self.stream_text + ''.join(list(self.stream_buffer))
+
+    def stop_stream(self):
+        if self.stream_tick_id:
+            self.remove_tick_callback(self.stream_tick_id)
+            self.stream_tick_id = None
+        if self.stream_map_id:
+            self.disconnect(self.stream_map_id)
+            self.stream_map_id = None
+        self.stream_scheduled = False
+        text = self.drain_stream_buffer()
+        if text:
+            if self.get_mapped():
+                self.append_stream_text(text)
+            else:
+                # Skips the widgets, finish_streaming renders everything at once
+                self.stream_text += text
+                self.stream_parser = None
+
+    def end_stream(self):
+        self.stop_stream()
+        self.finish_streaming()
+
+    def update_message_batch(self, chunks:list):
+        # Merges every chunk from the same read so the widgets only update once
+        if len(chunks) == 1:
+            return self.update_message(chunks[0])
+        data = chunks[-1].copy()
+        data['message'] = {**chunks[-1].get('message', {}), 'content': ''.join(chunk['message']['content'] for chunk in chunks if 'message' in chunk)}
+        self.update_message(data)
+
+    def finish_streaming(self):
+        if not self.streaming:
+            return
+        self.streaming = False
+        chat = self.get_parent().get_parent().get_parent().get_parent()
+        if not chat.quick_chat:
+            window.chat_list_box.get_tab_by_name(chat.get_name()).spinner.set_visible(False)
+            if window.chat_list_box.get_current_chat().get_name() != chat.get_name():
+                window.chat_list_box.get_tab_by_name(chat.get_name()).indicator.set_visible(True)
+            if chat.welcome_screen:
+                chat.container.remove(chat.welcome_screen)
+                chat.welcome_screen = None
+        chat.request_handle = None
+        chat.stop_message()
+        if self.spinner:
+            GLib.idle_add(self.container.remove, self.spinner)
+            self.spinner = None
+        self.text = self.stream_text
+        blocks = None
+        if self.stream_parser:
+            self.add_stream_blocks(self.stream_parser.finish())
+            self.stream_parser = None
+            self.remove_stream_widget()
+            blocks = self.stream_blocks
+            self.blocks = blocks
+        elif self.text:
+            GLib.idle_add(self.set_text, self.text)
+        self.dt = datetime.datetime.now()
+        GLib.idle_add(self.add_footer, self.dt)
+        window.show_notification(chat.get_name(), self.text[:200] + (self.text[200:] and '...'), Gio.ThemedIcon.new("chat-message-new-symbolic"))
+        if chat.quick_chat:
+            GLib.idle_add(window.quick_ask_save_button.set_sensitive, True)
+        else:
+            ast = None
+            if self.text and blocks is not None:
+                ast = (markdown_parser.get_hash(self.text), markdown_parser.PARSER_VERSION, markdown_parser.dump_blocks(blocks))
+            storage.update_message(self.message_id, self.dt, self.text or None, ast)
+
+    def add_block(self, part:dict):
+        if part['type'] == 'normal':
+            text_b = text_block(self.bot, self.system)
+            text_b.raw_text = markdown_parser.render_markup(part['inline'])
+            self.content_children.append(text_b)
+            self.container.append(text_b)
+            GLib.idle_add(text_b.set_markup, text_b.raw_text)
+        elif part['type'] == 'code':
+            code_b = code_block(part['text'], part['language'], True)
+            self.content_children.append(code_b)
+            self.container.append(code_b)
+        elif part['type'] == 'table':
+            table_w = TableWidget(part['text'])
+            self.content_children.append(table_w)
+            self.container.append(table_w)
+        elif part['type'] == 'latex':
+            latex_w = latex_image(part['text'])
+            self.content_children.append(latex_w)
+            self.container.append(latex_w)
+
+    def estimate_height(self) -> int:
+        lines = 0
+        for block in self.blocks:
+            if block['type'] == 'normal':
+                lines += len(block['text']) // 90 + block['text'].count('\n') + 1
+            elif block['type'] == 'code':
+                lines += block['text'].count('\n') + 3
+            elif block['type'] == 'table':
+                lines += (block['text'].count('\n') + 1) * 2
             else:
-                sqlite_con = sqlite3.connect(window.sqlite_path)
-                cursor = sqlite_con.cursor()
-                cursor.execute("UPDATE message SET date_time = ?, content = ? WHERE id = ?", (self.dt.strftime("%Y/%m/%d %H:%M:%S"), self.text, self.message_id))
-                sqlite_con.commit()
-                sqlite_con.close()
-            sys.exit()
-
-    def set_text(self, text:str=None):
+                lines += 3
+        return lines * 20 + len(self.blocks) * 12
+
+    def defer_text(self, text:str, blocks:list):
+        # Used while loading chats, the widgets are created once the message gets close to the viewport
+        self.text = text
+        self.blocks = blocks
+        self.loaded = False
+        self.container.set_property('height-request', self.estimate_height())
+
+    def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        self.container.set_property('height-request', -1)
+        for part in self.blocks:
+            self.add_block(part)
+
+    def update_code_blocks(self, container, value:float, page:float) -> bool:
+        # Source views are only kept for code blocks around the viewport, returns whether any of them changed
+        changed = False
+        for block in self.content_children:
+            if not isinstance(block, code_block) or block is self.stream_widget:
+                continue
+            found, x, y = block.translate_coordinates(container, 0, 0)
+            if not found:
+                continue
+            height = block.get_height()
+            if y + height >= value - page and y <= value + page * 2:
+                if not block.source_view:
+                    block.materialize()
+                    changed = True
+            elif y + height < value - page * 3 or y > value + page * 4:
+                if block.source_view:
+                    block.release()
+                    changed = True
+        return changed
+
+    def unload(self):
+        if not self.loaded or self.streaming or not self.text or self.blocks is None or not self.content_children:
+            return
+        height = self.container.get_height()
+        for child in self.content_children:
+            self.container.remove(child)
+        self.content_children = []
+        self.container.set_property('height-request', height)
+        self.loaded = False
+
+    def set_text(self, text:str=None, blocks:list=None):
         self.text = text
         for child in self.content_children:
             self.container.remove(child)
         self.content_children = []
+        self.blocks = None
+        if not self.loaded:
+            self.loaded = True
+            self.container.set_property('height-request', -1)
         if text:
             self.content_children = []
-            code_block_pattern = re.compile(r'```(\w*)\n(.*?)\n\s*```', re.DOTALL)
-            no_language_code_block_pattern = re.compile(r'`(\w*)\n(.*?)\n\s*`', re.DOTALL)
-            table_pattern = re.compile(r'((?:\| *[^|\r\n]+ *)+\|)(?:\r?\n)((?:\|[ :]?-+[ :]?)+\|)((?:(?:\r?\n)(?:\| *[^|\r\n]+ *)+\|)+)', re.MULTILINE)
-            latex_pattern = re.compile(r'\\\[\n(.*?)\n\\\]|\$(.*?)\$', re.MULTILINE)
-            markup_pattern = re.compile(r'<(b|u|tt|a.*|span.*)>(.*?)<\/(b|u|tt|a|span)>')
-            parts = []
-            pos = 0
-            # Code blocks
-            for match in code_block_pattern.finditer(self.text[pos:]):
-                start, end = match.span()
-                if pos < start:
-                    normal_text = self.text[pos:start]
-                    parts.append({"type": "normal", "text": normal_text.strip()})
-                language = match.group(1)
-                code_text = match.group(2)
-                parts.append({"type": "code", "text": code_text, "language": 'python3' if language == 'python' else language})
-                pos = end
-            for match in no_language_code_block_pattern.finditer(self.text[pos:]):
-                start, end = match.span()
-                if pos < start:
-                    normal_text = self.text[pos:start]
-                    parts.append({"type": "normal", "text": normal_text.strip()})
-                language = match.group(1)
-                code_text = match.group(2)
-                parts.append({"type": "code", "text": code_text, "language": None})
-                pos = end
-            # Tables
-            for match in table_pattern.finditer(self.text[pos:]):
-                start, end = match.span()
-                if pos < start:
-                    normal_text = self.text[pos:start]
-                    parts.append({"type": "normal", "text": normal_text.strip()})
-                table_text = match.group(0)
-                parts.append({"type": "table", "text": table_text})
-                pos = end
-            # Latex
-            for match in latex_pattern.finditer(self.text[pos:]):
-                start, end = match.span()
-                if pos < start:
-                    normal_text = self.text[pos:start]
-                    parts.append({"type": "normal", "text": normal_text.strip()})
-                latex_text = match.group(0)
-                parts.append({"type": "latex", "text": latex_text})
-                pos = end
-            # Text blocks
-            if pos < len(self.text):
-                normal_text = self.text[pos:]
-                if normal_text.strip():
-                    parts.append({"type": "normal", "text": normal_text.strip()})
-
-            for part in parts:
-                if part['type'] == 'normal':
-                    text_b = text_block(self.bot, self.system)
-                    part['text'] = GLib.markup_escape_text(part['text'])
-                    part['text'] = part['text'].replace("\n* ", "\n• ")
-                    part['text'] = re.sub(r'`([^`\n]*?)`', r'<tt>\1</tt>', part['text'])
-                    part['text'] = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', part['text'], flags=re.MULTILINE)
-                    part['text'] = re.sub(r'^#\s+(.*)', r'<span size="xx-large">\1</span>', part['text'], flags=re.MULTILINE)
-                    part['text'] = re.sub(r'^##\s+(.*)', r'<span size="x-large">\1</span>', part['text'], flags=re.MULTILINE)
-                    part['text'] = re.sub(r'^###\s+(.*)', r'<span size="large">\1</span>', part['text'], flags=re.MULTILINE)
-                    part['text'] = re.sub(r'_(\((.*?)\)|\d+)', r'<sub>\2\1</sub>', part['text'], flags=re.MULTILINE)
-                    part['text'] = re.sub(r'\^(\((.*?)\)|\d+)', r'<sup>\2\1</sup>', part['text'], flags=re.MULTILINE)
-                    part['text'] = re.sub(r'\[(.*?)\]\((.*?)\)', r'<a href="\1">\2</a>', part['text'], flags=re.MULTILINE)
-                    part['text'] = re.sub(r'\s\[(.*?)\]\s', r' <a href="\1">\1</a> ', part['text'], flags=re.MULTILINE)
-                    pos = 0
-
-                    for match in markup_pattern.finditer(part['text']):
-                        start, end = match.span()
-                        if pos < start:
-                            text_b.raw_text += part['text'][pos:start]
-                        text_b.raw_text += match.group(0)
-                        pos = end
-
-                    if pos < len(part['text']):
-                        text_b.raw_text += part['text'][pos:]
-                    if text_b.raw_text:
-                        self.content_children.append(text_b)
-                        self.container.append(text_b)
-                        GLib.idle_add(text_b.set_markup,text_b.raw_text)
-                elif part['type'] == 'code':
-                    code_b = code_block(part['text'], part['language'])
-                    self.content_children.append(code_b)
-                    self.container.append(code_b)
-                elif part['type'] == 'table':
-                    table_w = TableWidget(part['text'])
-                    self.content_children.append(table_w)
-                    self.container.append(table_w)
-                elif part['type'] == 'latex':
-                    latex_w = latex_image(part['text'])
-                    self.content_children.append(latex_w)
-                    self.container.append(latex_w)
+            self.blocks = blocks if blocks is not None else markdown_parser.tokenize(self.text)
+            for part in self.blocks:
+                self.add_block(part)
         else:
             text_b = text_block(self.bot, self.system)
             text_b.set_visible(False)
@@ -804,6 +1113,12 @@ class message(Gtk.Box):
                 self.container.remove(self.spinner)
                 self.spinner = None
             self.spinner = Gtk.Spinner(spinning=True, margin_top=10, margin_bottom=10, hexpand=True)
+            self.streaming = True
+            self.stream_text = ''
+            self.stream_parser = markdown_parser.block_parser()
+            self.stream_blocks = []
+            self.stream_widget = text_b
+            self.stream_widget_text = ''
             self.container.append(self.spinner)
             self.container.append(text_b)
         self.container.queue_draw()
@@ -7,9 +7,10 @@ import gi
 gi.require_version('Gtk', '4.0')
 gi.require_version('GtkSource', '5')
 from gi.repository import Gtk, GObject, Gio, Adw, GtkSource, GLib, Gdk, GdkPixbuf
-import logging, os, datetime, re, shutil, threading, json, sys, glob, icu, base64, sqlite3
+import logging, os, datetime, re, shutil, threading, json, glob, icu, base64
 from ..internal import config_dir, data_dir, cache_dir, source_dir
-from .. import available_models_descriptions
+from .. import available_models_descriptions, connection_handler, storage
+from ..texture_cache import shared_cache
 from . import dialog_widget
 
 logger = logging.getLogger(__name__)
@@ -73,12 +74,7 @@ class model_selector_row(Gtk.ListBoxRow):
         self.data = data
         self.image_recognition = 'projector_info' in self.data
         self.profile_picture_data = None
-        sqlite_con = sqlite3.connect(window.sqlite_path)
-        cursor = sqlite_con.cursor()
-        picture = cursor.execute("SELECT picture FROM model WHERE id=?", (self.get_name(),)).fetchone()
-        if picture:
-            self.profile_picture_data = picture[0]
-        sqlite_con.close()
+        self.profile_picture_data = storage.get_model_picture(self.get_name())
 
 class model_selector_button(Gtk.MenuButton):
     __gtype_name__ = 'AlpacaModelSelectorButton'
@@ -112,6 +108,7 @@ class model_selector_button(Gtk.MenuButton):
             model_name = row.get_name()
             self.label.set_label(window.convert_model_name(model_name, 0))
             self.set_tooltip_text(window.convert_model_name(model_name, 0))
+            window.preload_selected_model()
         elif len(list(listbox)) == 0:
             window.title_stack.set_visible_child_name('no_models')
         window.model_manager.verify_if_image_can_be_used()
@@ -126,12 +123,8 @@ class model_selector_button(Gtk.MenuButton):
         self.get_popover().model_list_box.remove(next((model for model in list(self.get_popover().model_list_box) if model.get_name() == model_name), None))
         self.model_changed(self.get_popover().model_list_box)
         window.title_stack.set_visible_child_name('model_selector' if len(window.model_manager.get_model_list()) > 0 else 'no_models')
-        sqlite_con = sqlite3.connect(window.sqlite_path)
-        cursor = sqlite_con.cursor()
-        cursor.execute("DELETE FROM model WHERE id=?", (self.get_name(),))
-        sqlite_con.commit()
-        sqlite_con.close()
-        window.chat_list_box.update_profile_pictures()
+        storage.remove_model_picture(model_name)
+        window.chat_list_box.update_profile_pictures(model_name)
 
     def get_model_by_name(self, model_name:str) -> object:
         return next((model for model in list(self.get_popover().model_list_box) if model.get_name() == model_name), None)
@@ -214,27 +207,29 @@ class pulling_model(Gtk.ListBoxRow):
         )
         self.error = None
         self.digests = []
+        self.request_handle = connection_handler.request_handle()
 
     def stop(self):
+        self.request_handle.cancel()
         if len(list(self.get_parent())) == 1:
             self.get_parent().set_visible(False)
         self.get_parent().remove(self)
 
+    def delete_blobs(self):
+        logger.info("Pulling of '{}' was canceled".format(self.get_name()))
+        directory = os.path.join(window.ollama_instance.model_directory, 'blobs')
+        for digest in self.digests:
+            files_to_delete = glob.glob(os.path.join(directory, digest + '*'))
+            for file in files_to_delete:
+                logger.info("Deleting '{}'".format(file))
+                try:
+                    os.remove(file)
+                except Exception as e:
+                    logger.error(f"Can't delete file {file}: {e}")
+
     def update(self, data):
         if 'digest' in data and data['digest'] not in self.digests:
             self.digests.append(data['digest'].replace(':', '-'))
-        if not self.get_parent():
-            logger.info("Pulling of '{}' was canceled".format(self.get_name()))
-            directory = os.path.join(window.ollama_instance.model_directory, 'blobs')
-            for digest in self.digests:
-                files_to_delete = glob.glob(os.path.join(directory, digest + '*'))
-                for file in files_to_delete:
-                    logger.info("Deleting '{}'".format(file))
-                    try:
-                        os.remove(file)
-                    except Exception as e:
-                        logger.error(f"Can't delete file {file}: {e}")
-            sys.exit()
         if 'error' in data:
             self.error = data['error']
         else:
@@ -246,6 +241,15 @@ class pulling_model(Gtk.ListBoxRow):
                 GLib.idle_add(self.prc_label.set_label, data['status'])
                 GLib.idle_add(self.progress_bar.pulse)
 
+    def update_batch(self, chunks:list):
+        # Only the newest progress is shown but every digest and error has to be kept
+        for data in chunks[:-1]:
+            if 'digest' in data and data['digest'].replace(':', '-') not in self.digests:
+                self.digests.append(data['digest'].replace(':', '-'))
+            if 'error' in data:
+                self.error = data['error']
+        self.update(chunks[-1])
+
 class pulling_model_list(Gtk.ListBox):
     __gtype_name__ = 'AlpacaPullingModelList'
 
@@ -395,36 +399,20 @@ class local_model(Gtk.ListBoxRow):
         file = file_dialog.open_finish(result)
         if file:
             model.profile_picture_data = window.get_content_of_file(file.get_path(), 'image')
-            image_data = base64.b64decode(model.profile_picture_data)
-            loader = GdkPixbuf.PixbufLoader.new()
-            loader.write(image_data)
-            loader.close()
-            pixbuf = loader.get_pixbuf()
-            texture = Gdk.Texture.new_for_pixbuf(pixbuf)
-            image = Gtk.Image.new_from_paintable(texture)
+            image = Gtk.Image()
             image.set_size_request(64, 64)
+            shared_cache.load_texture(model.profile_picture_data, 64, lambda texture, image=image: image.set_from_paintable(texture))
             button.set_overflow(1)
             button.set_child(image)
-            sqlite_con = sqlite3.connect(window.sqlite_path)
-            cursor = sqlite_con.cursor()
-            if cursor.execute("SELECT picture FROM model WHERE id=?", (self.get_name(),)).fetchone():
-                cursor.execute("UPDATE model SET picture=? WHERE id=?", (model.profile_picture_data, self.get_name()))
-            else:
-                cursor.execute("INSERT INTO model (id, picture) VALUES (?, ?)", (self.get_name(), model.profile_picture_data))
-            sqlite_con.commit()
-            sqlite_con.close()
-            window.chat_list_box.update_profile_pictures()
+            storage.set_model_picture(self.get_name(), model.profile_picture_data)
+            window.chat_list_box.update_profile_pictures(self.get_name())
 
     def remove_pfp(self, button, model):
-        sqlite_con = sqlite3.connect(window.sqlite_path)
-        cursor = sqlite_con.cursor()
-        cursor.execute("DELETE FROM model WHERE id=?", (self.get_name(),))
-        sqlite_con.commit()
-        sqlite_con.close()
+        storage.remove_model_picture(self.get_name())
         #button.remove(button.get_child())
         button.set_icon_name('image-x-generic-symbolic')
         model.profile_picture_data = None
-        window.chat_list_box.update_profile_pictures()
+        window.chat_list_box.update_profile_pictures(self.get_name())
 
     def pfp_button_pressed(self, button, model):
         file_filter = Gtk.FileFilter()
@@ -464,14 +452,9 @@ class local_model(Gtk.ListBoxRow):
             tooltip_text=_("Change Model Picture")
         )
         if model.profile_picture_data:
-            image_data = base64.b64decode(model.profile_picture_data)
-            loader = GdkPixbuf.PixbufLoader.new()
-            loader.write(image_data)
-            loader.close()
-            pixbuf = loader.get_pixbuf()
-            texture = Gdk.Texture.new_for_pixbuf(pixbuf)
-            image = Gtk.Image.new_from_paintable(texture)
+            image = Gtk.Image()
             image.set_size_request(64, 64)
+            shared_cache.load_texture(model.profile_picture_data, 64, lambda texture, image=image: image.set_from_paintable(texture))
             pfp_button.set_overflow(1)
             pfp_button.set_child(image)
 
@@ -733,7 +716,7 @@ class model_manager_container(Gtk.Box):
         data = None
         categories = []
         try:
-            response = window.ollama_instance.request("POST", "api/show", json.dumps({"name": model_name}))
+            response = window.ollama_instance.request("POST", "api/show", json.dumps({"name": model_name}), model=model_name, priority=connection_handler.PRIORITY_BACKGROUND, group='api/show')
             data = json.loads(response.text)
         except Exception as e:
             data = None
@@ -779,26 +762,22 @@ class model_manager_container(Gtk.Box):
     #Should only be called when the app starts
     def update_local_list(self):
         try:
-            response = window.ollama_instance.request("GET", "api/tags")
-            if response.status_code == 200:
-                threads = []
-                GLib.idle_add(self.model_selector.popover.model_list_box.remove_all)
-                GLib.idle_add(self.local_list.remove_all)
-                window.default_model_list.splice(0, len(list(window.default_model_list)), None)
-                data = json.loads(response.text)
-                GLib.idle_add(window.chat_list_box.update_welcome_screens, len(data['models']) > 0)
-                if len(data['models']) == 0:
-                    GLib.idle_add(self.local_list.set_visible, False)
-                else:
-                    GLib.idle_add(self.local_list.set_visible, True)
-                    for model in data['models']:
-                        thread = threading.Thread(target=self.add_local_model, args=(model['name'], ))
-                        thread.start()
-                        threads.append(thread)
-                for thread in threads:
-                    thread.join()
+            models = window.ollama_instance.refresh_endpoints()
+            threads = []
+            GLib.idle_add(self.model_selector.popover.model_list_box.remove_all)
+            GLib.idle_add(self.local_list.remove_all)
+            window.default_model_list.splice(0, len(list(window.default_model_list)), None)
+            GLib.idle_add(window.chat_list_box.update_welcome_screens, len(models) > 0)
+            if len(models) == 0:
+                GLib.idle_add(self.local_list.set_visible, False)
             else:
-                window.connection_error()
+                GLib.idle_add(self.local_list.set_visible, True)
+                for model_name in models:
+                    thread = threading.Thread(target=self.add_local_model, args=(model_name, ))
+                    thread.start()
+                    threads.append(thread)
+            for thread in threads:
+                thread.join()
         except Exception as e:
             logger.error(e)
             window.connection_error()
@@ -838,10 +817,13 @@ class model_manager_container(Gtk.Box):
                 GLib.idle_add(self.pulling_list.set_visible, True)
 
             if modelfile:
-                response = window.ollama_instance.request("POST", "api/create", json.dumps({"name": model_name, "modelfile": modelfile}), lambda data: model.update(data))
+                response = window.ollama_instance.request("POST", "api/create", json.dumps({"name": model_name, "modelfile": modelfile}), lambda chunks: model.update_batch(chunks), model.request_handle, batched=True)
             else:
-                response = window.ollama_instance.request("POST", "api/pull", json.dumps({"name": model_name}), lambda data: model.update(data))
+                response = window.ollama_instance.request("POST", "api/pull", json.dumps({"name": model_name}), lambda chunks: model.update_batch(chunks), model.request_handle, batched=True)
 
+            if response.cancelled:
+                model.delete_blobs()
+                return
             if response.status_code == 200 and not model.error:
                 GLib.idle_add(window.show_notification, _("Task Complete"), _("Model '{}' pulled successfully.").format(model_name), Gio.ThemedIcon.new("emblem-ok-symbolic"))
                 GLib.idle_add(window.show_toast, _("Model '{}' pulled successfully.").format(model_name), window.manage_models_overlay)
@@ -3,11 +3,12 @@
 Working on organizing the code
 """
 
-import os, requests, sqlite3, re
+import os, requests, re, threading
 from youtube_transcript_api import YouTubeTranscriptApi
 from youtube_transcript_api.formatters import TextFormatter
 from html2text import html2text
 from .internal import cache_dir
+from . import storage
 
 window = None
 
@@ -21,15 +22,32 @@ def connect_remote(remote_url:str, bearer_token:str):
     window.ollama_instance.remote = True
     window.ollama_instance.stop()
     window.model_manager.update_local_list()
-    sqlite_con = sqlite3.connect(window.sqlite_path)
-    cursor = sqlite_con.cursor()
-    cursor.execute("UPDATE preferences SET value=?, type=? WHERE id=?", (True, str(type(True)), "run_remote"))
-    cursor.execute("UPDATE preferences SET value=?, type=? WHERE id=?", (remote_url, str(type(remote_url)), "remote_url"))
-    cursor.execute("UPDATE preferences SET value=?, type=? WHERE id=?", (bearer_token, str(type(bearer_token)), "remote_bearer_token"))
-    sqlite_con.commit()
-    sqlite_con.close()
+    storage.set_preferences({
+        "run_remote": True,
+        "remote_url": remote_url,
+        "remote_bearer_token": bearer_token
+    })
     window.remote_connection_selector.set_subtitle(remote_url)
 
+def add_endpoint(remote_url:str, bearer_token:str):
+    if remote_url.endswith('/'):
+        remote_url = remote_url.rstrip('/')
+    if not remote_url:
+        return
+    if not (remote_url.startswith('http://') or remote_url.startswith('https://')):
+        remote_url = f'http://{remote_url}'
+    if remote_url not in [target.url for target in window.ollama_instance.extra_endpoints]:
+        window.add_endpoint_row(remote_url)
+    window.ollama_instance.add_endpoint(remote_url, bearer_token)
+    storage.add_endpoint(remote_url, bearer_token)
+    threading.Thread(target=window.model_manager.update_local_list).start()
+
+def remove_endpoint(row):
+    window.ollama_instance.remove_endpoint(row.get_name())
+    window.endpoints_group.remove(row)
+    storage.remove_endpoint(row.get_name())
+    threading.Thread(target=window.model_manager.update_local_list).start()
+
 def attach_youtube(video_title:str, video_author:str, watch_url:str, video_url:str, video_id:str, caption_name:str):
     buffer = window.message_text_view.get_buffer()
     text = buffer.get_text(buffer.get_start_iter(), buffer.get_end_iter(), False).replace(video_url, "")
@@ -0,0 +1,144 @@
+# latex_renderer.py
+"""
+Renders LaTeX equations to PNG in worker processes and keeps the results in a disk cache
+"""
+import os, io, hashlib, logging, threading, multiprocessing
+from concurrent.futures import ProcessPoolExecutor, Future
+from .internal import cache_dir
+
+logger = logging.getLogger(__name__)
+
+MAX_WORKERS = max(1, min(2, (os.cpu_count() or 1) - 1))
+CACHE_DIR = os.path.join(cache_dir, 'latex')
+# Least recently used equations are removed once the cache grows past this size
+MAX_CACHE_SIZE = 32 * 1024 * 1024
+# Equations are always rendered in black, the dark style inverts them with CSS
+COLOR = 'black'
+
+def render_equation(equation:str, use_TeX:bool, scale:float=1.0, color:str=COLOR) -> bytes:
+    """
+    Runs in a worker process, returns the cropped equation as PNG bytes
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from PIL import Image
+
+    if not use_TeX:
+        equation = '${}$'.format(equation.replace('\\[', '').replace('\\]', '').replace('$', '').replace('\n', ''))
+    # pyplot is avoided, a standalone figure isn't registered anywhere
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    fig.text(0.5, 0.5, equation, fontsize=24, ha='center', va='center', usetex=use_TeX, color=color)
+    fig.patch.set_alpha(0.0)
+    png = io.BytesIO()
+    fig.savefig(png, format='png', dpi=100 * scale, bbox_inches="tight", pad_inches=0, transparent=True)
+
+    img = Image.open(io.BytesIO(png.getvalue())).convert("RGBA")
+    bbox = img.getbbox()
+    if not bbox:
+        return png.getvalue()
+    png = io.BytesIO()
+    img.crop(bbox).save(png, format='png')
+    return png.getvalue()
+
+def render_with_fallback(equation:str, use_TeX:bool, scale:float, color:str) -> bytes:
+    try:
+        return render_equation(equation, use_TeX, scale, color)
+    except Exception:
+        if not use_TeX:
+            raise
+        # TeX might not be installed or the equation might not be valid TeX, mathtext is tried instead
+        return render_equation(equation, False, scale, color)
+
+class renderer():
+    """
+    Deduplicates render requests and serves them from the disk cache when possible
+    """
+
+    def __init__(self):
+        self.executor = None
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.cache_size = None
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        if not self.executor:
+            # Workers are spawned so they don't inherit the GTK state of the app, matplotlib is only imported by them
+            self.executor = ProcessPoolExecutor(max_workers=MAX_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return self.executor
+
+    def get_key(self, equation:str, use_TeX:bool, scale:float, color:str) -> str:
+        return hashlib.sha256('{}\0{}\0{}\0{}'.format(equation, use_TeX, scale, color).encode('utf-8')).hexdigest()
+
+    def read_cache(self, key:str) -> bytes:
+        path = os.path.join(CACHE_DIR, '{}.png'.format(key))
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # The modification time is used as the last access time for the LRU
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+
+    def write_cache(self, key:str, data:bytes):
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            path = os.path.join(CACHE_DIR, '{}.png'.format(key))
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(path + '.tmp', path)
+            with self.lock:
+                if self.cache_size is None:
+                    self.cache_size = sum(entry.stat().st_size for entry in os.scandir(CACHE_DIR) if entry.name.endswith('.png'))
+                else:
+                    self.cache_size += len(data)
+                if self.cache_size > MAX_CACHE_SIZE:
+                    self.evict()
+        except OSError as e:
+            logger.error(e)
+
+    def evict(self):
+        entries = sorted((entry for entry in os.scandir(CACHE_DIR) if entry.name.endswith('.png')), key=lambda entry: entry.stat().st_mtime)
+        self.cache_size = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self.cache_size <= MAX_CACHE_SIZE * 0.8:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self.cache_size -= size
+            except OSError:
+                pass
+
+    def render(self, equation:str, use_TeX:bool=True, scale:float=1.0, color:str=COLOR, use_cache:bool=True) -> Future:
+        """
+        Returns a future with the PNG bytes of the equation, its callbacks might run in another thread
+        """
+        key = self.get_key(equation, use_TeX, scale, color)
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+        if use_cache:
+            data = self.read_cache(key)
+            if data:
+                future = Future()
+                future.set_result(data)
+                return future
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+            future = self.get_executor().submit(render_with_fallback, equation, use_TeX, scale, color)
+            self.pending[key] = future
+        future.add_done_callback(lambda future, key=key: self.on_rendered(key, future))
+        return future
+
+    def on_rendered(self, key:str, future:Future):
+        with self.lock:
+            self.pending.pop(key, None)
+        if not future.cancelled() and not future.exception():
+            self.write_cache(key, future.result())
+
+shared_renderer = renderer()
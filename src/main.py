@@ -27,6 +27,7 @@ from gi.repository import Gtk, Gio, Adw, GLib
 
 from .window import AlpacaWindow
 from .internal import cache_dir, data_dir
+from . import storage
 
 import sys
 import logging
@@ -34,7 +35,6 @@ import os
 import argparse
 import json
 import time
-import sqlite3
 
 from pydbus import SessionBus
 
@@ -167,6 +167,17 @@ class AlpacaApplication(Adw.Application):
             self.set_accels_for_action(f"app.{name}", shortcuts)
 
 
+def open_database() -> bool:
+    # Options handled before the window opens still need the database at the current schema version
+    if not os.path.isfile(storage.DB_PATH):
+        return False
+    try:
+        storage.migrate()
+        return True
+    except Exception as e:
+        logger.error("Could not open the database: {}".format(e))
+        return False
+
 def main(version):
     logging.basicConfig(
         format="%(levelname)s\t[%(filename)s | %(funcName)s] %(message)s",
@@ -179,30 +190,42 @@ def main(version):
     parser.add_argument('--list-chats', action='store_true', help='Display all the current chats')
     parser.add_argument('--select-chat', type=str, metavar='"CHAT"', help="Select a chat on launch")
     parser.add_argument('--ask', type=str, metavar='"MESSAGE"', help="Open quick ask with message")
+    parser.add_argument('--list-metrics', action='store_true', help='Display the average inference metrics per model and day')
     args = parser.parse_args()
 
     if args.version:
         print(f"Alpaca version {version}")
         sys.exit(0)
 
+    if args.list_chats or args.list_metrics:
+        # Their output is read by other programs, logs go to stderr instead
+        for handler in logging.getLogger().handlers:
+            if isinstance(handler, logging.StreamHandler) and handler.stream is sys.stdout:
+                handler.setStream(sys.stderr)
+
     if args.list_chats:
-        sqlite_con = sqlite3.connect(os.path.join(data_dir, "alpaca.db"))
-        cursor = sqlite_con.cursor()
-        chats = cursor.execute('SELECT chat.name, MAX(message.date_time) AS latest_message_time FROM chat LEFT JOIN message ON chat.id = message.chat_id GROUP BY chat.id ORDER BY latest_message_time DESC').fetchall()
+        # The search provider reads this output, nothing is printed if the database can't be read
+        chats = storage.get_chats() if open_database() else []
         if chats:
             for chat in chats:
-                print(chat[0])
+                print(chat[1])
         else:
             print()
-        sqlite_con.close()
         sys.exit(0)
 
-    if args.select_chat:
-        sqlite_con = sqlite3.connect(os.path.join(data_dir, "alpaca.db"))
-        cursor = sqlite_con.cursor()
-        cursor.execute("UPDATE preferences SET value=? WHERE id=?", (args.select_chat, 'selected_chat'))
-        sqlite_con.commit()
-        sqlite_con.close()
+    if args.list_metrics:
+        if not open_database():
+            sys.exit(0)
+        rows = storage.get_metrics_summary()
+        print('{:10}  {:30}  {:>8}  {:>8}  {:>8}  {:>12}  {:>12}'.format('day', 'model', 'messages', 'ttft s', 'load s', 'prompt tok/s', 'eval tok/s'))
+        for row in rows:
+            print('{:10}  {:30}  {:>8}  {:>8}  {:>8}  {:>12}  {:>12}'.format(row[0], row[1] or '-', row[2], *['{:.2f}'.format(value) if value is not None else '-' for value in row[3:]]))
+        sys.exit(0)
+
+    if args.select_chat and open_database():
+        storage.set_preference('selected_chat', args.select_chat)
+        # The process can exit right away if Alpaca is already running
+        storage.flush()
 
     if os.path.isfile(os.path.join(data_dir, 'tmp.log')):
         os.remove(os.path.join(data_dir, 'tmp.log'))
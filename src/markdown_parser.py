@@ -0,0 +1,325 @@
+# markdown_parser.py
+"""
+Single pass markdown tokenizer used to split messages into blocks and render their inline markup
+"""
+import re, html, json, hashlib
+
+# Bump when the output of tokenize changes so cached blocks get parsed again
+PARSER_VERSION = 1
+
+TABLE_SEPARATOR = re.compile(r'^\|(?:\s*:?-+:?\s*\|)+$')
+INLINE_LATEX = re.compile(r'\$([^$\n]+)\$')
+BARE_CODE_START = re.compile(r'^`(\w*)$')
+HEADING_SIZES = {1: 'xx-large', 2: 'x-large', 3: 'large'}
+INLINE_SPECIAL = re.compile(r'[`*_^\[]')
+
+def is_table_row(line:str) -> bool:
+    return len(line) > 1 and line.startswith('|') and line.endswith('|')
+
+class block_parser():
+    """
+    Incremental block tokenizer, it's fed streamed text and returns the blocks closed by every feed
+    """
+
+    def __init__(self, disabled:set=None):
+        self.disabled = disabled or set() # Delimiters known to never close
+        self.partial = ''
+        self.kind = 'normal'
+        self.delimiter = None
+        self.opener = None
+        self.language = None
+        self.lines = []
+        self.reparsed = False
+
+    def feed(self, text:str) -> list:
+        blocks = []
+        if '\n' not in text:
+            self.partial += text
+            return blocks
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.process_line(line, blocks)
+        return blocks
+
+    def finish(self) -> list:
+        blocks = []
+        if self.partial:
+            self.process_line(self.partial, blocks)
+            self.partial = ''
+        if self.kind in ('code', 'latex'):
+            # Never closed, everything after the opener is parsed again without that delimiter
+            self.reparsed = True
+            parser = block_parser(self.disabled | {self.delimiter})
+            blocks.extend(parser.feed('\n'.join([self.opener] + self.lines) + '\n'))
+            blocks.extend(parser.finish())
+        else:
+            self.close_block(blocks)
+        self.lines = []
+        self.kind = 'normal'
+        return blocks
+
+    def get_open_block(self) -> dict:
+        lines = self.lines
+        # A partial line that could become a closing fence is held back
+        if self.partial and not (self.kind == 'code' and self.partial.lstrip().startswith('`')):
+            lines = lines + [self.partial]
+        if self.kind == 'code':
+            return {"type": "code", "text": '\n'.join(lines), "language": self.language}
+        return {"type": self.kind, "text": '\n'.join(([self.opener] if self.opener else []) + lines)}
+
+    def close_block(self, blocks:list):
+        if self.kind == 'code':
+            blocks.append({"type": "code", "text": '\n'.join(self.lines), "language": self.language})
+        elif self.kind == 'latex':
+            blocks.append({"type": "latex", "text": '\\[\n{}\n\\]'.format('\n'.join(self.lines))})
+        elif self.kind == 'table':
+            blocks.append({"type": "table", "text": '\n'.join(self.lines)})
+        else:
+            add_paragraph(blocks, self.lines)
+        self.kind = 'normal'
+        self.delimiter = None
+        self.opener = None
+        self.language = None
+        self.lines = []
+
+    def open_block(self, blocks:list, kind:str, delimiter:str, opener:str, language:str=None):
+        self.close_block(blocks)
+        self.kind = kind
+        self.delimiter = delimiter
+        self.opener = opener
+        self.language = language
+
+    def process_line(self, line:str, blocks:list):
+        stripped = line.strip()
+        if self.kind == 'code':
+            if (self.delimiter == '```' and stripped.startswith('```')) or (self.delimiter == '`' and stripped == '`'):
+                self.close_block(blocks)
+                if stripped[3:].strip():
+                    self.lines.append(stripped[3:].strip())
+            else:
+                self.lines.append(line)
+            return
+        if self.kind == 'latex':
+            if stripped == '\\]':
+                self.close_block(blocks)
+            else:
+                self.lines.append(line)
+            return
+        if self.kind == 'table':
+            if is_table_row(stripped):
+                self.lines.append(stripped)
+                return
+            self.close_block(blocks)
+
+        if stripped.startswith('```') and '```' not in self.disabled:
+            language = stripped[3:].strip()
+            self.open_block(blocks, 'code', '```', line, 'python3' if language == 'python' else language or None)
+        elif BARE_CODE_START.match(stripped) and '`' not in self.disabled:
+            self.open_block(blocks, 'code', '`', line)
+        elif stripped == '\\[' and '\\[' not in self.disabled:
+            self.open_block(blocks, 'latex', '\\[', line)
+        elif is_table_row(stripped) and len(self.lines) > 1 and TABLE_SEPARATOR.match(self.lines[-1].strip()) and is_table_row(self.lines[-2].strip()):
+            header = [row.strip() for row in self.lines[-2:]]
+            del self.lines[-2:]
+            self.open_block(blocks, 'table', None, None)
+            self.lines = header + [stripped]
+        elif not stripped:
+            # Blank lines end paragraphs so the open block stays small while streaming
+            self.close_block(blocks)
+        else:
+            self.lines.append(line)
+
+def tokenize(text:str) -> list:
+    """
+    Splits a message into normal, code, table and latex blocks, normal blocks include their inline nodes
+    """
+    parser = block_parser()
+    return parser.feed(text) + parser.finish()
+
+def add_paragraph(blocks:list, paragraph:list):
+    if not paragraph:
+        return
+    text = '\n'.join(paragraph)
+    paragraph.clear()
+    pos = 0
+    for match in INLINE_LATEX.finditer(text):
+        add_normal(blocks, text[pos:match.start()])
+        blocks.append({"type": "latex", "text": match.group(0)})
+        pos = match.end()
+    add_normal(blocks, text[pos:])
+
+def add_normal(blocks:list, text:str):
+    text = text.strip()
+    if text:
+        blocks.append({"type": "normal", "text": text, "inline": tokenize_inline(text)})
+
+def tokenize_inline(text:str) -> list:
+    nodes = []
+    for n, line in enumerate(text.split('\n')):
+        if n > 0:
+            nodes.append({"type": "newline"})
+        level = len(line) - len(line.lstrip('#'))
+        if 0 < level <= 3 and line[level:level + 1].isspace():
+            nodes.append({"type": "heading", "level": level, "children": parse_spans(line[level:].lstrip())})
+        elif line.startswith('* '):
+            nodes.append({"type": "bullet"})
+            nodes.extend(parse_spans(line[2:]))
+        else:
+            nodes.extend(parse_spans(line))
+    return nodes
+
+def parse_spans(line:str, bold:bool=True) -> list:
+    nodes = []
+    closers = {}
+
+    def find(token:str, start:int) -> int:
+        # The first match after an earlier start is still the first one after a later start
+        cached = closers.get(token)
+        if cached is None or (cached != -1 and cached < start):
+            cached = line.find(token, start)
+            closers[token] = cached
+        return cached
+
+    text_start = 0
+    i = 0
+    while True:
+        # Jumps straight to the next character that can start a span
+        special = INLINE_SPECIAL.search(line, i)
+        if not special:
+            break
+        i = special.start()
+        node = None
+        character = line[i]
+        if character == '`':
+            end = find('`', i + 1)
+            if end > i + 1:
+                node = {"type": "code", "text": line[i + 1:end]}
+                next_i = end + 1
+        elif character == '*' and bold and line.startswith('**', i):
+            end = find('**', i + 2)
+            if end != -1:
+                node = {"type": "bold", "children": parse_spans(line[i + 2:end], False)}
+                next_i = end + 2
+        elif character in ('_', '^') and i + 1 < len(line):
+            node_type = 'sub' if character == '_' else 'sup'
+            if line[i + 1] == '(':
+                end = find(')', i + 2)
+                if end != -1:
+                    node = {"type": node_type, "text": line[i + 2:end]}
+                    next_i = end + 1
+            elif line[i + 1].isdigit():
+                end = i + 1
+                while end < len(line) and line[end].isdigit():
+                    end += 1
+                node = {"type": node_type, "text": line[i + 1:end]}
+                next_i = end
+        elif character == '[':
+            end = find(']', i + 1)
+            if end != -1:
+                if line.startswith('(', end + 1):
+                    close = find(')', end + 2)
+                    if close != -1:
+                        node = {"type": "link", "text": line[i + 1:end], "url": line[end + 2:close]}
+                        next_i = close + 1
+                elif i > 0 and line[i - 1].isspace() and end + 1 < len(line) and line[end + 1].isspace():
+                    node = {"type": "link", "text": line[i + 1:end], "url": line[i + 1:end]}
+                    next_i = end + 1
+        if node:
+            if text_start < i:
+                nodes.append({"type": "text", "text": line[text_start:i]})
+            nodes.append(node)
+            i = text_start = next_i
+        else:
+            i += 1
+    if text_start < len(line):
+        nodes.append({"type": "text", "text": line[text_start:]})
+    return nodes
+
+def get_hash(text:str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def dump_blocks(blocks:list) -> str:
+    return json.dumps(blocks, ensure_ascii=False, separators=(',', ':'))
+
+def load_blocks(data:str) -> list:
+    return json.loads(data)
+
+def escape(text:str) -> str:
+    return html.escape(text, quote=True)
+
+def render_markup(nodes:list) -> str:
+    """
+    Turns inline nodes into Pango markup
+    """
+    markup = []
+    for node in nodes:
+        if node['type'] == 'text':
+            markup.append(escape(node['text']))
+        elif node['type'] == 'newline':
+            markup.append('\n')
+        elif node['type'] == 'bullet':
+            markup.append('• ')
+        elif node['type'] == 'code':
+            markup.append('<tt>{}</tt>'.format(escape(node['text'])))
+        elif node['type'] == 'bold':
+            markup.append('<b>{}</b>'.format(render_markup(node['children'])))
+        elif node['type'] == 'heading':
+            markup.append('<span size="{}">{}</span>'.format(HEADING_SIZES[node['level']], render_markup(node['children'])))
+        elif node['type'] in ('sub', 'sup'):
+            markup.append('<{0}>{1}</{0}>'.format(node['type'], escape(node['text'])))
+        elif node['type'] == 'link':
+            markup.append('<a href="{}">{}</a>'.format(escape(node['url']), escape(node['text'])))
+    return ''.join(markup)
+
+if __name__ == '__main__':
+    # Conformance corpus and linear time check, run with 'python3 markdown_parser.py'
+    import time
+
+    corpus = [
+        ("Hello **world**", [("normal", "Hello <b>world</b>")]),
+        ("Use `ls -l` here", [("normal", "Use <tt>ls -l</tt> here")]),
+        ("# Title\n## Sub\n### Small\n#### None", [("normal", '<span size="xx-large">Title</span>\n<span size="x-large">Sub</span>\n<span size="large">Small</span>\n#### None')]),
+        ("List:\n* one\n* two", [("normal", "List:\n• one\n• two")]),
+        ("H_2O and x^2 and a_(i+1)", [("normal", "H<sub>2</sub>O and x<sup>2</sup> and a<sub>i+1</sub>")]),
+        ("See [Alpaca](https://jeffser.com) or [https://ollama.com] now", [("normal", 'See <a href="https://jeffser.com">Alpaca</a> or <a href="https://ollama.com">https://ollama.com</a> now')]),
+        ("a < b & c", [("normal", "a &lt; b &amp; c")]),
+        ("Before\n```python\nprint('hi')\n```\nAfter", [("normal", "Before"), ("code", "print('hi')"), ("normal", "After")]),
+        ("```\nno language\n  ```", [("code", "no language")]),
+        ("Open ```\nnever closed", [("normal", "Open ```\nnever closed")]),
+        ("`bash\necho hi\n`", [("code", "echo hi")]),
+        ("Table:\n| a | b |\n|---|:-:|\n| 1 | 2 |\n| 3 | 4 |\nEnd", [("normal", "Table:"), ("table", "| a | b |\n|---|:-:|\n| 1 | 2 |\n| 3 | 4 |"), ("normal", "End")]),
+        ("Energy $E=mc^2$ done", [("normal", "Energy"), ("latex", "$E=mc^2$"), ("normal", "done")]),
+        ("\\[\nx^2\n\\]", [("latex", "\\[\nx^2\n\\]")]),
+        ("**open bold and `code", [("normal", "**open bold and `code")])
+    ]
+    failures = 0
+    for text, expected in corpus:
+        result = [(block['type'], render_markup(block['inline']) if block['type'] == 'normal' else block['text']) for block in tokenize(text)]
+        if result != expected:
+            failures += 1
+            print('FAIL {!r}\n  expected {!r}\n  got      {!r}'.format(text, expected, result))
+    print('{}/{} corpus entries match'.format(len(corpus) - failures, len(corpus)))
+
+    # Streaming the same text in small pieces has to produce the same blocks
+    failures = 0
+    for text, expected in corpus:
+        parser = block_parser()
+        blocks = []
+        for i in range(0, len(text), 3):
+            blocks.extend(parser.feed(text[i:i + 3]))
+        blocks.extend(parser.finish())
+        if blocks != tokenize(text):
+            failures += 1
+            print('STREAM FAIL {!r}'.format(text))
+    print('{}/{} corpus entries match when streamed'.format(len(corpus) - failures, len(corpus)))
+
+    sample = "## Answer\nThis is **bold**, `code`, H_2O and a [link](https://example.com).\n* item $x$\n\n```python\nprint('hi')\n```\n| a | b |\n|---|---|\n| 1 | 2 |\n"
+    for size in (1, 4):
+        text = sample * (size * 1024 * 1024 // len(sample))
+        start = time.perf_counter()
+        blocks = tokenize(text)
+        for block in blocks:
+            if block['type'] == 'normal':
+                render_markup(block['inline'])
+        print('{} MiB: {} blocks in {:.0f} ms'.format(size, len(blocks), (time.perf_counter() - start) * 1000))
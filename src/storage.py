@@ -0,0 +1,822 @@
+# storage.py
+"""
+Owns the connections to the SQLite database, every query of the app goes through this module
+"""
+import sqlite3, threading, logging, os, time, functools, datetime, queue, hashlib
+from .internal import data_dir
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.path.join(data_dir, "alpaca.db")
+# Seconds SQLite waits for a lock before failing, the whole transaction is then retried a few times
+BUSY_TIMEOUT = 5
+RETRIES = 4
+
+# Tables as they were before the schema was versioned, later changes are made by MIGRATIONS
+# Exported chats still use this layout so they can be imported by any version
+TABLES = {
+    "chat": """
+        CREATE TABLE chat (
+            id TEXT NOT NULL PRIMARY KEY,
+            name TEXT NOT NULL
+        );
+    """,
+    "message": """
+        CREATE TABLE message (
+            id TEXT NOT NULL PRIMARY KEY,
+            chat_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            model TEXT,
+            date_time DATETIME NOT NULL,
+            content TEXT NOT NULL
+        )
+    """,
+    "attachment": """
+        CREATE TABLE attachment (
+            id TEXT NOT NULL PRIMARY KEY,
+            message_id TEXT NOT NULL,
+            type TEXT NOT NULL,
+            name TEXT NOT NULL,
+            content TEXT NOT NULL
+        )
+    """,
+    "model": """
+        CREATE TABLE model (
+            id TEXT NOT NULL PRIMARY KEY,
+            picture TEXT NOT NULL
+        )
+    """,
+    "preferences": """
+        CREATE TABLE preferences (
+            id TEXT NOT NULL PRIMARY KEY,
+            value TEXT,
+            type TEXT
+        )
+    """,
+    "overrides": """
+        CREATE TABLE overrides (
+            id TEXT NOT NULL PRIMARY KEY,
+            value TEXT
+        )
+    """,
+    "endpoint": """
+        CREATE TABLE endpoint (
+            url TEXT NOT NULL PRIMARY KEY,
+            bearer_token TEXT
+        )
+    """,
+    "message_ast": """
+        CREATE TABLE message_ast (
+            hash TEXT NOT NULL,
+            parser_version INTEGER NOT NULL,
+            blocks TEXT NOT NULL,
+            PRIMARY KEY (hash, parser_version)
+        )
+    """,
+    "message_metrics": """
+        CREATE TABLE message_metrics (
+            message_id TEXT NOT NULL PRIMARY KEY,
+            model TEXT,
+            endpoint TEXT,
+            date_time DATETIME NOT NULL,
+            time_to_first_token REAL,
+            total_duration INTEGER,
+            load_duration INTEGER,
+            prompt_eval_count INTEGER,
+            prompt_eval_duration INTEGER,
+            eval_count INTEGER,
+            eval_duration INTEGER
+        )
+    """
+}
+
+# Maximum number of variables used by a single IN (...) query
+CHUNK_SIZE = 500
+# Seconds the writer waits for more writes before committing them in the same transaction
+COMMIT_INTERVAL = 0.1
+# Rows converted at a time when the tables are rewritten
+BATCH_SIZE = 1000
+
+# Roles and attachment types are stored as their index
+ROLES = ('user', 'assistant', 'system')
+ATTACHMENT_TYPES = ('plain_text', 'code', 'pdf', 'odt', 'image', 'youtube', 'website')
+
+local = threading.local()
+
+def get_connection() -> sqlite3.Connection:
+    """
+    Every thread keeps its own connection open, statements are cached per connection
+    """
+    connection = getattr(local, 'connection', None)
+    if connection is None:
+        connection = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT, cached_statements=256)
+        # WAL lets the UI read while a streaming chat writes, NORMAL only syncs on checkpoints
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA cache_size=-16000")
+        connection.execute("PRAGMA mmap_size=268435456")
+        connection.execute("PRAGMA temp_store=MEMORY")
+        connection.execute("PRAGMA foreign_keys=ON")
+        local.connection = connection
+    return connection
+
+def close_connection():
+    connection = getattr(local, 'connection', None)
+    if connection is not None:
+        connection.close()
+        local.connection = None
+
+def run_transaction(connection:sqlite3.Connection, name:str, callback:callable):
+    for attempt in range(RETRIES + 1):
+        try:
+            with connection:
+                return callback(connection.cursor())
+        except sqlite3.OperationalError as e:
+            if attempt == RETRIES or ('locked' not in str(e) and 'busy' not in str(e)):
+                raise
+            logger.warning("Database is locked, retrying {}".format(name))
+            time.sleep(0.05 * 2 ** attempt)
+
+class writer():
+    """
+    Runs queued writes in a single thread, writes arriving close together are committed in the same transaction
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def put(self, function:callable, args:tuple, kwargs:dict):
+        with self.lock:
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run, name='storage-writer', daemon=True)
+                self.thread.start()
+        self.queue.put((function, args, kwargs))
+
+    def flush(self):
+        """
+        Waits until every queued write is committed
+        """
+        if not self.thread or threading.current_thread() is self.thread or not self.queue.unfinished_tasks:
+            return
+        # The marker makes the writer commit right away instead of waiting for more writes
+        self.queue.put(None)
+        self.queue.join()
+
+    def run(self):
+        connection = get_connection()
+        while True:
+            commands = [self.queue.get()]
+            deadline = time.monotonic() + COMMIT_INTERVAL
+            while commands[-1] is not None and time.monotonic() < deadline:
+                try:
+                    commands.append(self.queue.get(timeout=deadline - time.monotonic()))
+                except (queue.Empty, ValueError):
+                    break
+            self.commit(connection, [command for command in commands if command])
+            for command in commands:
+                self.queue.task_done()
+
+    def commit(self, connection:sqlite3.Connection, commands:list):
+        if not commands:
+            return
+        try:
+            run_transaction(connection, 'queued writes', lambda cursor: [function(cursor, *args, **kwargs) for function, args, kwargs in commands])
+        except Exception as e:
+            if len(commands) == 1:
+                logger.error("{} failed: {}".format(commands[0][0].__name__, e))
+                return
+            # A single failing write shouldn't discard the rest of the batch
+            for command in commands:
+                self.commit(connection, [command])
+
+shared_writer = writer()
+
+def flush():
+    shared_writer.flush()
+
+def transaction(function):
+    """
+    Runs the decorated function with a cursor inside a transaction, it's retried if the database stays locked
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        return run_transaction(get_connection(), function.__name__, lambda cursor: function(cursor, *args, **kwargs))
+    return wrapper
+
+def flushed(function):
+    """
+    The decorated read sees the queued writes made before it, the main thread never waits for them
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if threading.current_thread() is not threading.main_thread():
+            shared_writer.flush()
+        return function(*args, **kwargs)
+    return wrapper
+
+def queued(function):
+    """
+    The decorated function runs later in the writer thread, the call returns right away
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        shared_writer.put(function, args, kwargs)
+    return wrapper
+
+def chunks(items:list):
+    for i in range(0, len(items), CHUNK_SIZE):
+        chunk = items[i:i + CHUNK_SIZE]
+        yield chunk, ', '.join('?' * len(chunk))
+
+#Values
+
+id_lock = threading.Lock()
+last_id_time = 0
+
+def generate_id() -> str:
+    """
+    Ids are 16 bytes, 7 bytes of creation time in microseconds followed by 9 random bytes, so they sort by creation
+    """
+    global last_id_time
+    with id_lock:
+        last_id_time = max(time.time_ns() // 1000, last_id_time + 1)
+        return '{:014x}{}'.format(last_id_time, os.urandom(9).hex())
+
+def to_id(value) -> bytes:
+    """
+    Converts an id from the app or from an older database to its stored form
+    """
+    if isinstance(value, bytes) and len(value) == 16:
+        return value
+    value = str(value)
+    try:
+        if len(value) == 32:
+            return bytes.fromhex(value)
+        if len(value) == 52 and value[:20].isdigit():
+            # Older ids were a '%Y%m%d%H%M%S%f' date followed by a uuid4, the date is kept so they still sort by creation
+            created = datetime.datetime.strptime(value[:20], '%Y%m%d%H%M%S%f')
+            return bytes.fromhex('{:014x}{}'.format(round(created.timestamp() * 1e6), value[-18:]))
+    except ValueError:
+        pass
+    return hashlib.md5(value.encode('utf-8')).digest()
+
+def from_id(value:bytes) -> str:
+    return value.hex()
+
+def parse_date_time(date_time:str) -> datetime.datetime:
+    """
+    Older dates were stored as '%Y/%m/%d %H:%M' or '%Y/%m/%d %H:%M:%S', slicing them is much faster than strptime
+    """
+    return datetime.datetime(int(date_time[0:4]), int(date_time[5:7]), int(date_time[8:10]), int(date_time[11:13]), int(date_time[14:16]), int(date_time[17:19] or 0))
+
+def to_timestamp(value) -> int:
+    """
+    Dates are stored as milliseconds since the epoch
+    """
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        try:
+            value = parse_date_time(value)
+        except ValueError:
+            logger.warning("Invalid date {}".format(value))
+            return 0
+    return round(value.timestamp() * 1000)
+
+def from_timestamp(value:int) -> datetime.datetime:
+    if value is not None:
+        return datetime.datetime.fromtimestamp(value / 1000)
+
+def to_enum(value, names:tuple) -> int:
+    if isinstance(value, int):
+        return value
+    if value in names:
+        return names.index(value)
+    logger.warning("Unknown value {}, using {}".format(value, names[0]))
+    return 0
+
+#Setup
+
+def create_tables(cursor):
+    for name, script in TABLES.items():
+        if not cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (name,)).fetchone():
+            cursor.execute(script)
+    # Used to load the messages of a chat one page at a time, ids sort by creation
+    cursor.execute("CREATE INDEX IF NOT EXISTS message_chat_id ON message (chat_id, id)")
+
+def rebuild_table(cursor, name:str, script:str, columns:str, condition:str):
+    """
+    SQLite can't add constraints to a table, it's copied into a new one, rows not matching condition are dropped
+    """
+    cursor.execute(script.format('new_{}'.format(name)))
+    cursor.execute("INSERT INTO new_{0} ({1}) SELECT {1} FROM {0} WHERE {2}".format(name, columns, condition))
+    dropped = cursor.execute("SELECT COUNT(*) FROM {}".format(name)).fetchone()[0] - cursor.execute("SELECT COUNT(*) FROM new_{}".format(name)).fetchone()[0]
+    if dropped:
+        logger.info("Dropped {} orphaned rows from {}".format(dropped, name))
+    cursor.execute("DROP TABLE {}".format(name))
+    cursor.execute("ALTER TABLE new_{0} RENAME TO {0}".format(name))
+
+def add_foreign_keys(cursor):
+    # Deleting a chat or a message removes everything that belongs to it, metrics are kept for the statistics
+    rebuild_table(cursor, 'message', """
+        CREATE TABLE {} (
+            id TEXT NOT NULL PRIMARY KEY,
+            chat_id TEXT NOT NULL REFERENCES chat (id) ON DELETE CASCADE,
+            role TEXT NOT NULL,
+            model TEXT,
+            date_time DATETIME NOT NULL,
+            content TEXT NOT NULL
+        )
+    """, "id, chat_id, role, model, date_time, content", "chat_id IN (SELECT id FROM chat)")
+    rebuild_table(cursor, 'attachment', """
+        CREATE TABLE {} (
+            id TEXT NOT NULL PRIMARY KEY,
+            message_id TEXT NOT NULL REFERENCES message (id) ON DELETE CASCADE,
+            type TEXT NOT NULL,
+            name TEXT NOT NULL,
+            content TEXT NOT NULL
+        )
+    """, "id, message_id, type, name, content", "message_id IN (SELECT id FROM message)")
+    cursor.execute("CREATE INDEX message_chat_id ON message (chat_id, id)")
+    cursor.execute("CREATE INDEX attachment_message_id ON attachment (message_id)")
+
+def add_last_activity(cursor):
+    # The chat list is sorted by the date of the newest message, triggers keep it up to date
+    cursor.execute("ALTER TABLE chat ADD COLUMN last_activity DATETIME")
+    cursor.execute("UPDATE chat SET last_activity=(SELECT MAX(date_time) FROM message WHERE chat_id=chat.id)")
+    cursor.execute("CREATE INDEX chat_last_activity ON chat (last_activity)")
+    create_activity_triggers(cursor)
+
+def create_activity_triggers(cursor):
+    cursor.execute("""
+        CREATE TRIGGER message_insert_activity AFTER INSERT ON message BEGIN
+            UPDATE chat SET last_activity=NEW.date_time WHERE id=NEW.chat_id AND (last_activity IS NULL OR last_activity < NEW.date_time);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER message_update_activity AFTER UPDATE OF date_time ON message BEGIN
+            UPDATE chat SET last_activity=NEW.date_time WHERE id=NEW.chat_id AND (last_activity IS NULL OR last_activity < NEW.date_time);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER message_delete_activity AFTER DELETE ON message BEGIN
+            UPDATE chat SET last_activity=(SELECT MAX(date_time) FROM message WHERE chat_id=OLD.chat_id) WHERE id=OLD.chat_id;
+        END
+    """)
+
+def copy_rows(cursor, name:str, columns:str, convert:callable):
+    """
+    Copies a table into new_{name} in batches, convert turns an old row into the new one
+    """
+    reader = cursor.connection.cursor()
+    reader.execute("SELECT {} FROM {} ORDER BY rowid".format(columns, name))
+    count = 0
+    while True:
+        rows = reader.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        cursor.executemany("INSERT INTO new_{} ({}) VALUES ({})".format(name, columns, ', '.join('?' * len(rows[0]))), [convert(row) for row in rows])
+        count += len(rows)
+    logger.info("Converted {} rows of {}".format(count, name))
+
+def compact_schema(cursor):
+    # Ids become 16 byte blobs, dates milliseconds since the epoch and roles and types small integers
+    cursor.execute("""
+        CREATE TABLE new_chat (
+            id BLOB NOT NULL PRIMARY KEY,
+            name TEXT NOT NULL,
+            last_activity INTEGER
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE new_message (
+            id BLOB NOT NULL PRIMARY KEY,
+            chat_id BLOB NOT NULL REFERENCES chat (id) ON DELETE CASCADE,
+            role INTEGER NOT NULL,
+            model TEXT,
+            date_time INTEGER NOT NULL,
+            content TEXT NOT NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE new_attachment (
+            id BLOB NOT NULL PRIMARY KEY,
+            message_id BLOB NOT NULL REFERENCES message (id) ON DELETE CASCADE,
+            type INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            content TEXT NOT NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE new_message_metrics (
+            message_id BLOB NOT NULL PRIMARY KEY,
+            model TEXT,
+            endpoint TEXT,
+            date_time INTEGER NOT NULL,
+            time_to_first_token REAL,
+            total_duration INTEGER,
+            load_duration INTEGER,
+            prompt_eval_count INTEGER,
+            prompt_eval_duration INTEGER,
+            eval_count INTEGER,
+            eval_duration INTEGER
+        )
+    """)
+    copy_rows(cursor, 'chat', "id, name, last_activity", lambda row: (to_id(row[0]), row[1], to_timestamp(row[2]) if row[2] else None))
+    copy_rows(cursor, 'message', "id, chat_id, role, model, date_time, content", lambda row: (to_id(row[0]), to_id(row[1]), to_enum(row[2], ROLES), row[3], to_timestamp(row[4]), row[5]))
+    copy_rows(cursor, 'attachment', "id, message_id, type, name, content", lambda row: (to_id(row[0]), to_id(row[1]), to_enum(row[2], ATTACHMENT_TYPES), row[3], row[4]))
+    copy_rows(cursor, 'message_metrics', "message_id, model, endpoint, date_time, time_to_first_token, total_duration, load_duration, prompt_eval_count, prompt_eval_duration, eval_count, eval_duration", lambda row: (to_id(row[0]), *row[1:3], to_timestamp(row[3]), *row[4:]))
+    for name in ('message_metrics', 'attachment', 'message', 'chat'):
+        cursor.execute("DROP TABLE {}".format(name))
+    for name in ('chat', 'message', 'attachment', 'message_metrics'):
+        cursor.execute("ALTER TABLE new_{0} RENAME TO {0}".format(name))
+    cursor.execute("CREATE INDEX message_chat_id ON message (chat_id, id)")
+    cursor.execute("CREATE INDEX attachment_message_id ON attachment (message_id)")
+    cursor.execute("CREATE INDEX chat_last_activity ON chat (last_activity)")
+    create_activity_triggers(cursor)
+
+# The schema version stored in the database is the number of migrations it went through, they are never edited once released
+MIGRATIONS = [
+    create_tables,
+    add_foreign_keys,
+    add_last_activity,
+    compact_schema
+]
+
+def migrate():
+    connection = get_connection()
+    version = connection.execute("PRAGMA user_version").fetchone()[0]
+    if version >= len(MIGRATIONS):
+        return
+    # Foreign keys can't be toggled inside a transaction and would get in the way of rebuilding tables
+    connection.execute("PRAGMA foreign_keys=OFF")
+    try:
+        for version in range(version, len(MIGRATIONS)):
+            migration = MIGRATIONS[version]
+            start_time = time.perf_counter()
+            cursor = connection.cursor()
+            # DDL statements don't open a transaction by themselves
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                migration(cursor)
+                violations = cursor.execute("PRAGMA foreign_key_check").fetchall()
+                if violations:
+                    raise sqlite3.IntegrityError("Foreign key violations after migration: {}".format(violations[:5]))
+                cursor.execute("PRAGMA user_version={}".format(version + 1))
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+            logger.info("Migrated database to version {} ({}) in {:.3f}s".format(version + 1, migration.__name__, time.perf_counter() - start_time))
+        # Rewritten tables leave free pages behind
+        start_time = time.perf_counter()
+        connection.execute("VACUUM")
+        logger.info("Vacuumed database in {:.3f}s".format(time.perf_counter() - start_time))
+    finally:
+        connection.execute("PRAGMA foreign_keys=ON")
+
+def setup(parser_version:int):
+    migrate()
+    remove_old_asts(parser_version)
+
+@transaction
+def remove_old_asts(cursor, parser_version:int):
+    # Blocks parsed by older versions of the parser are never read again
+    cursor.execute("DELETE FROM message_ast WHERE parser_version != ?", (parser_version,))
+
+#Preferences
+
+@transaction
+def get_preferences(cursor) -> dict:
+    preferences = {}
+    for row in cursor.execute("SELECT id, value, type FROM preferences").fetchall():
+        value = row[1]
+        if row[2] == "<class 'int'>":
+            value = int(value)
+        elif row[2] == "<class 'float'>":
+            value = float(value)
+        elif row[2] == "<class 'bool'>":
+            value = value == "1"
+        preferences[row[0]] = value
+    return preferences
+
+@transaction
+def get_preference(cursor, name:str):
+    row = cursor.execute("SELECT value FROM preferences WHERE id=?", (name,)).fetchone()
+    if row:
+        return row[0]
+
+@queued
+def set_preferences(cursor, preferences:dict):
+    cursor.executemany("INSERT OR REPLACE INTO preferences (id, value, type) VALUES (?, ?, ?)", [(name, value, str(type(value))) for name, value in preferences.items()])
+
+def set_preference(name:str, value):
+    set_preferences({name: value})
+
+@transaction
+def add_missing_preferences(cursor, preferences:dict):
+    cursor.executemany("INSERT OR IGNORE INTO preferences (id, value, type) VALUES (?, ?, ?)", [(name, value, str(type(value))) for name, value in preferences.items()])
+
+@transaction
+def get_overrides(cursor) -> dict:
+    return {row[0]: row[1] for row in cursor.execute("SELECT id, value FROM overrides").fetchall()}
+
+@queued
+def set_overrides(cursor, overrides:dict):
+    # Empty overrides are removed so they don't reach the instance as empty variables
+    cursor.executemany("INSERT OR REPLACE INTO overrides (id, value) VALUES (?, ?)", [(name, value) for name, value in overrides.items() if value])
+    cursor.executemany("DELETE FROM overrides WHERE id=?", [(name,) for name, value in overrides.items() if not value])
+
+def set_override(name:str, value:str):
+    set_overrides({name: value})
+
+#Endpoints
+
+@transaction
+def get_endpoints(cursor) -> list:
+    return cursor.execute("SELECT url, bearer_token FROM endpoint").fetchall()
+
+@queued
+def add_endpoint(cursor, url:str, bearer_token:str):
+    cursor.execute("INSERT OR REPLACE INTO endpoint (url, bearer_token) VALUES (?, ?)", (url, bearer_token))
+
+@queued
+def remove_endpoint(cursor, url:str):
+    cursor.execute("DELETE FROM endpoint WHERE url=?", (url,))
+
+#Models
+
+@transaction
+def get_model_picture(cursor, model_name:str) -> str:
+    row = cursor.execute("SELECT picture FROM model WHERE id=?", (model_name,)).fetchone()
+    if row:
+        return row[0]
+
+@queued
+def set_model_picture(cursor, model_name:str, picture:str):
+    cursor.execute("INSERT OR REPLACE INTO model (id, picture) VALUES (?, ?)", (model_name, picture))
+
+@queued
+def remove_model_picture(cursor, model_name:str):
+    cursor.execute("DELETE FROM model WHERE id=?", (model_name,))
+
+#Chats
+
+@transaction
+def get_chats(cursor) -> list:
+    """
+    Returns (id, name, last activity) of every chat, most recent first
+    """
+    return [(from_id(row[0]), row[1], from_timestamp(row[2])) for row in cursor.execute("SELECT id, name, last_activity FROM chat ORDER BY last_activity DESC")]
+
+@queued
+def add_chat(cursor, chat_id:str, name:str):
+    cursor.execute("INSERT INTO chat (id, name) VALUES (?, ?)", (to_id(chat_id), name))
+
+@queued
+def rename_chat(cursor, chat_id:str, name:str):
+    cursor.execute("UPDATE chat SET name=? WHERE id=?", (name, to_id(chat_id)))
+
+def remove_unused_asts(cursor, contents:list, get_hash:callable):
+    """
+    Messages with the same content share their parsed blocks, they are only removed once no message uses them
+    """
+    contents = list(set(content for content in contents if content))
+    used = set()
+    for chunk, placeholders in chunks(contents):
+        used.update(row[0] for row in cursor.execute("SELECT content FROM message WHERE content IN ({})".format(placeholders), chunk))
+    cursor.executemany("DELETE FROM message_ast WHERE hash=?", [(get_hash(content),) for content in contents if content not in used])
+
+@queued
+def delete_chat(cursor, chat_id:str, get_hash:callable):
+    contents = [row[0] for row in cursor.execute("SELECT content FROM message WHERE chat_id=?", (to_id(chat_id),)).fetchall()]
+    # Messages and attachments are removed by the foreign keys
+    cursor.execute("DELETE FROM chat WHERE id=?", (to_id(chat_id),))
+    remove_unused_asts(cursor, contents, get_hash)
+
+@queued
+def duplicate_chat(cursor, chat_id:str, new_chat_id:str, new_name:str, generate_id:callable):
+    cursor.execute("INSERT INTO chat (id, name) VALUES (?, ?)", (to_id(new_chat_id), new_name))
+    # New ids are generated in order so the copies keep the order the messages were created in
+    for message in cursor.execute("SELECT id, role, model, date_time, content FROM message WHERE chat_id=? ORDER BY id", (to_id(chat_id),)).fetchall():
+        new_message_id = to_id(generate_id())
+        cursor.execute("INSERT INTO message (id, chat_id, role, model, date_time, content) VALUES (?, ?, ?, ?, ?, ?)",
+            (new_message_id, to_id(new_chat_id), message[1], message[2], message[3], message[4]))
+        for attachment in cursor.execute("SELECT type, name, content FROM attachment WHERE message_id=?", (message[0],)).fetchall():
+            cursor.execute("INSERT INTO attachment (id, message_id, type, name, content) VALUES (?, ?, ?, ?, ?)",
+                (to_id(generate_id()), new_message_id, attachment[0], attachment[1], attachment[2]))
+
+@flushed
+@transaction
+def export_chat(cursor, chat_id:str, path:str):
+    cursor.execute("ATTACH DATABASE ? AS export", (path,))
+    try:
+        for name in ('chat', 'message', 'attachment'):
+            cursor.execute(TABLES[name].replace('CREATE TABLE ', 'CREATE TABLE export.', 1))
+        cursor.executemany("INSERT INTO export.chat (id, name) VALUES (?, ?)",
+            [(from_id(row[0]), row[1]) for row in cursor.execute("SELECT id, name FROM chat WHERE id=?", (to_id(chat_id),)).fetchall()])
+        cursor.executemany("INSERT INTO export.message (id, chat_id, role, model, date_time, content) VALUES (?, ?, ?, ?, ?, ?)",
+            [(from_id(row[0]), from_id(row[1]), ROLES[row[2]], row[3], from_timestamp(row[4]).strftime("%Y/%m/%d %H:%M:%S"), row[5]) for row in cursor.execute("SELECT id, chat_id, role, model, date_time, content FROM message WHERE chat_id=?", (to_id(chat_id),)).fetchall()])
+        cursor.executemany("INSERT INTO export.attachment (id, message_id, type, name, content) VALUES (?, ?, ?, ?, ?)",
+            [(from_id(row[0]), from_id(row[1]), ATTACHMENT_TYPES[row[2]], row[3], row[4]) for row in cursor.execute("SELECT a.id, a.message_id, a.type, a.name, a.content FROM attachment as a JOIN message m ON a.message_id = m.id WHERE m.chat_id=?", (to_id(chat_id),)).fetchall()])
+        cursor.connection.commit()
+    finally:
+        # Nothing is left to roll back if it succeeded, a database can't be detached during a transaction
+        cursor.connection.rollback()
+        cursor.execute("DETACH DATABASE export")
+
+@flushed
+@transaction
+def import_chats(cursor, path:str, generate_name:callable, generate_id:callable) -> list:
+    """
+    Copies every chat of an exported database, returns the (id, name) of the imported chats
+    """
+    cursor.execute("ATTACH DATABASE ? AS import", (path,))
+    try:
+        chat_names = [row[0] for row in cursor.execute("SELECT name FROM chat").fetchall()]
+        chat_ids = {}
+        chats = []
+        for chat_id, name in cursor.execute("SELECT id, name FROM import.chat").fetchall():
+            # Repeated names and ids are replaced
+            new_id = to_id(chat_id)
+            if cursor.execute("SELECT 1 FROM chat WHERE id=?", (new_id,)).fetchone():
+                new_id = to_id(generate_id())
+            if name in chat_names:
+                name = generate_name(name)
+            chat_ids[chat_id] = new_id
+            chat_names.append(name)
+            chats.append((new_id, name))
+        cursor.executemany("INSERT INTO chat (id, name) VALUES (?, ?)", chats)
+
+        message_ids = {}
+        used_ids = set()
+        messages = []
+        # Rows that don't belong to an imported chat would break the foreign keys
+        for row in cursor.execute("SELECT id, chat_id, role, model, date_time, content FROM import.message ORDER BY id").fetchall():
+            if row[1] not in chat_ids:
+                continue
+            new_id = to_id(row[0])
+            if new_id in used_ids or cursor.execute("SELECT 1 FROM message WHERE id=?", (new_id,)).fetchone():
+                new_id = to_id(generate_id())
+            message_ids[row[0]] = new_id
+            used_ids.add(new_id)
+            messages.append((new_id, chat_ids[row[1]], to_enum(row[2], ROLES), row[3], to_timestamp(row[4]), row[5]))
+        cursor.executemany("INSERT INTO message (id, chat_id, role, model, date_time, content) VALUES (?, ?, ?, ?, ?, ?)", messages)
+
+        attachments = []
+        for row in cursor.execute("SELECT id, message_id, type, name, content FROM import.attachment").fetchall():
+            if row[1] not in message_ids:
+                continue
+            new_id = to_id(row[0])
+            if cursor.execute("SELECT 1 FROM attachment WHERE id=?", (new_id,)).fetchone():
+                new_id = to_id(generate_id())
+            attachments.append((new_id, message_ids[row[1]], to_enum(row[2], ATTACHMENT_TYPES), row[3], row[4]))
+        cursor.executemany("INSERT INTO attachment (id, message_id, type, name, content) VALUES (?, ?, ?, ?, ?)", attachments)
+        cursor.connection.commit()
+        return [(from_id(chat_id), name) for chat_id, name in chats]
+    finally:
+        # Nothing is left to roll back if it succeeded, a database can't be detached during a transaction
+        cursor.connection.rollback()
+        cursor.execute("DETACH DATABASE import")
+
+#Messages
+
+def select_messages(cursor, chat_id:str, limit:int, before:str) -> list:
+    # Messages are ordered by their id since date_time changes when a response finishes
+    if before:
+        rows = cursor.execute("SELECT id, role, model, date_time, content FROM message WHERE chat_id=? AND id < ? ORDER BY id DESC LIMIT ?", (to_id(chat_id), to_id(before), limit))
+    else:
+        rows = cursor.execute("SELECT id, role, model, date_time, content FROM message WHERE chat_id=? ORDER BY id DESC LIMIT ?", (to_id(chat_id), limit))
+    return [(from_id(row[0]), ROLES[row[1]], row[2], from_timestamp(row[3]), row[4]) for row in rows]
+
+def select_attachments(cursor, message_ids:list) -> dict:
+    attachments = {}
+    for chunk, placeholders in chunks([to_id(message_id) for message_id in message_ids]):
+        for row in cursor.execute("SELECT message_id, type, name, content FROM attachment WHERE message_id IN ({})".format(placeholders), chunk):
+            attachments.setdefault(from_id(row[0]), []).append((ATTACHMENT_TYPES[row[1]], row[2], row[3]))
+    return attachments
+
+@flushed
+@transaction
+def get_message_page(cursor, chat_id:str, limit:int=-1, before:str=None) -> tuple:
+    """
+    Returns (id, role, model, date_time, content) of the newest messages, optionally older than the message with the given id,
+    and the (type, name, content) of their attachments by message id, fetched with batched queries
+    """
+    messages = select_messages(cursor, chat_id, limit, before)
+    return messages, select_attachments(cursor, [row[0] for row in messages])
+
+@queued
+def add_messages(cursor, messages:list, attachments:list=None):
+    """
+    messages: (id, chat_id, role, model, date_time, content)
+    attachments: (id, message_id, type, name, content)
+    """
+    cursor.executemany("INSERT INTO message (id, chat_id, role, model, date_time, content) VALUES (?, ?, ?, ?, ?, ?)",
+        [(to_id(row[0]), to_id(row[1]), to_enum(row[2], ROLES), row[3], to_timestamp(row[4]), row[5]) for row in messages])
+    cursor.executemany("INSERT INTO attachment (id, message_id, type, name, content) VALUES (?, ?, ?, ?, ?)",
+        [(to_id(row[0]), to_id(row[1]), to_enum(row[2], ATTACHMENT_TYPES), row[3], row[4]) for row in attachments or []])
+
+@queued
+def update_message(cursor, message_id:str, date_time:datetime.datetime=None, content:str=None, ast:tuple=None, get_hash:callable=None):
+    """
+    ast: (hash, parser_version, blocks) of the new content
+    get_hash: given when the previous content could have parsed blocks, they are removed once no message uses them
+    """
+    if date_time is not None:
+        cursor.execute("UPDATE message SET date_time=? WHERE id=?", (to_timestamp(date_time), to_id(message_id)))
+    if content is not None:
+        previous = cursor.execute("SELECT content FROM message WHERE id=?", (to_id(message_id),)).fetchone() if get_hash else None
+        cursor.execute("UPDATE message SET content=? WHERE id=?", (content, to_id(message_id)))
+        if previous and previous[0] != content:
+            remove_unused_asts(cursor, [previous[0]], get_hash)
+    if ast:
+        cursor.execute("INSERT OR REPLACE INTO message_ast (hash, parser_version, blocks) VALUES (?, ?, ?)", ast)
+
+@queued
+def delete_message(cursor, message_id:str, get_hash:callable):
+    contents = [row[0] for row in cursor.execute("SELECT content FROM message WHERE id=?", (to_id(message_id),)).fetchall()]
+    cursor.execute("DELETE FROM message WHERE id=?", (to_id(message_id),))
+    remove_unused_asts(cursor, contents, get_hash)
+
+@transaction
+def get_message_asts(cursor, hashes:list, parser_version:int) -> dict:
+    blocks = {}
+    for chunk, placeholders in chunks(hashes):
+        for row in cursor.execute("SELECT hash, blocks FROM message_ast WHERE parser_version=? AND hash IN ({})".format(placeholders), (parser_version, *chunk)):
+            blocks[row[0]] = row[1]
+    return blocks
+
+@queued
+def add_message_asts(cursor, asts:list):
+    """
+    asts: (hash, parser_version, blocks)
+    """
+    cursor.executemany("INSERT OR REPLACE INTO message_ast (hash, parser_version, blocks) VALUES (?, ?, ?)", asts)
+
+#Metrics
+
+@flushed
+@transaction
+def get_message_metrics(cursor, message_id:str) -> tuple:
+    return cursor.execute("SELECT model, endpoint, time_to_first_token, total_duration, load_duration, prompt_eval_count, prompt_eval_duration, eval_count, eval_duration FROM message_metrics WHERE message_id=?", (to_id(message_id),)).fetchone()
+
+@queued
+def set_message_metrics(cursor, message_id:str, model:str, endpoint:str, date_time:datetime.datetime, time_to_first_token:float, metrics:dict):
+    cursor.execute("INSERT OR REPLACE INTO message_metrics (message_id, model, endpoint, date_time, time_to_first_token, total_duration, load_duration, prompt_eval_count, prompt_eval_duration, eval_count, eval_duration) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (to_id(message_id), model, endpoint, to_timestamp(date_time), time_to_first_token, metrics['total_duration'], metrics['load_duration'], metrics['prompt_eval_count'], metrics['prompt_eval_duration'], metrics['eval_count'], metrics['eval_duration']))
+
+@transaction
+def get_metrics_summary(cursor) -> list:
+    """
+    Returns the average metrics per day and model
+    """
+    try:
+        return cursor.execute("SELECT date(date_time / 1000, 'unixepoch', 'localtime') AS day, model, COUNT(*), AVG(time_to_first_token), AVG(load_duration) / 1e9, SUM(prompt_eval_count) / (SUM(prompt_eval_duration) / 1e9), SUM(eval_count) / (SUM(eval_duration) / 1e9) FROM message_metrics GROUP BY day, model ORDER BY day DESC, model").fetchall()
+    except sqlite3.OperationalError:
+        return []
+
+if __name__ == '__main__':
+    # Benchmark of hydrating a chat with 10k messages, run with 'python3 -m src.storage' from the repository
+    import tempfile, shutil
+
+    DB_PATH = os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+    migrate()
+    chat_id = generate_id()
+    add_chat(chat_id, 'Benchmark')
+    messages = []
+    attachments = []
+    start_date = datetime.datetime.now() - datetime.timedelta(days=30)
+    for i in range(10000):
+        message_id = generate_id()
+        messages.append((message_id, chat_id, ROLES[i % 2], 'llama3.2:latest' if i % 2 else None, start_date + datetime.timedelta(minutes=i), 'Message {} '.format(i) * 20))
+        if i % 5 == 0:
+            attachments.append((generate_id(), message_id, 'plain_text', 'file_{}.txt'.format(i), 'Attachment {} '.format(i) * 50))
+    add_messages(messages, attachments)
+    flush()
+
+    def per_message(cursor):
+        # What hydration did before, one query for the attachments of every message
+        rows = select_messages(cursor, chat_id, -1, None)
+        return rows, {row[0]: cursor.execute("SELECT type, name, content FROM attachment WHERE message_id=?", (to_id(row[0]),)).fetchall() for row in rows}
+
+    connection = get_connection()
+    for label, function in (
+        ('per message', lambda: run_transaction(connection, 'per_message', per_message)),
+        ('get_message_page', lambda: get_message_page(chat_id))
+    ):
+        statements = []
+        connection.set_trace_callback(statements.append)
+        function()
+        connection.set_trace_callback(None)
+        queries = sum(1 for statement in statements if statement.lstrip().upper().startswith('SELECT'))
+        elapsed = []
+        for run in range(5):
+            start = time.perf_counter()
+            function()
+            elapsed.append(time.perf_counter() - start)
+        print('{:18} {:6} queries {:8.1f} ms'.format(label, queries, min(elapsed) * 1000))
+    close_connection()
+    shutil.rmtree(os.path.dirname(DB_PATH))
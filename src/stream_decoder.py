@@ -0,0 +1,98 @@
+# stream_decoder.py
+"""
+Incremental decoder for the newline delimited JSON streams sent by Ollama
+"""
+import json
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    orjson = None
+    loads = json.loads
+
+# Ollama streams with chunked transfer encoding, reads return as soon as a chunk arrives, this only caps their size
+READ_SIZE = 64 * 1024
+
+class ndjson_decoder():
+    """
+    Splits raw bytes into lines and decodes every complete one, the unfinished tail is kept for the next feed
+    """
+
+    def __init__(self):
+        self.buffer = b''
+
+    def feed(self, data:bytes) -> list:
+        if self.buffer:
+            data = self.buffer + data
+        lines = data.split(b'\n')
+        self.buffer = lines.pop()
+        return [loads(line) for line in lines if line.strip()]
+
+    def flush(self) -> list:
+        data = self.buffer
+        self.buffer = b''
+        if data.strip():
+            return [loads(data)]
+        return []
+
+def iter_batches(response, cancelled:callable=None, read_size:int=READ_SIZE):
+    """
+    Yields a list with every chunk decoded from each read of a streamed response
+    """
+    decoder = ndjson_decoder()
+    for data in response.iter_content(chunk_size=read_size):
+        if cancelled and cancelled():
+            return
+        chunks = decoder.feed(data)
+        if chunks:
+            yield chunks
+    chunks = decoder.flush()
+    if chunks:
+        yield chunks
+
+if __name__ == '__main__':
+    # Micro-benchmark against the previous iter_lines loop, run with 'python3 stream_decoder.py'
+    import io, time
+
+    class fake_response():
+        def __init__(self, payload:bytes, read_size:int):
+            self.payload = payload
+            self.read_size = read_size
+
+        def iter_content(self, chunk_size:int=1):
+            stream = io.BytesIO(self.payload)
+            while True:
+                data = stream.read(min(chunk_size, self.read_size))
+                if not data:
+                    return
+                yield data
+
+        def iter_lines(self, chunk_size:int=512):
+            # Same as requests.Response.iter_lines with its default chunk size
+            pending = None
+            for data in self.iter_content(chunk_size):
+                if pending is not None:
+                    data = pending + data
+                lines = data.splitlines()
+                if lines and lines[-1] and data and lines[-1][-1] == data[-1]:
+                    pending = lines.pop()
+                else:
+                    pending = None
+                yield from lines
+            if pending is not None:
+                yield pending
+
+    token = {"model": "llama3.2:latest", "created_at": "2024-10-17T12:00:00.000000Z", "message": {"role": "assistant", "content": " token"}, "done": False}
+    progress = {"status": "pulling 6a0746a1ec1a", "digest": "sha256:6a0746a1ec1aef3e7ec53868f220ff6e389f6f8ef87a01d77c96807de94ca2aa", "total": 2019377376, "completed": 1048576}
+    for name, chunk in (('chat', token), ('pull', progress)):
+        payload = b''.join(json.dumps(chunk).encode('utf-8') + b'\n' for i in range(50000))
+        # Simulates a network read returning around 4 KiB at a time
+        for label, function in (
+            ('iter_lines + json.loads', lambda response: sum(1 for line in response.iter_lines() if line and json.loads(line.decode('utf-8')))),
+            ('iter_batches ({})'.format('orjson' if orjson else 'json'), lambda response: sum(len(chunks) for chunks in iter_batches(response)))
+        ):
+            start = time.perf_counter()
+            count = function(fake_response(payload, 4096))
+            elapsed = time.perf_counter() - start
+            print('{:5} {:28} {:7} lines {:8.1f} ms {:10.0f} lines/s'.format(name, label, count, elapsed * 1000, count / elapsed))
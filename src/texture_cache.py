@@ -0,0 +1,94 @@
+# texture_cache.py
+"""
+Decodes base64 images into textures once and shares them between every widget showing them
+"""
+import gi
+gi.require_version('Gdk', '4.0')
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import Gdk, GdkPixbuf, GLib
+import base64, hashlib, logging, threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Decoded textures are evicted, least recently used first, once they go over this size
+MAX_CACHE_SIZE = 128 * 1024 * 1024
+# Thumbnails keep twice the display size so they stay sharp on scaled displays
+THUMBNAIL_SCALE = 2
+
+class texture_cache():
+    """
+    Textures are keyed by the hash of their base64 content and the size they are displayed at
+    """
+
+    def __init__(self, max_size:int=MAX_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.textures = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='texture')
+
+    def get_key(self, content:str, size:int) -> tuple:
+        return (hashlib.sha256(content.encode('utf-8')).hexdigest(), size)
+
+    def lookup(self, key:tuple) -> Gdk.Texture:
+        with self.lock:
+            texture = self.textures.get(key)
+            if texture:
+                self.textures.move_to_end(key)
+            return texture
+
+    def store(self, key:tuple, texture:Gdk.Texture):
+        with self.lock:
+            if key in self.textures:
+                return
+            self.textures[key] = texture
+            self.size += texture.get_width() * texture.get_height() * 4
+            while self.size > self.max_size and len(self.textures) > 1:
+                old_key, old_texture = self.textures.popitem(last=False)
+                self.size -= old_texture.get_width() * old_texture.get_height() * 4
+
+    def decode(self, content:str, size:int=None) -> Gdk.Texture:
+        loader = GdkPixbuf.PixbufLoader.new()
+        loader.write(base64.b64decode(content))
+        loader.close()
+        pixbuf = loader.get_pixbuf()
+        if size:
+            # Only the size the image is shown at is kept, the full image is decoded on demand by the preview
+            target = size * THUMBNAIL_SCALE
+            ratio = target / max(pixbuf.get_width(), pixbuf.get_height())
+            if ratio < 1:
+                pixbuf = pixbuf.scale_simple(max(1, round(pixbuf.get_width() * ratio)), max(1, round(pixbuf.get_height() * ratio)), GdkPixbuf.InterpType.BILINEAR)
+        return Gdk.Texture.new_for_pixbuf(pixbuf)
+
+    def load_texture(self, content:str, size:int, callback:callable):
+        """
+        Calls callback(texture) in the main thread, texture is None if the image can't be decoded
+        """
+        key = self.get_key(content, size)
+        texture = self.lookup(key)
+        if texture:
+            callback(texture)
+            return
+        with self.lock:
+            if key in self.pending:
+                self.pending[key].append(callback)
+                return
+            self.pending[key] = [callback]
+        self.executor.submit(self.decode_in_background, key, content, size)
+
+    def decode_in_background(self, key:tuple, content:str, size:int):
+        texture = None
+        try:
+            texture = self.decode(content, size)
+            self.store(key, texture)
+        except Exception as e:
+            logger.error(e)
+        with self.lock:
+            callbacks = self.pending.pop(key, [])
+        for callback in callbacks:
+            GLib.idle_add(callback, texture)
+
+shared_cache = texture_cache()
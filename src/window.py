@@ -19,7 +19,7 @@
 """
 Handles the main window
 """
-import json, threading, os, re, base64, gettext, uuid, shutil, logging, time, requests, sqlite3
+import json, threading, os, re, base64, gettext, shutil, logging, time, requests
 import odf.opendocument as odfopen
 import odf.table as odftable
 from io import BytesIO
@@ -34,7 +34,7 @@ gi.require_version('GdkPixbuf', '2.0')
 gi.require_version('Spelling', '1')
 from gi.repository import Adw, Gtk, Gdk, GLib, GtkSource, Gio, GdkPixbuf, Spelling
 
-from . import connection_handler, generic_actions
+from . import connection_handler, generic_actions, markdown_parser, texture_cache, storage
 from .custom_widgets import message_widget, chat_widget, model_widget, terminal_widget, dialog_widget
 from .internal import config_dir, data_dir, cache_dir, source_dir
 
@@ -53,6 +53,7 @@ class AlpacaWindow(Adw.ApplicationWindow):
 
     #Variables
     attachments = {}
+    file_preview_id = 0 # Increased with every preview so slow decodes don't replace a newer one
 
     #Override elements
     overrides_group = Gtk.Template.Child()
@@ -116,6 +117,7 @@ class AlpacaWindow(Adw.ApplicationWindow):
     default_model_list = Gtk.Template.Child()
     model_directory_selector = Gtk.Template.Child()
     remote_connection_selector = Gtk.Template.Child()
+    endpoints_group = Gtk.Template.Child()
     model_tag_flow_box = Gtk.Template.Child()
 
     chat_list_container = Gtk.Template.Child()
@@ -126,6 +128,8 @@ class AlpacaWindow(Adw.ApplicationWindow):
 
     background_switch = Gtk.Template.Child()
     powersaver_warning_switch = Gtk.Template.Child()
+    preload_switch = Gtk.Template.Child()
+    live_chats_spin = Gtk.Template.Child()
     remote_connection_switch = Gtk.Template.Child()
 
     banner = Gtk.Template.Child()
@@ -137,7 +141,6 @@ class AlpacaWindow(Adw.ApplicationWindow):
     quick_ask_overlay = Gtk.Template.Child()
     quick_ask_save_button = Gtk.Template.Child()
 
-    sqlite_path = os.path.join(data_dir, "alpaca.db")
 
     @Gtk.Template.Callback()
     def remote_connection_selector_clicked(self, button):
@@ -157,6 +160,16 @@ class AlpacaWindow(Adw.ApplicationWindow):
             entries
         )
 
+    @Gtk.Template.Callback()
+    def add_endpoint_clicked(self, button):
+        dialog_widget.simple_entry(
+            _('Add Instance'),
+            _('Enter instance information to continue'),
+            lambda url, bearer: generic_actions.add_endpoint(url, bearer),
+            [{'placeholder': _('Server URL')}, {'placeholder': _('Bearer Token (Optional)')}],
+            _('Add')
+        )
+
     @Gtk.Template.Callback()
     def model_directory_selector_clicked(self, button):
         def directory_selected(result):
@@ -166,11 +179,7 @@ class AlpacaWindow(Adw.ApplicationWindow):
             self.model_directory_selector.set_subtitle(selected_directory)
             if not self.ollama_instance.remote:
                 self.ollama_instance.reset()
-            sqlite_con = sqlite3.connect(self.sqlite_path)
-            cursor = sqlite_con.cursor()
-            cursor.execute("UPDATE preferences SET value=?, type=? WHERE id=?", (self.ollama_instance.model_directory, str(type(self.ollama_instance.model_directory)), "model_directory"))
-            sqlite_con.commit()
-            sqlite_con.close()
+            storage.set_preference("model_directory", self.ollama_instance.model_directory)
             self.refresh_local_models()
             button.set_sensitive(True)
         dialog_widget.simple_directory(directory_selected)
@@ -201,18 +210,15 @@ class AlpacaWindow(Adw.ApplicationWindow):
             self.show_toast(_("Please select a model before chatting"), self.main_overlay)
             return
 
-        sqlite_con = sqlite3.connect(self.sqlite_path)
-        cursor = sqlite_con.cursor()
-
         message_id = self.generate_uuid()
+        attachments = []
 
         raw_message = self.message_text_view.get_buffer().get_text(self.message_text_view.get_buffer().get_start_iter(), self.message_text_view.get_buffer().get_end_iter(), False)
         current_chat.add_message(message_id, None, system)
         m_element = current_chat.messages[message_id]
 
         for name, content in self.attachments.items():
-            cursor.execute("INSERT INTO attachment (id, message_id, type, name, content) VALUES (?, ?, ?, ?, ?)",(
-                self.generate_uuid(), message_id, content['type'], name, content['content']))
+            attachments.append((self.generate_uuid(), message_id, content['type'], name, content['content']))
             m_element.add_attachment(name, content['type'], content['content'])
             content["button"].get_parent().remove(content["button"])
         self.attachments = {}
@@ -221,8 +227,7 @@ class AlpacaWindow(Adw.ApplicationWindow):
         m_element.set_text(raw_message)
         m_element.add_footer(datetime.now())
 
-        cursor.execute("INSERT INTO message (id, chat_id, role, model, date_time, content) VALUES (?, ?, ?, ?, ?, ?)",
-                (m_element.message_id, current_chat.chat_id, 'system' if system else 'user', None, m_element.dt.strftime("%Y/%m/%d %H:%M:%S"), m_element.text))
+        messages = [(m_element.message_id, current_chat.chat_id, 'system' if system else 'user', None, m_element.dt, m_element.text)]
 
         self.message_text_view.get_buffer().set_text("", 0)
 
@@ -230,6 +235,7 @@ class AlpacaWindow(Adw.ApplicationWindow):
             if current_chat.welcome_screen:
                 current_chat.welcome_screen.set_visible(False)
         else:
+            older_than = current_chat.get_unloaded_key()
             data = {
                 "model": current_model,
                 "messages": current_chat.convert_to_ollama(),
@@ -244,12 +250,11 @@ class AlpacaWindow(Adw.ApplicationWindow):
             current_chat.add_message(bot_id, current_model, False)
             m_element_bot = current_chat.messages[bot_id]
             m_element_bot.set_text()
-            cursor.execute("INSERT INTO message (id, chat_id, role, model, date_time, content) VALUES (?, ?, ?, ?, ?, ?)",
-                (m_element_bot.message_id, current_chat.chat_id, 'assistant', current_model, m_element.dt.strftime("%Y/%m/%d %H:%M:%S"), '(No Text)'))
-            threading.Thread(target=self.run_message, args=(data, m_element_bot, current_chat)).start()
+            messages.append((m_element_bot.message_id, current_chat.chat_id, 'assistant', current_model, m_element.dt, '(No Text)'))
 
-        sqlite_con.commit()
-        sqlite_con.close()
+        storage.add_messages(messages, attachments)
+        if not system:
+            threading.Thread(target=self.run_message, args=(data, m_element_bot, current_chat, False, older_than)).start()
 
     @Gtk.Template.Callback()
     def welcome_carousel_page_changed(self, carousel, index):
@@ -276,23 +281,17 @@ class AlpacaWindow(Adw.ApplicationWindow):
         else:
             self.welcome_dialog.force_close()
             self.powersaver_warning_switch.set_active(True)
-            sqlite_con = sqlite3.connect(self.sqlite_path)
-            cursor = sqlite_con.cursor()
-            cursor.execute("UPDATE preferences SET value=?, type=? WHERE id=?", (not shutil.which('ollama'), str(type(not shutil.which('ollama'))), "run_remote"))
-            cursor.execute("UPDATE preferences SET value=?, type=? WHERE id=?", (False, str(type(False)), "show_welcome_dialog"))
-            sqlite_con.commit()
-            sqlite_con.close()
+            storage.set_preferences({
+                "run_remote": not shutil.which('ollama'),
+                "show_welcome_dialog": False
+            })
             threading.Thread(target=self.prepare_alpaca).start()
 
     @Gtk.Template.Callback()
     def switch_run_on_background(self, switch, user_data):
         logger.debug("Switching run on background")
         self.set_hide_on_close(switch.get_active())
-        sqlite_con = sqlite3.connect(self.sqlite_path)
-        cursor = sqlite_con.cursor()
-        cursor.execute("UPDATE preferences SET value=?, type=? WHERE id=?", (switch.get_active(), str(type(switch.get_active())), "run_on_background"))
-        sqlite_con.commit()
-        sqlite_con.close()
+        storage.set_preference("run_on_background", switch.get_active())
     
     @Gtk.Template.Callback()
     def switch_powersaver_warning(self, switch, user_data):
@@ -301,35 +300,47 @@ class AlpacaWindow(Adw.ApplicationWindow):
             self.banner.set_revealed(Gio.PowerProfileMonitor.dup_default().get_power_saver_enabled())
         else:
             self.banner.set_revealed(False)
-        sqlite_con = sqlite3.connect(self.sqlite_path)
-        cursor = sqlite_con.cursor()
-        cursor.execute("UPDATE preferences SET value=?, type=? WHERE id=?", (switch.get_active(), str(type(switch.get_active())), "powersaver_warning"))
-        sqlite_con.commit()
-        sqlite_con.close()
+        storage.set_preference("powersaver_warning", switch.get_active())
+
+    @Gtk.Template.Callback()
+    def switch_preload_models(self, switch, user_data):
+        logger.debug("Switching model preloading")
+        if self.ollama_instance:
+            self.ollama_instance.preload_enabled = switch.get_active()
+            self.preload_selected_model()
+        storage.set_preference("preload_models", switch.get_active())
+
+    @Gtk.Template.Callback()
+    def live_chats_spin_changed(self, spin):
+        self.chat_list_box.max_live_chats = round(spin.get_value())
+        self.chat_list_box.trim_live_chats()
+        storage.set_preference("max_live_chats", self.chat_list_box.max_live_chats)
+
+    def preload_selected_model(self):
+        if self.ollama_instance and self.ollama_instance.preload_enabled and self.model_manager:
+            self.ollama_instance.preload_model(self.model_manager.get_selected_model())
+
+    def message_buffer_changed(self, buffer):
+        # Only the first keystroke of a new message is a useful hint
+        if buffer.get_char_count() == 1:
+            self.preload_selected_model()
 
     @Gtk.Template.Callback()
     def changed_default_model(self, comborow, user_data):
         logger.debug("Changed default model")
         default_model = self.convert_model_name(self.default_model_list.get_string(self.default_model_combo.get_selected()), 1)
-        sqlite_con = sqlite3.connect(self.sqlite_path)
-        cursor = sqlite_con.cursor()
-        cursor.execute("UPDATE preferences SET value=?, type=? WHERE id=?", (default_model, str(type(default_model)), "default_model"))
-        sqlite_con.commit()
-        sqlite_con.close()
+        storage.set_preference("default_model", default_model)
 
     @Gtk.Template.Callback()
     def closing_app(self, user_data):
         selected_chat = self.chat_list_box.get_selected_row().chat_window.get_name()
-        sqlite_con = sqlite3.connect(self.sqlite_path)
-        cursor = sqlite_con.cursor()
-        cursor.execute("UPDATE preferences SET value=?, type=? WHERE id=?", (selected_chat, str(type(selected_chat)), 'selected_chat'))
-        sqlite_con.commit()
-        sqlite_con.close()
+        storage.set_preference('selected_chat', selected_chat)
         if self.get_hide_on_close():
             logger.info("Hiding app...")
         else:
             logger.info("Closing app...")
             self.ollama_instance.stop()
+            storage.flush()
             self.get_application().quit()
 
     @Gtk.Template.Callback()
@@ -341,20 +352,12 @@ class AlpacaWindow(Adw.ApplicationWindow):
             value = round(value, 1)
         if self.ollama_instance.tweaks[spin.get_name()] != value:
             self.ollama_instance.tweaks[spin.get_name()] = value
-            sqlite_con = sqlite3.connect(self.sqlite_path)
-            cursor = sqlite_con.cursor()
-            cursor.execute("UPDATE preferences SET value=?, type=? WHERE id=?", (value, str(type(value)), spin.get_name()))
-            sqlite_con.commit()
-            sqlite_con.close()
+            storage.set_preference(spin.get_name(), value)
 
     @Gtk.Template.Callback()
     def instance_idle_timer_changed(self, spin):
         self.ollama_instance.idle_timer_delay = round(spin.get_value())
-        sqlite_con = sqlite3.connect(self.sqlite_path)
-        cursor = sqlite_con.cursor()
-        cursor.execute("UPDATE preferences SET value=?, type=? WHERE id=?", (self.ollama_instance.idle_timer_delay, str(type(self.ollama_instance.idle_timer_delay)), "idle_timer"))
-        sqlite_con.commit()
-        sqlite_con.close()
+        storage.set_preference("idle_timer", self.ollama_instance.idle_timer_delay)
 
     @Gtk.Template.Callback()
     def create_model_start(self, button):
@@ -379,11 +382,7 @@ class AlpacaWindow(Adw.ApplicationWindow):
                 del self.ollama_instance.overrides[name]
             if not self.ollama_instance.remote:
                 self.ollama_instance.reset()
-            sqlite_con = sqlite3.connect(self.sqlite_path)
-            cursor = sqlite_con.cursor()
-            cursor.execute("UPDATE overrides SET value=? WHERE id=?", (value, name))
-            sqlite_con.commit()
-            sqlite_con.close()
+            storage.set_override(name, value)
 
     @Gtk.Template.Callback()
     def link_button_handler(self, button):
@@ -424,10 +423,16 @@ class AlpacaWindow(Adw.ApplicationWindow):
         if not current_chat:
             current_chat = self.chat_list_box.get_current_chat()
         if current_chat:
+            self.chat_list_box.hydrate_chat(current_chat)
+            if search_term and (current_chat.has_older or current_chat.loading):
+                # Every message has to be loaded to be searched, the search runs again once they are
+                current_chat.load_older_messages(-1, lambda: self.message_search_changed(entry, current_chat))
             try:
                 for key, message in current_chat.messages.items():
                     if message and message.text:
                         message.set_visible(re.search(search_term, message.text, re.IGNORECASE))
+                        if search_term and message.get_visible():
+                            message.load()
                         for block in message.content_children:
                             if isinstance(block, message_widget.text_block):
                                 if search_term:
@@ -442,6 +447,49 @@ class AlpacaWindow(Adw.ApplicationWindow):
     def model_detail_create_button_clicked(self, button):
         self.create_model(button.get_name(), False)
 
+    def add_endpoint_row(self, url:str):
+        row = Adw.ActionRow(
+            title=url,
+            name=url
+        )
+        remove_button = Gtk.Button(
+            icon_name='user-trash-symbolic',
+            valign=3,
+            css_classes=['flat', 'circular'],
+            tooltip_text=_('Remove Instance')
+        )
+        remove_button.connect('clicked', lambda *_, row=row: dialog_widget.simple(
+            _('Remove Instance?'),
+            _("Are you sure you want to remove '{}'?").format(url),
+            lambda row=row: generic_actions.remove_endpoint(row),
+            _('Remove'),
+            'destructive'
+        ))
+        row.add_suffix(remove_button)
+        self.endpoints_group.add(row)
+
+    def show_request_queue(self):
+        priorities = {
+            connection_handler.PRIORITY_CHAT: _('Chat'),
+            connection_handler.PRIORITY_REGENERATE: _('Regenerate'),
+            connection_handler.PRIORITY_BACKGROUND: _('Background')
+        }
+        lines = []
+        for job in self.ollama_instance.scheduler.get_queue():
+            lines.append('{} • {} • {} ({}s)\n{}'.format(
+                _('Running') if job['running'] else _('Waiting'),
+                priorities[job['priority']],
+                job['description'],
+                round(job['elapsed']),
+                job['target']
+            ))
+        dialog_widget.Options(
+            _('Request Queue'),
+            '\n\n'.join(lines) if lines else _('There are no requests running or waiting'),
+            'close',
+            {_('Close'): {}}
+        )
+
     def convert_model_name(self, name:str, mode:int) -> str: # mode=0 name:tag -> Name (tag)   |   mode=1 Name (tag) -> name:tag
         try:
             if mode == 0:
@@ -457,23 +505,25 @@ class AlpacaWindow(Adw.ApplicationWindow):
         chat = self.quick_ask_overlay.get_child()
         chat_name = self.generate_numbered_name(chat.get_name(), [tab.chat_window.get_name() for tab in self.chat_list_box.tab_list])
         new_chat = self.chat_list_box.new_chat(chat_name)
-        sqlite_con = sqlite3.connect(self.sqlite_path)
-        cursor = sqlite_con.cursor()
+        messages = []
         for message in chat.messages.values():
             message_author = 'user'
             if message.bot:
                 message_author = 'assistant'
             if message.system:
                 message_author = 'system'
-            cursor.execute("INSERT INTO message (id, chat_id, role, model, date_time, content) VALUES (?, ?, ?, ?, ?, ?)",
-                (message.message_id, new_chat.chat_id, message_author, message.model, message.dt.strftime("%Y/%m/%d %H:%M:%S"), message.text))
-        sqlite_con.commit()
-        sqlite_con.close()
-        threading.Thread(target=new_chat.load_chat_messages).start()
+            messages.append((message.message_id, new_chat.chat_id, message_author, message.model, message.dt, message.text))
+        storage.add_messages(messages)
+        new_chat.load_chat_messages()
         self.present()
 
     @Gtk.Template.Callback()
     def closing_quick_ask(self, user_data):
+        chat = self.quick_ask_overlay.get_child()
+        # Closing Quick Ask cancels its generation
+        if chat and chat.request_handle:
+            chat.request_handle.cancel()
+            chat.request_handle = None
         if not self.get_visible():
             self.close()
 
@@ -539,18 +589,15 @@ class AlpacaWindow(Adw.ApplicationWindow):
             if file_type == 'image':
                 self.file_preview_image.set_visible(True)
                 self.file_preview_text_label.set_visible(False)
-                image_data = base64.b64decode(file_content)
-                loader = GdkPixbuf.PixbufLoader.new()
-                loader.write(image_data)
-                loader.close()
-                pixbuf = loader.get_pixbuf()
-                texture = Gdk.Texture.new_for_pixbuf(pixbuf)
-                self.file_preview_image.set_from_paintable(texture)
+                self.file_preview_image.set_from_paintable(None)
+                self.file_preview_id += 1
+                texture_cache.shared_cache.load_texture(file_content, None, lambda texture, preview_id=self.file_preview_id: self.file_preview_image.set_from_paintable(texture) if preview_id == self.file_preview_id else None)
                 self.file_preview_image.set_size_request(360, 360)
                 self.file_preview_image.set_overflow(1)
                 self.file_preview_dialog.set_title(file_name)
                 self.file_preview_open_button.set_visible(False)
             else:
+                self.file_preview_id += 1
                 self.file_preview_image.set_visible(False)
                 self.file_preview_text_label.set_visible(True)
                 buffer = self.file_preview_text_label.set_label(file_content)
@@ -564,7 +611,7 @@ class AlpacaWindow(Adw.ApplicationWindow):
                     self.file_preview_open_button.set_visible(False)
             self.file_preview_dialog.present(self)
 
-    def generate_chat_title(self, message, old_chat_name):
+    def generate_chat_title(self, message, old_chat_name, chat_id:str):
         logger.debug("Generating chat title")
         system_prompt = f"""
 Generate a title following these rules:
@@ -577,7 +624,7 @@ Generate a title following these rules:
         current_model = self.model_manager.get_selected_model()
         data = {"model": current_model, "messages": [{"role": "system", "content": system_prompt}] + [message], "stream": False}
         try:
-            response = self.ollama_instance.request("POST", "api/chat", json.dumps(data))
+            response = self.ollama_instance.request("POST", "api/chat", json.dumps(data), model=current_model, priority=connection_handler.PRIORITY_BACKGROUND, group=chat_id)
             if response.status_code == 200:
                 new_chat_name = json.loads(response.text)["message"]["content"].strip().removeprefix("Title: ").removeprefix("title: ").strip('\'"').replace('\n', ' ').title().replace('\'S', '\'s')
                 new_chat_name = new_chat_name[:50] + (new_chat_name[50:] and '...')
@@ -589,12 +636,16 @@ Generate a title following these rules:
         self.stop_button.set_visible(not send)
         self.send_button.set_visible(send)
 
-    def run_message(self, data:dict, message_element:message_widget.message, chat:chat_widget.chat):
+    def run_message(self, data:dict, message_element:message_widget.message, chat:chat_widget.chat, regenerate:bool=False, older_than:str=None):
         logger.debug("Running message")
+        if older_than:
+            # Messages that aren't loaded are read here instead of on the main thread
+            data['messages'] = chat.get_older_ollama_messages(older_than) + data['messages']
         chat.busy = True
         self.chat_list_box.get_tab_by_name(chat.get_name()).spinner.set_visible(True)
+        title_args = None
         if [m['role'] for m in data['messages']].count('assistant') == 0 and chat.get_name().startswith(_("New Chat")):
-            threading.Thread(target=self.generate_chat_title, args=(data['messages'][0].copy(), chat.get_name())).start()
+            title_args = (data['messages'][0].copy(), chat.get_name(), chat.chat_id)
 
         if chat.welcome_screen:
             chat.welcome_screen.set_visible(False)
@@ -604,54 +655,53 @@ Generate a title following these rules:
         self.switch_send_stop_button(False)
         if self.regenerate_button:
             GLib.idle_add(self.chat_list_box.get_current_chat().remove, self.regenerate_button)
+        handle = connection_handler.request_handle()
+        chat.request_handle = handle
+        message_element.start_request()
+
+        def update_message(chunks):
+            # The title is only requested once the answer started, so it can't take the slot before the chat request
+            nonlocal title_args
+            if title_args:
+                threading.Thread(target=self.generate_chat_title, args=title_args).start()
+                title_args = None
+            message_element.update_message_batch(chunks)
+
         try:
-            response = self.ollama_instance.request("POST", "api/chat", json.dumps(data), lambda data, message_element=message_element: message_element.update_message(data))
-            if response.status_code != 200:
+            response = self.ollama_instance.request("POST", "api/chat", json.dumps(data), update_message, handle, data['model'], priority=connection_handler.PRIORITY_REGENERATE if regenerate else connection_handler.PRIORITY_CHAT, group=chat.chat_id, batched=True)
+            if response.cancelled:
+                GLib.idle_add(message_element.end_stream)
+            elif response.status_code != 200:
                 raise Exception('Network Error')
+            else:
+                message_element.save_metrics(response.endpoint)
         except Exception as e:
             logger.error(e)
+            message_element.streaming = False
             self.chat_list_box.get_tab_by_name(chat.get_name()).spinner.set_visible(False)
             chat.busy = False
             if message_element.spinner:
                 GLib.idle_add(message_element.container.remove, message_element.spinner)
                 message_element.spinner = None
-            GLib.idle_add(message_element.set_text, message_element.content_children[-1].get_label())
+            GLib.idle_add(message_element.stop_stream)
+            GLib.idle_add(lambda: message_element.set_text(message_element.stream_text))
             GLib.idle_add(message_element.add_footer, datetime.now())
             GLib.idle_add(chat.show_regenerate_button, message_element)
-            sqlite_con = sqlite3.connect(window.sqlite_path)
-            cursor = sqlite_con.cursor()
-            cursor.execute("UPDATE message SET date_time = ?, content = ? WHERE id = ?",
-                (message_element.dt.strftime("%Y/%m/%d %H:%M:%S"), message_element.content_children[-1].get_label(), message_element.message_id)
-            )
-            sqlite_con.commit()
-            sqlite_con.close()
+            storage.update_message(message_element.message_id, message_element.dt, message_element.get_streamed_text())
             GLib.idle_add(self.connection_error)
 
     def load_history(self):
         logger.debug("Loading history")
-        sqlite_con = sqlite3.connect(self.sqlite_path)
-        cursor = sqlite_con.cursor()
-        selected_chat = cursor.execute("SELECT value FROM preferences WHERE id='selected_chat'").fetchone()
-        if selected_chat:
-            selected_chat = selected_chat[0]
-        chats = cursor.execute('SELECT chat.id, chat.name, MAX(message.date_time) AS latest_message_time FROM chat LEFT JOIN message ON chat.id = message.chat_id GROUP BY chat.id ORDER BY latest_message_time DESC').fetchall()
-        threads = []
+        selected_chat = storage.get_preference('selected_chat')
+        chats = storage.get_chats()
         if len(chats) > 0:
+            # Chats are added as stubs, selecting one loads its messages
             for row in chats:
-                self.chat_list_box.append_chat(row[1], row[0])
-                chat_container = self.chat_list_box.get_chat_by_name(row[1])
-                if not selected_chat:
-                    selected_chat = row[1]
-                if row[1] == selected_chat:
-                    self.chat_list_box.select_row(self.chat_list_box.tab_list[-1])
-                thread = threading.Thread(target=chat_container.load_chat_messages)
-                thread.start()
-                threads.append(thread)
+                self.chat_list_box.append_chat(row[1], row[0], row[2])
+            selected_tab = self.chat_list_box.get_tab_by_name(selected_chat) if selected_chat else None
+            self.chat_list_box.select_row(selected_tab if selected_tab else self.chat_list_box.tab_list[0])
         else:
             self.chat_list_box.new_chat()
-        #for thread in threads:
-            #thread.join()
-        sqlite_con.close()
 
     def generate_numbered_name(self, chat_name:str, compare_list:list) -> str:
         if chat_name in compare_list:
@@ -667,7 +717,7 @@ Generate a title following these rules:
         return chat_name
 
     def generate_uuid(self) -> str:
-        return f"{datetime.today().strftime('%Y%m%d%H%M%S%f')}{uuid.uuid4().hex}"
+        return storage.generate_id()
 
     def connection_error(self):
         logger.error("Connection error")
@@ -924,11 +974,7 @@ Generate a title following these rules:
             self.ollama_instance.remote = False
             threading.Thread(target=self.ollama_instance.start).start()
             self.model_manager.update_local_list()
-            sqlite_con = sqlite3.connect(self.sqlite_path)
-            cursor = sqlite_con.cursor()
-            cursor.execute("UPDATE preferences SET value=?, type=? WHERE id=?", (False, str(type(False)), "run_remote"))
-            sqlite_con.commit()
-            sqlite_con.close()
+            storage.set_preference("run_remote", False)
 
             [element.set_sensitive(True) for element in sensitive_elements]
             self.get_application().lookup_action('manage_models').set_enabled(True)
@@ -953,13 +999,18 @@ Generate a title following these rules:
         elif self.ollama_instance.remote:
             threading.Thread(target=local_instance_process).start()
 
-    def run_quick_chat(self, data:dict, message_element:message_widget.message):
+    def run_quick_chat(self, data:dict, message_element:message_widget.message, chat:chat_widget.chat):
+        handle = connection_handler.request_handle()
+        chat.request_handle = handle
         try:
-            response = self.ollama_instance.request("POST", "api/chat", json.dumps(data), lambda data, message_element=message_element: message_element.update_message(data))
-            if response.status_code != 200:
+            response = self.ollama_instance.request("POST", "api/chat", json.dumps(data), lambda chunks, message_element=message_element: message_element.update_message_batch(chunks), handle, data['model'], priority=connection_handler.PRIORITY_CHAT, group='QA', batched=True)
+            if response.cancelled:
+                GLib.idle_add(message_element.end_stream)
+            elif response.status_code != 200:
                 raise Exception('Network Error')
         except Exception as e:
             logger.error(e)
+            message_element.streaming = False
             self.show_toast(_("An error occurred: {}").format(e), self.quick_ask_overlay)
 
     def quick_chat(self, message:str):
@@ -990,25 +1041,12 @@ Generate a title following these rules:
         m_element_bot = chat.messages[bot_id]
         m_element_bot.set_text()
         chat.busy = True
-        threading.Thread(target=self.run_quick_chat, args=(data, m_element_bot)).start()
+        threading.Thread(target=self.run_quick_chat, args=(data, m_element_bot, chat)).start()
 
     def prepare_alpaca(self):
-        sqlite_con = sqlite3.connect(self.sqlite_path)
-        cursor = sqlite_con.cursor()
-
-        configuration = {}
-        for row in cursor.execute("SELECT id, value, type FROM preferences").fetchall():
-            value = row[1]
-            if row[2] == "<class 'int'>":
-                value = int(value)
-            elif row[2] == "<class 'float'>":
-                value = float(value)
-            elif row[2] == "<class 'bool'>":
-                value = value == "1"
-            configuration[row[0]] = value
+        configuration = storage.get_preferences()
         if 'show_welcome_dialog' in configuration and configuration['show_welcome_dialog']:
             self.welcome_dialog.present(self)
-            sqlite_con.close()
             return
 
         configuration['model_tweaks'] = {
@@ -1016,22 +1054,34 @@ Generate a title following these rules:
             "seed": configuration['seed'] if 'seed' in configuration else 0,
             "keep_alive": configuration['keep_alive'] if 'keep_alive' in configuration else 5
         }
-        configuration['ollama_overrides'] = {}
-        for row in cursor.execute("SELECT id, value FROM overrides"):
-            configuration['ollama_overrides'][row[0]] = row[1]
+        configuration['connection_settings'] = {
+            "pool_size": configuration['connection_pool_size'] if 'connection_pool_size' in configuration else 10,
+            "connect_timeout": configuration['connect_timeout'] if 'connect_timeout' in configuration else 5,
+            "read_timeout": configuration['read_timeout'] if 'read_timeout' in configuration else 0
+        }
+        configuration['ollama_overrides'] = storage.get_overrides()
 
         #Model Manager
         self.model_manager = model_widget.model_manager_container()
         self.model_scroller.set_child(self.model_manager)
 
         #Chat History
+        self.chat_list_box.max_live_chats = configuration['max_live_chats']
+        GLib.idle_add(self.live_chats_spin.set_value, configuration['max_live_chats'])
         self.load_history()
 
         if self.get_application().args.new_chat:
             self.chat_list_box.new_chat(self.get_application().args.new_chat)
 
         #Instance
-        self.ollama_instance = connection_handler.instance(configuration['local_port'], configuration['remote_url'], configuration['run_remote'], configuration['model_tweaks'], configuration['ollama_overrides'], configuration['remote_bearer_token'], configuration['idle_timer'], configuration['model_directory'])
+        self.ollama_instance = connection_handler.instance(configuration['local_port'], configuration['remote_url'], configuration['run_remote'], configuration['model_tweaks'], configuration['ollama_overrides'], configuration['remote_bearer_token'], configuration['idle_timer'], configuration['model_directory'], configuration['connection_settings'])
+
+        for row in storage.get_endpoints():
+            self.ollama_instance.add_endpoint(row[0], row[1])
+            self.add_endpoint_row(row[0])
+
+        self.ollama_instance.preload_enabled = configuration['preload_models']
+        GLib.idle_add(self.preload_switch.set_active, configuration['preload_models'])
 
         #Model Manager P.2
         threading.Thread(target=self.model_manager.update_available_list).start()
@@ -1074,8 +1124,6 @@ Generate a title following these rules:
         if self.get_application().args.ask:
             self.quick_chat(self.get_application().args.ask)
 
-        sqlite_con.close()
-
     def open_button_menu(self, gesture, x, y, menu):
         button = gesture.get_widget()
         popover = Gtk.PopoverMenu(
@@ -1093,59 +1141,7 @@ Generate a title following these rules:
     def setup_sqlite(self):
         if os.path.exists(os.path.join(data_dir, "chats_test.db")) and not os.path.exists(os.path.join(data_dir, "alpaca.db")):
             shutil.move(os.path.join(data_dir, "chats_test.db"), os.path.join(data_dir, "alpaca.db"))
-        sqlite_con = sqlite3.connect(self.sqlite_path)
-        cursor = sqlite_con.cursor()
-
-        tables = {
-            "chat": """
-                CREATE TABLE chat (
-                    id TEXT NOT NULL PRIMARY KEY,
-                    name TEXT NOT NULL
-                );
-            """,
-            "message": """
-                CREATE TABLE message (
-                    id TEXT NOT NULL PRIMARY KEY,
-                    chat_id TEXT NOT NULL,
-                    role TEXT NOT NULL,
-                    model TEXT,
-                    date_time DATETIME NOT NULL,
-                    content TEXT NOT NULL
-                )
-            """,
-            "attachment": """
-                CREATE TABLE attachment (
-                    id TEXT NOT NULL PRIMARY KEY,
-                    message_id TEXT NOT NULL,
-                    type TEXT NOT NULL,
-                    name TEXT NOT NULL,
-                    content TEXT NOT NULL
-                )
-            """,
-            "model": """
-                CREATE TABLE model (
-                    id TEXT NOT NULL PRIMARY KEY,
-                    picture TEXT NOT NULL
-                )
-            """,
-            "preferences": """
-                CREATE TABLE preferences (
-                    id TEXT NOT NULL PRIMARY KEY,
-                    value TEXT,
-                    type TEXT
-                )
-            """,
-            "overrides": """
-                CREATE TABLE overrides (
-                    id TEXT NOT NULL PRIMARY KEY,
-                    value TEXT
-                )
-            """
-        }
-
-        for name, script in tables.items():
-            if not cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (name,)).fetchone():
-                cursor.execute(script)
+        storage.setup(markdown_parser.PARSER_VERSION)
 
         preferences = {
             "remote_url": "http://0.0.0.0:11434",
@@ -1161,46 +1157,40 @@ Generate a title following these rules:
             "show_welcome_dialog": True,
             "temperature": 0.7,
             "seed": 0,
-            "keep_alive": 5
+            "keep_alive": 5,
+            "connection_pool_size": 10,
+            "connect_timeout": 5,
+            "read_timeout": 0,
+            "preload_models": False,
+            "max_live_chats": 5
         }
 
-        for name, value in preferences.items():
-            if not cursor.execute("SELECT * FROM preferences WHERE id=?", (name,)).fetchone():
-                cursor.execute("INSERT INTO preferences (id, value, type) VALUES (?, ?, ?)", (name, value, str(type(value))))
-
-        sqlite_con.commit()
-        sqlite_con.close()
+        storage.add_missing_preferences(preferences)
 
     def initial_convert_to_sql(self):
         if os.path.exists(os.path.join(data_dir, "chats", "chats.json")):
             try:
                 with open(os.path.join(data_dir, "chats", "chats.json"), "r", encoding="utf-8") as f:
                     data = json.load(f)
-                    sqlite_con = sqlite3.connect(self.sqlite_path)
-                    cursor = sqlite_con.cursor()
                     for chat_name in data['chats'].keys():
                         chat_id = self.generate_uuid()
-                        cursor.execute("INSERT INTO chat (id, name) VALUES (?, ?);", (chat_id, chat_name))
-
+                        storage.add_chat(chat_id, chat_name)
+                        messages = []
+                        attachments = []
                         for message_id, message in data['chats'][chat_name]['messages'].items():
-                            cursor.execute("INSERT INTO message (id, chat_id, role, model, date_time, content) VALUES (?, ?, ?, ?, ?, ?)",
-                            (message_id, chat_id, message['role'], message['model'], message['date'], message['content']))
+                            messages.append((message_id, chat_id, message['role'], message['model'], message['date'], message['content']))
 
                             if 'files' in message:
                                 for file_name, file_type in message['files'].items():
                                     attachment_id = self.generate_uuid()
                                     content = self.get_content_of_file(os.path.join(data_dir, "chats", chat_name, message_id, file_name), file_type)
-                                    cursor.execute("INSERT INTO attachment (id, message_id, type, name, content) VALUES (?, ?, ?, ?, ?)",
-                                    (attachment_id, message_id, file_type, file_name, content))
+                                    attachments.append((attachment_id, message_id, file_type, file_name, content))
                             if 'images' in message:
                                 for image in message['images']:
                                     attachment_id = self.generate_uuid()
                                     content = self.get_content_of_file(os.path.join(data_dir, "chats", chat_name, message_id, image), 'image')
-                                    cursor.execute("INSERT INTO attachment (id, message_id, type, name, content) VALUES (?, ?, ?, ?, ?)",
-                                    (attachment_id, message_id, 'image', image, content))
-
-                    sqlite_con.commit()
-                    sqlite_con.close()
+                                    attachments.append((attachment_id, message_id, 'image', image, content))
+                        storage.add_messages(messages, attachments)
                 shutil.move(os.path.join(data_dir, "chats"), os.path.join(data_dir, "chats_OLD"))
             except Exception as e:
                 logger.error(e)
@@ -1213,26 +1203,13 @@ Generate a title following these rules:
             try:
                 with open(os.path.join(config_dir, "server.json"), "r", encoding="utf-8") as f:
                     data = json.load(f)
-                    sqlite_con = sqlite3.connect(self.sqlite_path)
-                    cursor = sqlite_con.cursor()
                     if 'model_tweaks' in data:
                         for name, value in data['model_tweaks'].items():
                             data[name] = value
                         del data['model_tweaks']
-                    for name, value in data.items():
-                        if isinstance(value, dict) and name == 'ollama_overrides':
-                            for name2, value2 in value.items():
-                                if cursor.execute("SELECT * FROM overrides WHERE id=?", (name2,)).fetchone():
-                                    cursor.execute("UPDATE overrides SET value=? WHERE id=?", (value2, name2))
-                                else:
-                                    cursor.execute("INSERT INTO overrides (id, value) VALUES (?, ?)", (name2, value2))
-                        else:
-                            if cursor.execute("SELECT * FROM preferences WHERE id=?", (name,)).fetchone():
-                                cursor.execute("UPDATE preferences SET value=?, type=? WHERE id=?", (value, str(type(value)), name))
-                            else:
-                                cursor.execute("INSERT INTO preferences (id, value, type) VALUES (?, ?, ?)", (name, value, str(type(value))))
-                    sqlite_con.commit()
-                    sqlite_con.close()
+                    if isinstance(data.get('ollama_overrides'), dict):
+                        storage.set_overrides(data.pop('ollama_overrides'))
+                    storage.set_preferences(data)
                 os.remove(os.path.join(config_dir, "server.json"))
             except Exception as e:
                 logger.error(e)
@@ -1267,6 +1244,8 @@ Generate a title following these rules:
         GtkSource.init()
         self.setup_sqlite()
         self.initial_convert_to_sql()
+        # The preferences are read right after, before the window is shown
+        storage.flush()
         self.message_searchbar.connect('notify::search-mode-enabled', lambda *_: self.message_search_button.set_active(self.message_searchbar.get_search_mode()))
         message_widget.window = self
         chat_widget.window = self
@@ -1286,6 +1265,7 @@ Generate a title following these rules:
         self.message_text_view.add_controller(drop_target)
         self.message_text_view.get_buffer().set_style_scheme(GtkSource.StyleSchemeManager.get_default().get_scheme('adwaita'))
         self.message_text_view.connect('paste-clipboard', self.on_clipboard_paste)
+        self.message_text_view.get_buffer().connect('changed', self.message_buffer_changed)
 
         self.chat_list_box = chat_widget.chat_list()
         self.chat_list_container.set_child(self.chat_list_box)
@@ -1321,6 +1301,7 @@ Generate a title following these rules:
             'export_current_chat': [self.current_chat_actions],
             'toggle_sidebar': [lambda *_: self.split_view_overlay.set_show_sidebar(not self.split_view_overlay.get_show_sidebar()), ['F9']],
             'manage_models': [lambda *_: self.manage_models_dialog.present(self), ['<primary>m']],
+            'request_queue': [lambda *_: self.show_request_queue()],
             'search_messages': [lambda *_: self.message_searchbar.set_search_mode(not self.message_searchbar.get_search_mode()), ['<primary>f']],
             'send_message': [lambda *_: self.send_message()],
             'send_system_message': [lambda *_: self.send_message(None, True)],